@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Provide an opt-in persistent cache for layer system responses and particle coupling lookup tables.
+
+If a cache directory is set with set_cache_directory, the arrays are stored as .npy files in one subdirectory per entry
+and are loaded as read-only memory maps when the same physical and numerical parameters occur again, for example in a
+later run with the same layer system and wavelength. Entries are written to a temporary directory first and then
+renamed, such that several processes can share the same cache directory."""
+
+import os
+import sys
+import pickle
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+import smuthi.memoizing as memo
+
+
+# path of the cache directory. If None, the disk cache is disabled.
+cache_directory = None
+
+
+def set_cache_directory(directory=None):
+    """Enable or disable the disk cache.
+
+    Args:
+        directory (str or None):    Path of the cache directory (is created if it does not exist). If None, the disk
+                                    cache is disabled.
+    """
+    global cache_directory
+    if directory is not None:
+        directory = os.path.abspath(directory)
+        os.makedirs(directory, exist_ok=True)
+    cache_directory = directory
+
+
+def entry_key(kind, **parameters):
+    """Name of the cache entry for a given set of parameters.
+
+    Args:
+        kind (str):         kind of data, e.g. 'layer_response'
+        **parameters:       all physical and numerical parameters that the data depends on
+
+    Returns:
+        entry name as str
+    """
+    digest = hashlib.sha256(pickle.dumps(memo.fingerprint(parameters), protocol=4)).hexdigest()
+    return kind + '-' + digest[:32]
+
+
+def load(key):
+    """Load a cache entry.
+
+    Args:
+        key (str):      entry name as returned by entry_key
+
+    Returns:
+        dictionary of read-only memory mapped numpy arrays, or None if the cache is disabled or the entry doesn't exist
+    """
+    if cache_directory is None:
+        return None
+    path = os.path.join(cache_directory, key)
+    if not os.path.isdir(path):
+        return None
+    return {filename[:-4]: np.load(os.path.join(path, filename), mmap_mode='r')
+            for filename in os.listdir(path) if filename.endswith('.npy')}
+
+
+def store(key, **arrays):
+    """Write a cache entry. If the entry has meanwhile been written by another process, the existing entry is kept.
+
+    Args:
+        key (str):          entry name as returned by entry_key
+        **arrays:           numpy arrays to store
+
+    Returns:
+        dictionary of read-only memory mapped numpy arrays, or the arrays themselves if the cache is disabled
+    """
+    if cache_directory is None:
+        return arrays
+    temporary_path = tempfile.mkdtemp(prefix='.' + key + '-', dir=cache_directory)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary_path, name + '.npy'), array)
+        os.rename(temporary_path, os.path.join(cache_directory, key))
+    except OSError:     # entry exists already (written concurrently by another process), or the disk is full
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    entry = load(key)
+    if entry is None or set(entry) != set(arrays):
+        sys.stdout.write('Could not write disk cache entry ' + key + '\n')
+        sys.stdout.flush()
+        return arrays
+    return entry
+
+
+def clear():
+    """Remove all entries from the cache directory."""
+    if cache_directory is None:
+        return
+    for filename in os.listdir(cache_directory):
+        path = os.path.join(cache_directory, filename)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""Multilevel fast multipole method (FMM) for the direct particle coupling inside homogeneous layers.
+
+The direct coupling matrix W maps the outgoing (scattered field) coefficients of all particles to the regular
+(incoming field) coefficients of all particles. Its matrix-vector product is split into
+
+- a near field part: coupling between particles in neighboring leaf boxes of an octree, stored as a sparse matrix
+  of direct coupling blocks (see smuthi.particle_coupling.direct_coupling_block_list), and
+- a far field part: the outgoing waves of the particles in a box are translated to an outgoing (multipole) expansion
+  about the box center (P2M), multipole expansions are translated up the tree (M2M), converted into regular (local)
+  expansions about the centers of well separated boxes (M2L), translated down the tree (L2L) and finally evaluated at
+  the receiving particles (L2P).
+
+All translations are given by the SVWF translation operator in the conventions of
+smuthi.vector_wave_functions.translation_coefficients_svwf: M2L uses the outgoing to regular translation (spherical
+Hankel functions), while P2M, M2M, L2L and L2P use the outgoing to outgoing or regular to regular translation (spherical
+Bessel functions, see translation_coefficients_svwf_out_to_out). The M2M, M2L and L2L operators only depend on the
+relative position of the boxes and are computed once per level and box offset.
+"""
+
+import smuthi.particle_coupling as coup
+import smuthi.field_expansion as fldex
+import smuthi.coordinates as coord
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import itertools
+import sys
+from tqdm import tqdm
+
+
+def translation_blocks(k, vectors, l_max1, m_max1, l_max2, m_max2, regular=False):
+    """Matrix blocks of the SVWF translation for an array of translation vectors, in the layout of the direct coupling
+    matrix blocks (index of the receiving expansion first).
+
+    Args:
+        k (float or complex):   Wavenumber
+        vectors (numpy.ndarray):    Translation vectors (receiving minus emitting origin) in the format [n, 3]
+        l_max1 (int):           Maximal multipole degree of the receiving expansion
+        m_max1 (int):           Maximal multipole order of the receiving expansion
+        l_max2 (int):           Maximal multipole degree of the emitting expansion
+        m_max2 (int):           Maximal multipole order of the emitting expansion
+        regular (bool):         If False, translate outgoing to regular waves (M2L). If True, translate outgoing to
+                                outgoing or regular to regular waves (P2M, M2M, L2L, L2P)
+
+    Returns:
+        Complex array of shape [n, blocksize1, blocksize2]
+    """
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 3)
+    distance = np.linalg.norm(vectors, axis=1)
+    rho = np.sqrt(vectors[:, 0]**2 + vectors[:, 1]**2)
+    cos_theta = np.ones(len(distance))
+    sin_theta = np.zeros(len(distance))
+    nonzero = distance > 0
+    cos_theta[nonzero] = vectors[nonzero, 2] / distance[nonzero]
+    sin_theta[nonzero] = rho[nonzero] / distance[nonzero]
+    phi = np.arctan2(vectors[:, 1], vectors[:, 0])
+    m1 = coup.block_m_array(l_max1, m_max1)
+    m2 = coup.block_m_array(l_max2, m_max2)
+    w = coup.direct_coupling_kernel(k, distance, cos_theta, sin_theta, l_max1, m_max1, l_max2, m_max2, regular)
+    return w * np.exp(1j * (m2[None, None, :] - m1[None, :, None]) * phi[:, None, None])
+
+
+def expansion_order(k, box_size, tolerance=1e-4, separation=2, l_min=1):
+    """Multipole degree of the box expansions on one level of the octree. The order is the maximum of an excess
+    bandwidth estimate for the box radius and of the number of terms needed for the geometric convergence of the
+    translation between well separated boxes, estimated with the ratio of the box radius to the minimal distance of
+    the centers of well separated boxes.
+
+    Args:
+        k (float or complex):   Wavenumber
+        box_size (float):       Edge length of the boxes
+        tolerance (float):      Targeted relative accuracy
+        separation (int):       Number of neighbor boxes in each direction that are treated as near field
+        l_min (int):            Lower bound for the expansion order, e.g. the maximal multipole degree of the particles
+
+    Returns:
+        Expansion order (int)
+    """
+    box_radius = np.sqrt(3) / 2 * box_size
+    digits = -np.log10(tolerance)
+    kr = abs(k) * box_radius
+    l_bandwidth = kr + 1.8 * digits**(2 / 3) * kr**(1 / 3)
+    ratio = box_radius / ((separation + 1) * box_size)
+    l_geometric = np.log(tolerance) / np.log(ratio)
+    return int(max(l_min, np.ceil(l_bandwidth), np.ceil(l_geometric)))
+
+
+class Octree:
+    """Octree with uniform depth. The boxes of each level are identified by their integer coordinates, only boxes that
+    contain particles are stored.
+
+    Args:
+        positions (numpy.ndarray):  Particle positions in the format [number of particles, 3]
+        max_leaf_size (float):      The tree is refined until the mean number of particles per (nonempty) leaf box is
+                                    not larger than max_leaf_size
+        separation (int):           Boxes with a distance of up to separation boxes in each direction are neighbors
+        max_depth (int):            Maximal number of levels below the root box
+
+    Attributes:
+        depth (int):                Index of the leaf level
+        box_size (list):            Edge length of the boxes on each level
+        box_coordinates (list):     For each level, integer array [number of boxes, 3] with the coordinates of the
+                                    nonempty boxes, sorted by box key
+        box_centers (list):         For each level, array [number of boxes, 3] with the box centers
+        parents (list):             For each level > 0, index of the parent box of each box on the level above
+        particle_box (numpy.ndarray):   Leaf box index of each particle
+    """
+    def __init__(self, positions, max_leaf_size=8, separation=2, max_depth=10):
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        self.separation = separation
+        self.lower_corner = self.positions.min(axis=0)
+        extent = (self.positions.max(axis=0) - self.lower_corner).max()
+        self.root_size = extent * (1 + 1e-9) if extent > 0 else 1.0
+
+        self.depth = 0
+        while self.depth < max_depth:
+            number_boxes = len(np.unique(self.box_keys(self.depth, self.particle_coordinates(self.depth))))
+            if len(self.positions) / number_boxes <= max_leaf_size:
+                break
+            self.depth += 1
+
+        self.box_size = [self.root_size / 2**level for level in range(self.depth + 1)]
+        self.box_coordinates = []
+        self.box_centers = []
+        self.parents = [None]
+        for level in range(self.depth + 1):
+            particle_coordinates = self.particle_coordinates(level)
+            keys, first = np.unique(self.box_keys(level, particle_coordinates), return_index=True)
+            self.box_coordinates.append(particle_coordinates[first])
+            self.box_centers.append(self.lower_corner + (particle_coordinates[first] + 0.5) * self.box_size[level])
+            if level > 0:
+                self.parents.append(self.find_boxes(level - 1, self.box_coordinates[level] // 2))
+            if level == self.depth:
+                self.particle_box = np.searchsorted(keys, self.box_keys(level, particle_coordinates))
+
+    def particle_coordinates(self, level):
+        """Integer coordinates of the box that contains each particle on a given level."""
+        coordinates = np.floor((self.positions - self.lower_corner) / (self.root_size / 2**level)).astype(np.int64)
+        return np.clip(coordinates, 0, 2**level - 1)
+
+    def box_keys(self, level, coordinates):
+        """Unique integer key for integer box coordinates on a given level."""
+        return (coordinates[:, 0] * 2**level + coordinates[:, 1]) * 2**level + coordinates[:, 2]
+
+    def find_boxes(self, level, coordinates):
+        """Index of the boxes with given integer coordinates on a given level, or -1 for empty boxes.
+
+        Args:
+            level (int):                    Level of the boxes
+            coordinates (numpy.ndarray):    Integer box coordinates in the format [n, 3]
+
+        Returns:
+            Integer array of length n
+        """
+        keys = self.box_keys(level, self.box_coordinates[level])
+        valid = np.all((coordinates >= 0) & (coordinates < 2**level), axis=1)
+        search_keys = self.box_keys(level, coordinates)
+        indices = np.minimum(np.searchsorted(keys, search_keys), len(keys) - 1)
+        found = valid & (keys[indices] == search_keys)
+        return np.where(found, indices, -1)
+
+    def interaction_list(self, level):
+        """Pairs of boxes on a given level which are well separated, but whose parents are neighbors.
+
+        Args:
+            level (int):    Level of the boxes
+
+        Returns:
+            List of tuples (offset, targets, sources) with the integer offset vector of the source box relative to the
+            target box and the arrays of target and source box indices with that offset
+        """
+        interactions = []
+        if level < 1:
+            return interactions
+        coordinates = self.box_coordinates[level]
+        bound = 2 * self.separation + 1
+        for offset in itertools.product(range(-bound, bound + 1), repeat=3):
+            offset = np.array(offset)
+            if np.abs(offset).max() <= self.separation:
+                continue
+            sources = self.find_boxes(level, coordinates + offset)
+            parent_distance = np.abs((coordinates + offset) // 2 - coordinates // 2).max(axis=1)
+            targets = np.nonzero((sources >= 0) & (parent_distance <= self.separation))[0]
+            if len(targets):
+                interactions.append((offset, targets, sources[targets]))
+        return interactions
+
+    def near_field_pairs(self):
+        """Pairs of distinct particles in neighboring leaf boxes.
+
+        Returns:
+            Tuple (receiving, emitting) of integer arrays with the particle numbers of each pair
+        """
+        level = self.depth
+        coordinates = self.box_coordinates[level]
+        order = np.argsort(self.particle_box, kind='stable')
+        count = np.bincount(self.particle_box, minlength=len(coordinates))
+        start = np.concatenate([[0], np.cumsum(count)[:-1]])
+
+        target_boxes = []
+        source_boxes = []
+        for offset in itertools.product(range(-self.separation, self.separation + 1), repeat=3):
+            sources = self.find_boxes(level, coordinates + np.array(offset))
+            targets = np.nonzero(sources >= 0)[0]
+            target_boxes.append(targets)
+            source_boxes.append(sources[targets])
+        target_boxes = np.concatenate(target_boxes)
+        source_boxes = np.concatenate(source_boxes)
+
+        number_pairs = count[target_boxes] * count[source_boxes]
+        box_pair = np.repeat(np.arange(len(target_boxes)), number_pairs)
+        local = np.arange(number_pairs.sum()) - np.repeat(np.cumsum(number_pairs) - number_pairs, number_pairs)
+        source_count = count[source_boxes][box_pair]
+        receiving = order[start[target_boxes][box_pair] + local // source_count]
+        emitting = order[start[source_boxes][box_pair] + local % source_count]
+        distinct = receiving != emitting
+        return receiving[distinct], emitting[distinct]
+
+
+class LayerFMM:
+    """Far field part of the direct coupling between particles in one homogeneous layer.
+
+    Args:
+        k (float or complex):       Wavenumber in the layer
+        particle_list (list):       Particles in the layer (smuthi.particles.Particle objects)
+        index_arrays (list):        For each particle, the integer array of its coefficients in the system vector
+        octree (Octree):            Octree of the particle positions
+        tolerance (float):          Targeted relative accuracy of the box expansions
+    """
+    def __init__(self, k, particle_list, index_arrays, octree, tolerance=1e-4):
+        self.k = k
+        self.octree = octree
+        depth = octree.depth
+        l_min = max(particle.l_max for particle in particle_list)
+        self.orders = [expansion_order(k, octree.box_size[level], tolerance, octree.separation, l_min)
+                       for level in range(depth + 1)]
+        self.blocksizes = [fldex.blocksize(order, order) for order in self.orders]
+
+        # multipole to local translations for each level and box offset
+        self.m2l = []
+        for level in range(depth + 1):
+            interactions = octree.interaction_list(level)
+            if interactions:
+                offsets = np.array([offset for offset, _, _ in interactions]) * octree.box_size[level]
+                blocks = translation_blocks(k, -offsets, self.orders[level], self.orders[level], self.orders[level],
+                                            self.orders[level])
+                interactions = [(block, targets, sources)
+                                for block, (_, targets, sources) in zip(blocks, interactions)]
+            self.m2l.append(interactions)
+        interaction_levels = [level for level in range(depth + 1) if self.m2l[level]]
+        self.top_level = min(interaction_levels) if interaction_levels else depth + 1
+
+        # multipole to multipole and local to local translations between each level and its parent level, below the
+        # coarsest level with interactions
+        self.m2m = [None for level in range(self.top_level + 1)]
+        self.l2l = [None for level in range(self.top_level + 1)]
+        for level in range(self.top_level + 1, depth + 1):
+            child_offsets = (octree.box_centers[level]
+                             - octree.box_centers[level - 1][octree.parents[level]])
+            octants = (child_offsets > 0).dot([4, 2, 1])
+            unique_octants, first = np.unique(octants, return_index=True)
+            m2m_blocks = translation_blocks(k, -child_offsets[first], self.orders[level - 1], self.orders[level - 1],
+                                            self.orders[level], self.orders[level], regular=True)
+            l2l_blocks = translation_blocks(k, child_offsets[first], self.orders[level], self.orders[level],
+                                            self.orders[level - 1], self.orders[level - 1], regular=True)
+            self.m2m.append([(m2m_block, np.nonzero(octants == octant)[0])
+                             for m2m_block, octant in zip(m2m_blocks, unique_octants)])
+            self.l2l.append([(l2l_block, np.nonzero(octants == octant)[0])
+                             for l2l_block, octant in zip(l2l_blocks, unique_octants)])
+
+        # particle to multipole and local to particle translations, grouped by multipole cutoffs of the particles
+        self.particle_groups = []
+        order = self.orders[depth]
+        cutoffs = [(particle.l_max, particle.m_max) for particle in particle_list]
+        for l_max, m_max in sorted(set(cutoffs)):
+            members = np.array([i for i, cutoff in enumerate(cutoffs) if cutoff == (l_max, m_max)])
+            boxes = octree.particle_box[members]
+            box_offsets = octree.box_centers[depth][boxes] - octree.positions[members]
+            p2m = translation_blocks(k, box_offsets, order, order, l_max, m_max, regular=True)
+            l2p = translation_blocks(k, -box_offsets, l_max, m_max, order, order, regular=True)
+            indices = np.array([index_arrays[i] for i in members])
+            self.particle_groups.append((indices, boxes, p2m, l2p))
+
+    def apply(self, in_block, result):
+        """Add the far field coupling to a block of system vectors.
+
+        Args:
+            in_block (numpy.ndarray):   System vectors in the format [number of unknowns, number of vectors]
+            result (numpy.ndarray):     Array of the same format, to which the far field coupling is added
+        """
+        depth = self.octree.depth
+        if self.top_level > depth:
+            return
+        number_vectors = in_block.shape[1]
+        number_boxes = [len(centers) for centers in self.octree.box_centers]
+
+        # upward pass
+        multipoles = [None for level in range(depth + 1)]
+        multipoles[depth] = np.zeros((number_boxes[depth], self.blocksizes[depth], number_vectors), dtype=complex)
+        for indices, boxes, p2m, _ in self.particle_groups:
+            np.add.at(multipoles[depth], boxes, np.einsum('pij,pjv->piv', p2m, in_block[indices]))
+        for level in range(depth, self.top_level, -1):
+            multipoles[level - 1] = np.zeros((number_boxes[level - 1], self.blocksizes[level - 1], number_vectors),
+                                             dtype=complex)
+            parents = self.octree.parents[level]
+            for m2m_block, children in self.m2m[level]:
+                multipoles[level - 1][parents[children]] += np.einsum('ij,cjv->civ', m2m_block,
+                                                                      multipoles[level][children])
+
+        # interactions and downward pass
+        local = None
+        for level in range(self.top_level, depth + 1):
+            new_local = np.zeros((number_boxes[level], self.blocksizes[level], number_vectors), dtype=complex)
+            if local is not None:
+                parents = self.octree.parents[level]
+                for l2l_block, children in self.l2l[level]:
+                    new_local[children] += np.einsum('ij,cjv->civ', l2l_block, local[parents[children]])
+            for m2l_block, targets, sources in self.m2l[level]:
+                new_local[targets] += np.einsum('ij,cjv->civ', m2l_block, multipoles[level][sources])
+            local = new_local
+
+        for indices, boxes, _, l2p in self.particle_groups:
+            result[indices] += np.einsum('pij,pjv->piv', l2p, local[boxes])
+
+
+class DirectCouplingFMM:
+    """Direct particle coupling matrix as a linear operator that is evaluated with the fast multipole method. The
+    particles in each layer are sorted into an octree. The coupling between particles in neighboring leaf boxes is
+    stored as a sparse matrix, the remaining coupling is evaluated with multipole expansions of the boxes, see LayerFMM.
+
+    Like in smuthi.particle_coupling.direct_coupling_block_list, particles in different layers are not directly coupled.
+
+    Args:
+        vacuum_wavelength (float):  Vacuum wavelength in length units
+        particle_list (list):       List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium
+        tolerance (float):          Targeted relative accuracy of the far field coupling
+        max_leaf_size (float):      Mean number of particles per leaf box of the octree
+        separation (int):           Number of neighbor boxes in each direction that are treated as near field
+
+    Attributes:
+        linear_operator (scipy.sparse.linalg.LinearOperator):   Direct coupling matrix with matvec and matmat
+        near_field_matrix (scipy.sparse.csr_matrix):            Near field part of the direct coupling matrix
+    """
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, tolerance=1e-4, max_leaf_size=8,
+                 separation=2):
+        blocksizes = np.array([fldex.blocksize(particle.l_max, particle.m_max) for particle in particle_list])
+        offsets = np.concatenate([[0], np.cumsum(blocksizes)])
+        index_arrays = [np.arange(offsets[i], offsets[i + 1]) for i in range(len(particle_list))]
+        self.shape = (offsets[-1], offsets[-1])
+        omega = coord.angular_frequency(vacuum_wavelength)
+
+        layer_numbers = np.array([layer_system.layer_number(particle.position[2]) for particle in particle_list])
+        self.layer_fmms = []
+        receiving = []
+        emitting = []
+        for iS in np.unique(layer_numbers):
+            members = np.nonzero(layer_numbers == iS)[0]
+            octree = Octree([particle_list[i].position for i in members], max_leaf_size, separation)
+            pairs = octree.near_field_pairs()
+            receiving.append(members[pairs[0]])
+            emitting.append(members[pairs[1]])
+            self.layer_fmms.append(LayerFMM(omega * layer_system.refractive_indices[iS],
+                                            [particle_list[i] for i in members],
+                                            [index_arrays[i] for i in members], octree, tolerance))
+        receiving = np.concatenate(receiving)
+        emitting = np.concatenate(emitting)
+
+        rows = []
+        columns = []
+        data = []
+        chunksize = max(1, 2**20 // max(blocksizes)**2)
+        chunks = range(0, len(receiving), chunksize)
+        for start in tqdm(chunks, desc='Near field coupling       ', file=sys.stdout,
+                          bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            chunk_receiving = receiving[start:start + chunksize]
+            chunk_emitting = emitting[start:start + chunksize]
+            blocks = coup.direct_coupling_block_list(vacuum_wavelength,
+                                                     [particle_list[i] for i in chunk_receiving],
+                                                     [particle_list[i] for i in chunk_emitting], layer_system)
+            for i1, i2, block in zip(chunk_receiving, chunk_emitting, blocks):
+                rows.append(np.repeat(index_arrays[i1], blocksizes[i2]))
+                columns.append(np.tile(index_arrays[i2], blocksizes[i1]))
+                data.append(block.ravel())
+        if data:
+            self.near_field_matrix = scipy.sparse.csr_matrix(
+                (np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))), shape=self.shape)
+        else:
+            self.near_field_matrix = scipy.sparse.csr_matrix(self.shape, dtype=complex)
+
+        def matmat(in_block):
+            in_block = np.asarray(in_block).reshape(self.shape[0], -1)
+            result = np.asarray(self.near_field_matrix.dot(in_block), dtype=complex)
+            for layer_fmm in self.layer_fmms:
+                layer_fmm.apply(in_block, result)
+            return result
+
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=matmat, matmat=matmat,
+                                                                  dtype=complex)
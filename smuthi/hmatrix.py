@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""Hierarchical matrix compression of the coupling matrix and fast direct solution of the linear system.
+
+The particles are sorted into a binary cluster tree by recursive coordinate bisection. The coupling matrix is stored in
+the hierarchically off-diagonal low-rank (HODLR) format: the diagonal blocks of the leaf clusters are dense, while the
+off-diagonal blocks between the two children of each cluster are compressed by adaptive cross approximation (ACA),
+such that only a few rows and columns of each block need to be evaluated. This is the H-matrix format for the weak
+admissibility condition. It allows an exact recursive factorization of the compressed master matrix :math:`M = 1 - TW`
+by the Sherman-Morrison-Woodbury formula, which serves as a direct solver or, with a coarse tolerance, as a
+preconditioner for GMRES (see smuthi.preconditioners.HMatrixPreconditioner).
+"""
+
+import smuthi.field_expansion as fldex
+import smuthi.particles as part
+import numpy as np
+import scipy.linalg
+import copy
+import sys
+from tqdm import tqdm
+
+
+class ClusterNode:
+    """Node of the cluster tree. Holds a contiguous range of particles in tree order and the blocks of the hierarchical
+    matrix that belong to the cluster: a dense block for leaves, the two off-diagonal low-rank blocks between the
+    children otherwise.
+
+    Args:
+        particle_start (int):   Position of the first particle of the cluster in tree order
+        particle_end (int):     Position of the last particle of the cluster in tree order plus one
+    """
+    def __init__(self, particle_start, particle_end):
+        self.particle_start = particle_start
+        self.particle_end = particle_end
+        self.children = []
+
+
+def cluster_tree(positions, leaf_size=16):
+    """Binary cluster tree by recursive coordinate bisection: each cluster is split at the median particle position
+    along the coordinate axis with the largest extent, until no cluster has more than leaf_size particles.
+
+    Args:
+        positions (numpy.ndarray):  Particle positions in the format [number of particles, 3]
+        leaf_size (int):            Maximal number of particles per leaf cluster
+
+    Returns:
+        Tuple (root, order) of the root ClusterNode and the particle numbers in tree order
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    order = np.arange(len(positions))
+    root = ClusterNode(0, len(positions))
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        members = order[node.particle_start:node.particle_end]
+        if len(members) <= leaf_size:
+            continue
+        member_positions = positions[members]
+        axis = np.argmax(member_positions.max(axis=0) - member_positions.min(axis=0))
+        order[node.particle_start:node.particle_end] = members[np.argsort(member_positions[:, axis], kind='stable')]
+        middle = node.particle_start + len(members) // 2
+        node.children = [ClusterNode(node.particle_start, middle), ClusterNode(middle, node.particle_end)]
+        nodes.extend(node.children)
+    return root, order
+
+
+def recompress(u, vt, tolerance):
+    """Truncate a low-rank matrix u.dot(vt) to the smallest rank that keeps the relative accuracy in the Frobenius norm.
+
+    Args:
+        u (numpy.ndarray):  Left factor of shape [m, k]
+        vt (numpy.ndarray): Right factor of shape [k, n]
+        tolerance (float):  Relative accuracy
+
+    Returns:
+        Tuple (u, vt) of the recompressed factors
+    """
+    if u.shape[1] == 0:
+        return u, vt
+    qu, ru = np.linalg.qr(u)
+    qv, rv = np.linalg.qr(vt.conj().T)
+    x, s, yh = np.linalg.svd(ru.dot(rv.conj().T), full_matrices=False)
+    tail_norms = np.sqrt(np.cumsum(s[::-1]**2))[::-1]  # Frobenius norm of the truncated singular values
+    rank = np.count_nonzero(tail_norms > tolerance * tail_norms[0])
+    return qu.dot(x[:, :rank] * s[:rank]), yh[:rank].dot(qv.conj().T)
+
+
+def adaptive_cross_approximation(particle_rows, particle_columns, row_offsets, column_offsets, tolerance=1e-4):
+    """Low-rank approximation u.dot(vt) of a matrix block by adaptive cross approximation with partial pivoting, where
+    the rows and columns are evaluated particle-wise: in each step, the rows of one particle and the columns of one
+    particle are evaluated and the cross approximation C P^+ R (with the pivot block P) of the residual is added.
+
+    Args:
+        particle_rows (function):       particle_rows(i) returns the rows of the i-th receiving particle of the block
+        particle_columns (function):    particle_columns(j) returns the columns of the j-th emitting particle
+        row_offsets (numpy.ndarray):    Offsets of the rows of each receiving particle (plus the number of rows)
+        column_offsets (numpy.ndarray): Offsets of the columns of each emitting particle (plus the number of columns)
+        tolerance (float):              Relative accuracy in the Frobenius norm
+
+    Returns:
+        Tuple (u, vt) of arrays with shape [rows, rank] and [rank, columns]
+    """
+    row_particles = np.repeat(np.arange(len(row_offsets) - 1), np.diff(row_offsets))
+    column_particles = np.repeat(np.arange(len(column_offsets) - 1), np.diff(column_offsets))
+    used_rows = np.zeros(len(row_offsets) - 1, dtype=bool)
+    used_columns = np.zeros(len(column_offsets) - 1, dtype=bool)
+    u = np.zeros((row_offsets[-1], 0), dtype=complex)
+    vt = np.zeros((0, column_offsets[-1]), dtype=complex)
+    squared_norm = 0
+    i = 0
+    while not used_rows.all() and not used_columns.all():
+        used_rows[i] = True
+        rows = slice(row_offsets[i], row_offsets[i + 1])
+        residual_rows = particle_rows(i) - u[rows].dot(vt)
+        magnitudes = abs(residual_rows).max(axis=0)
+        magnitudes[used_columns[column_particles]] = -1
+        if magnitudes.max() <= 0:  # residual rows vanish, try the next particle
+            i = np.nonzero(~used_rows)[0][0] if not used_rows.all() else i
+            continue
+        j = column_particles[np.argmax(magnitudes)]
+        used_columns[j] = True
+        columns = slice(column_offsets[j], column_offsets[j + 1])
+        residual_columns = particle_columns(j) - u.dot(vt[:, columns])
+
+        x, s, yh = np.linalg.svd(residual_rows[:, columns], full_matrices=False)
+        rank = np.count_nonzero(s > 1e-12 * s[0])
+        new_u = residual_columns.dot(yh[:rank].conj().T / s[:rank])
+        new_vt = x[:, :rank].conj().T.dot(residual_rows)
+
+        increment = np.sum(new_u.conj().T.dot(new_u) * new_vt.dot(new_vt.conj().T).T).real
+        squared_norm += increment + 2 * np.sum(u.conj().T.dot(new_u) * new_vt.dot(vt.conj().T).T).real
+        u = np.hstack([u, new_u])
+        vt = np.vstack([vt, new_vt])
+        if increment <= tolerance**2 * squared_norm:
+            break
+
+        # next pivot: the particle with the largest entry in the new columns
+        magnitudes = abs(new_u).max(axis=1)
+        magnitudes[used_rows[row_particles]] = -1
+        if magnitudes.max() < 0:
+            break
+        i = row_particles[np.argmax(magnitudes)]
+    return recompress(u, vt, tolerance)
+
+
+class HierarchicalMatrix:
+    """Coupling matrix in HODLR format, see module docstring. The matrix acts on system vectors in the usual particle
+    order, internally the rows and columns are permuted to the order of the cluster tree.
+
+    Args:
+        particle_list (list):   List of smuthi.particles.Particle objects
+        submatrix (function):   submatrix(receiving, emitting) returns the coupling matrix between two arrays of
+                                particle numbers as numpy.ndarray (rows of the receiving, columns of the emitting
+                                particles)
+        tolerance (float):      Relative accuracy of the ACA of the off-diagonal blocks
+        leaf_size (int):        Maximal number of particles per leaf cluster
+
+    Attributes:
+        order (numpy.ndarray):          Particle numbers in tree order
+        permutation (numpy.ndarray):    System vector indices in tree order
+        t_blocks (list or None):        T-matrices in tree order if the object represents the master matrix 1 - TW
+    """
+    def __init__(self, particle_list, submatrix, tolerance=1e-4, leaf_size=16):
+        self.submatrix = submatrix
+        self.tolerance = tolerance
+        self.t_blocks = None
+        positions = part.particle_positions(particle_list)
+        self.root, self.order = cluster_tree(positions, leaf_size)
+
+        blocksizes = np.array([fldex.blocksize(particle.l_max, particle.m_max) for particle in particle_list],
+                              dtype=int)
+        system_offsets = np.concatenate([[0], np.cumsum(blocksizes)])
+        self.permutation = np.concatenate([np.arange(system_offsets[i], system_offsets[i + 1]) for i in self.order])
+        self.row_offsets = np.concatenate([[0], np.cumsum(blocksizes[self.order])])
+        self.shape = (self.row_offsets[-1], self.row_offsets[-1])
+
+        for node in tqdm(self.nodes(), desc='Hierarchical matrix       ', file=sys.stdout,
+                         bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            particles = self.order[node.particle_start:node.particle_end]
+            if not node.children:
+                node.dense = submatrix(particles, particles)
+            else:
+                node.u12, node.vt12 = self.compress(node.children[0], node.children[1])
+                node.u21, node.vt21 = self.compress(node.children[1], node.children[0])
+
+    def nodes(self):
+        """List of all nodes of the cluster tree (preorder)."""
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.children[::-1])
+        return nodes
+
+    def row_range(self, node):
+        """Rows of a cluster in tree order."""
+        return slice(self.row_offsets[node.particle_start], self.row_offsets[node.particle_end])
+
+    def compress(self, receiving_node, emitting_node):
+        """Compress the coupling matrix block between two clusters by adaptive cross approximation.
+
+        Args:
+            receiving_node (ClusterNode):   Cluster of the receiving particles
+            emitting_node (ClusterNode):    Cluster of the emitting particles
+
+        Returns:
+            Tuple (u, vt) of the low-rank factors
+        """
+        receiving = self.order[receiving_node.particle_start:receiving_node.particle_end]
+        emitting = self.order[emitting_node.particle_start:emitting_node.particle_end]
+        row_offsets = (self.row_offsets[receiving_node.particle_start:receiving_node.particle_end + 1]
+                       - self.row_offsets[receiving_node.particle_start])
+        column_offsets = (self.row_offsets[emitting_node.particle_start:emitting_node.particle_end + 1]
+                          - self.row_offsets[emitting_node.particle_start])
+        return adaptive_cross_approximation(lambda i: self.submatrix(receiving[i:i + 1], emitting),
+                                            lambda j: self.submatrix(receiving, emitting[j:j + 1]),
+                                            row_offsets, column_offsets, self.tolerance)
+
+    def apply_t_matrices(self, node, block):
+        """Multiply the rows of a cluster with the T-matrices of its particles.
+
+        Args:
+            node (ClusterNode):     Cluster
+            block (numpy.ndarray):  Array with the rows of the cluster
+
+        Returns:
+            T-matrix times block
+        """
+        result = np.zeros(block.shape, dtype=complex)
+        offset = self.row_offsets[node.particle_start]
+        for p in range(node.particle_start, node.particle_end):
+            rows = slice(self.row_offsets[p] - offset, self.row_offsets[p + 1] - offset)
+            result[rows] = self.t_blocks[p].dot(block[rows])
+        return result
+
+    def master_matrix(self, t_matrices):
+        """Master matrix :math:`M = 1 - TW` in HODLR format with the same cluster tree and ranks, where W is the matrix
+        represented by this object.
+
+        Args:
+            t_matrices (list):  T-matrices of the particles (in the usual particle order)
+
+        Returns:
+            HierarchicalMatrix object
+        """
+        master = copy.copy(self)
+        master.factorized = False
+        master.t_blocks = [t_matrices[i] for i in self.order]
+
+        def transform(node):
+            new_node = ClusterNode(node.particle_start, node.particle_end)
+            if not node.children:
+                new_node.dense = np.eye(len(node.dense), dtype=complex) - master.apply_t_matrices(node, node.dense)
+            else:
+                new_node.children = [transform(child) for child in node.children]
+                new_node.u12 = - master.apply_t_matrices(node.children[0], node.u12)
+                new_node.u21 = - master.apply_t_matrices(node.children[1], node.u21)
+                new_node.vt12, new_node.vt21 = node.vt12, node.vt21
+            return new_node
+
+        master.root = transform(self.root)
+        return master
+
+    def matvec(self, vector):
+        """Multiply the hierarchical matrix to a system vector or to an array of system vectors.
+
+        Args:
+            vector (numpy.ndarray): System vector, or array of shape [number of unknowns, number of vectors]
+
+        Returns:
+            Product of the same shape as vector
+        """
+        vector = np.asarray(vector)
+        result = np.zeros(vector.shape, dtype=complex)
+        result[self.permutation] = self.apply_node(self.root, vector[self.permutation])
+        return result
+
+    def apply_node(self, node, block):
+        """Multiply the block of a cluster to an array with the rows of the cluster (in tree order)."""
+        if not node.children:
+            return node.dense.dot(block)
+        n1 = len(node.u12)
+        result = np.zeros(block.shape, dtype=complex)
+        result[:n1] = self.apply_node(node.children[0], block[:n1]) + node.u12.dot(node.vt12.dot(block[n1:]))
+        result[n1:] = self.apply_node(node.children[1], block[n1:]) + node.u21.dot(node.vt21.dot(block[:n1]))
+        return result
+
+    def factorize(self):
+        """Recursive factorization: leaf blocks are LU factorized and for each cluster with children
+        :math:`M = \\mathrm{diag}(M_1, M_2)(1 + \\tilde{U} \\tilde{V}^H)`, where the inverse of the second factor is
+        computed with the Sherman-Morrison-Woodbury formula from the LU factorization of a small matrix of the size of
+        the sum of the off-diagonal ranks."""
+        for node in tqdm(self.nodes()[::-1], desc='Hierarchical factorization', file=sys.stdout,
+                         bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            if not node.children:
+                node.lu_piv = scipy.linalg.lu_factor(node.dense)
+            else:
+                node.w12 = self.solve_node(node.children[0], node.u12)
+                node.w21 = self.solve_node(node.children[1], node.u21)
+                k1, k2 = node.vt12.shape[0], node.vt21.shape[0]
+                if k1 + k2 > 0:
+                    capacitance = np.eye(k1 + k2, dtype=complex)
+                    capacitance[:k1, k1:] = node.vt12.dot(node.w21)
+                    capacitance[k1:, :k1] = node.vt21.dot(node.w12)
+                    node.lu_piv = scipy.linalg.lu_factor(capacitance)
+                else:
+                    node.lu_piv = None
+        self.factorized = True
+
+    def solve_node(self, node, block):
+        """Apply the inverse of the factorized block of a cluster to an array with the rows of the cluster."""
+        if not node.children:
+            return scipy.linalg.lu_solve(node.lu_piv, block)
+        n1 = len(node.u12)
+        y1 = self.solve_node(node.children[0], block[:n1])
+        y2 = self.solve_node(node.children[1], block[n1:])
+        if node.lu_piv is None:
+            return np.concatenate([y1, y2])
+        k1 = node.vt12.shape[0]
+        w = scipy.linalg.lu_solve(node.lu_piv, np.concatenate([node.vt12.dot(y2), node.vt21.dot(y1)]))
+        return np.concatenate([y1 - node.w12.dot(w[:k1]), y2 - node.w21.dot(w[k1:])])
+
+    def solve(self, rhs):
+        """Solve the linear system with the hierarchical matrix. The matrix is factorized with the first call.
+
+        Args:
+            rhs (numpy.ndarray):    Right hand side, a system vector or an array of shape [number of unknowns, number
+                                    of right hand sides]
+
+        Returns:
+            Solution of the same shape as rhs
+        """
+        if not getattr(self, 'factorized', False):
+            self.factorize()
+        rhs = np.asarray(rhs)
+        solution = np.zeros(rhs.shape, dtype=complex)
+        solution[self.permutation] = self.solve_node(self.root, rhs[self.permutation].astype(complex))
+        return solution
+
+    def compression_ratio(self):
+        """Number of stored matrix entries relative to the dense matrix."""
+        stored = 0
+        for node in self.nodes():
+            if not node.children:
+                stored += node.dense.size
+            else:
+                stored += node.u12.size + node.vt12.size + node.u21.size + node.vt21.size
+        return stored / float(self.shape[0] * self.shape[1])
+
+    def particle_rows(self, p):
+        """Rows of the hierarchical matrix that belong to one particle.
+
+        Args:
+            p (int):    Position of the particle in tree order
+
+        Returns:
+            Array of shape [blocksize, number of unknowns] with the columns in tree order
+        """
+        rows = np.zeros((self.row_offsets[p + 1] - self.row_offsets[p], self.shape[1]), dtype=complex)
+        node = self.root
+        while node.children:
+            child1, child2 = node.children
+            local_rows = slice(self.row_offsets[p] - self.row_offsets[node.particle_start],
+                               self.row_offsets[p + 1] - self.row_offsets[node.particle_start])
+            if p < child1.particle_end:
+                rows[:, self.row_range(child2)] = node.u12[local_rows].dot(node.vt12)
+                node = child1
+            else:
+                local_rows = slice(local_rows.start - len(node.u12), local_rows.stop - len(node.u12))
+                rows[:, self.row_range(child1)] = node.u21[local_rows].dot(node.vt21)
+                node = child2
+        local_rows = slice(self.row_offsets[p] - self.row_offsets[node.particle_start],
+                           self.row_offsets[p + 1] - self.row_offsets[node.particle_start])
+        rows[:, self.row_range(node)] = node.dense[local_rows]
+        return rows
+
+    def exact_particle_rows(self, p):
+        """Rows of the uncompressed matrix that belong to one particle, see particle_rows."""
+        rows = self.submatrix(self.order[p:p + 1], self.order)
+        if self.t_blocks is not None:
+            identity_rows = np.zeros(rows.shape, dtype=complex)
+            identity_rows[np.arange(len(rows)), self.row_offsets[p] + np.arange(len(rows))] = 1
+            rows = identity_rows - self.t_blocks[p].dot(rows)
+        return rows
+
+    def relative_error_estimate(self, number_samples=10):
+        """Estimate the relative error of the compressed matrix in the Frobenius norm by comparison of the rows of a
+        random sample of particles with the uncompressed rows.
+
+        Args:
+            number_samples (int):   Number of sampled particles
+
+        Returns:
+            Estimated relative error (float)
+        """
+        samples = np.random.RandomState(0).choice(len(self.order), min(number_samples, len(self.order)),
+                                                  replace=False)
+        error = 0
+        norm = 0
+        for p in samples:
+            exact_rows = self.exact_particle_rows(p)
+            error += np.linalg.norm(self.particle_rows(p) - exact_rows)**2
+            norm += np.linalg.norm(exact_rows)**2
+        return np.sqrt(error / norm)
+
+    def report(self, number_samples=10):
+        """Write compression ratio and estimated relative error to the log."""
+        sys.stdout.write('Hierarchical matrix compression ratio: %.3f | estimated relative error: %.2e\n'
+                         % (self.compression_ratio(), self.relative_error_estimate(number_samples)))
+        sys.stdout.flush()
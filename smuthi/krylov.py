@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Iterative solvers for the linear system with several right hand sides or for sequences of similar linear systems."""
+
+import sys
+import time
+import numpy as np
+import scipy.linalg
+
+
+def block_gmres(linear_operator, rhs, x0=None, tol=1e-4, restart=20, maxiter=100, callback=None):
+    """Solve a linear system for several right hand sides with the restarted block GMRES method. In each iteration,
+    the linear operator is applied to a block of vectors, such that the cost of the operator evaluation (e.g., the
+    interpolation of a coupling lookup table) is shared by all right hand sides.
+
+    Args:
+        linear_operator (scipy.sparse.linalg.LinearOperator):   system matrix, should support matmat
+        rhs (numpy.ndarray):        right hand sides in the format [number of unknowns, number of right hand sides]
+        x0 (numpy.ndarray or None): initial guess in the same format as rhs. If None, start from zero
+        tol (float):                relative tolerance for the residual norm of each right hand side
+        restart (int):              number of block iterations between restarts
+        maxiter (int):              maximal number of restarts
+        callback (function):        called after each block iteration with the array of relative residual norms
+
+    Returns:
+        Tuple (x, info) where x is the solution in the same format as rhs and info is 0 if all right hand sides
+        converged or the number of block iterations otherwise
+    """
+    n, p = rhs.shape
+    rhs_norm = np.linalg.norm(rhs, axis=0)
+    rhs_norm[rhs_norm == 0] = 1
+    if x0 is None:
+        x = np.zeros((n, p), dtype=complex)
+    else:
+        x = np.array(x0, dtype=complex).reshape(n, p)
+
+    iteration = 0
+    for _ in range(maxiter):
+        residual = rhs - linear_operator.matmat(x)
+        if np.all(np.linalg.norm(residual, axis=0) / rhs_norm < tol):
+            return x, 0
+        v0, s = scipy.linalg.qr(residual, mode='economic')
+        basis = [v0]
+        hessenberg = np.zeros(((restart + 1) * p, restart * p), dtype=complex)
+        for j in range(restart):
+            w = np.asarray(linear_operator.matmat(basis[j]), dtype=complex)
+            for i in range(j + 1):  # block modified Gram-Schmidt
+                h = basis[i].conj().T.dot(w)
+                w = w - basis[i].dot(h)
+                hessenberg[i * p:(i + 1) * p, j * p:(j + 1) * p] = h
+            v, h = scipy.linalg.qr(w, mode='economic')
+            hessenberg[(j + 1) * p:(j + 2) * p, j * p:(j + 1) * p] = h
+            basis.append(v)
+
+            # minimize the residual in the block Krylov space
+            e1s = np.zeros(((j + 2) * p, p), dtype=complex)
+            e1s[:p, :] = s
+            h = hessenberg[:(j + 2) * p, :(j + 1) * p]
+            y = np.linalg.lstsq(h, e1s, rcond=None)[0]
+            relative_residual = np.linalg.norm(e1s - h.dot(y), axis=0) / rhs_norm
+            iteration += 1
+            if callback is not None:
+                callback(relative_residual)
+            if np.all(relative_residual < tol):
+                break
+        x = x + np.hstack(basis[:j + 1]).dot(y)
+
+    residual = rhs - linear_operator.matmat(x)
+    if np.all(np.linalg.norm(residual, axis=0) / rhs_norm < tol):
+        return x, 0
+    return x, iteration
+
+
+def gcro_dr(linear_operator, rhs, x0=None, tol=1e-4, restart=40, recycle_dimension=10, recycle_space=None,
+            maxiter=100, callback=None):
+    """Solve a linear system with the GCRO-DR method (GMRES with deflated restarting and Krylov subspace recycling,
+    see Parks et al., SIAM J. Sci. Comput. 28, 2006). The recycle space is updated with harmonic Ritz vectors at each
+    restart and can be passed on to the solution of a similar linear system, e.g. the next step of a wavelength sweep.
+
+    Args:
+        linear_operator (scipy.sparse.linalg.LinearOperator):   system matrix
+        rhs (numpy.ndarray):                right hand side
+        x0 (numpy.ndarray or None):         initial guess. If None, start from zero
+        tol (float):                        relative tolerance for the residual norm
+        restart (int):                      dimension of the search space per cycle, including the recycle space
+        recycle_dimension (int):            number of vectors in the recycle space
+        recycle_space (numpy.ndarray or None):  recycle space from the solution of a previous linear system, in the
+                                                format [number of unknowns, number of vectors]
+        maxiter (int):                      maximal number of cycles
+        callback (function):                called after each iteration with the relative residual norm
+
+    Returns:
+        Tuple (x, info, recycle_space, iterations) where info is 0 if the solver converged and 1 otherwise, and
+        iterations is the number of applications of the linear operator
+    """
+    n = len(rhs)
+    rhs_norm = np.linalg.norm(rhs)
+    if rhs_norm == 0:
+        rhs_norm = 1
+    if x0 is None:
+        x = np.zeros(n, dtype=complex)
+    else:
+        x = np.array(x0, dtype=complex).ravel()
+    residual = rhs - linear_operator.matvec(x).ravel()
+    iterations = 1
+
+    c = None
+    u = None
+    if recycle_space is not None and recycle_space.shape[1] > 0:
+        c, r = scipy.linalg.qr(np.asarray(linear_operator.matmat(recycle_space), dtype=complex), mode='economic')
+        iterations += recycle_space.shape[1]
+        if np.abs(np.diag(r)).min() > 1e-12 * np.abs(np.diag(r)).max():
+            u = scipy.linalg.solve_triangular(r.T, recycle_space.T, lower=True).T
+            x = x + u.dot(c.conj().T.dot(residual))
+            residual = residual - c.dot(c.conj().T.dot(residual))
+        else:  # recycle space is rank deficient
+            c = None
+
+    for _ in range(maxiter):
+        residual_norm = np.linalg.norm(residual)
+        if residual_norm / rhs_norm < tol:
+            return x, 0, u, iterations
+
+        k = 0 if c is None else c.shape[1]
+        m = max(restart - k, 1)
+        v = np.zeros((n, m + 1), dtype=complex)
+        h = np.zeros((m + 1, m), dtype=complex)
+        b = np.zeros((k, m), dtype=complex)
+        v[:, 0] = residual / residual_norm
+        if k > 0:
+            d = 1 / np.linalg.norm(u, axis=0)
+        breakdown = False
+        for j in range(m):
+            w = linear_operator.matvec(v[:, j]).ravel()
+            iterations += 1
+            if k > 0:
+                b[:, j] = c.conj().T.dot(w)
+                w = w - c.dot(b[:, j])
+            for i in range(j + 1):
+                h[i, j] = np.vdot(v[:, i], w)
+                w = w - h[i, j] * v[:, i]
+            h[j + 1, j] = np.linalg.norm(w)
+            if h[j + 1, j] <= 1e-14 * np.abs(h[:j + 1, j]).max():
+                breakdown = True
+            else:
+                v[:, j + 1] = w / h[j + 1, j]
+
+            # least squares problem for A [U D, V_j] = [C, V_j+1] G
+            g = np.zeros((k + j + 2, k + j + 1), dtype=complex)
+            if k > 0:
+                g[:k, :k] = np.diag(d)
+                g[:k, k:] = b[:, :j + 1]
+            g[k:, k:] = h[:j + 2, :j + 1]
+            e1 = np.zeros(k + j + 2, dtype=complex)
+            e1[k] = residual_norm
+            y = np.linalg.lstsq(g, e1, rcond=None)[0]
+            relative_residual = np.linalg.norm(e1 - g.dot(y)) / rhs_norm
+            if callback is not None:
+                callback(relative_residual)
+            if breakdown or relative_residual < tol:
+                break
+
+        j_end = j + 1
+        if k > 0:
+            v_hat = np.hstack([u * d[None, :], v[:, :j_end]])
+            w_hat = np.hstack([c, v[:, :j_end + 1]])
+        else:
+            v_hat = v[:, :j_end]
+            w_hat = v[:, :j_end + 1]
+        x = x + v_hat.dot(y)
+        residual = residual - w_hat.dot(g.dot(y))
+        if breakdown:
+            residual = rhs - linear_operator.matvec(x).ravel()
+            iterations += 1
+            continue
+
+        # update the recycle space with the harmonic Ritz vectors of the smallest harmonic Ritz values
+        number_ritz = min(recycle_dimension, k + j_end - 1)
+        if number_ritz < 1:
+            continue
+        theta, p = scipy.linalg.eig(g.conj().T.dot(g), g.conj().T.dot(w_hat.conj().T.dot(v_hat)))
+        theta[~np.isfinite(theta)] = np.inf
+        p = p[:, np.argsort(np.abs(theta))[:number_ritz]]
+        q, r = scipy.linalg.qr(g.dot(p), mode='economic')
+        if np.abs(np.diag(r)).min() <= 1e-12 * np.abs(np.diag(r)).max():
+            continue
+        c = w_hat.dot(q)
+        u = scipy.linalg.solve_triangular(r.T, v_hat.dot(p).T, lower=True).T
+
+    residual_norm = np.linalg.norm(rhs - linear_operator.matvec(x).ravel())
+    return x, int(residual_norm / rhs_norm >= tol), u, iterations
+
+
+class KrylovRecycler:
+    """Solver state that is carried through a sequence of similar linear systems, e.g. the steps of a wavelength sweep
+    or of a sweep over slightly displaced particles. Each system is solved with GCRO-DR, starting from the recycle space
+    of the previous step and from a warm start guess that is extrapolated from the previous solutions.
+
+    Pass the same object to the LinearSystem (or Simulation) of each sweep step.
+
+    Args:
+        recycle_dimension (int):    number of vectors in the recycle space
+        restart (int):              dimension of the search space per GCRO-DR cycle, including the recycle space
+        maxiter (int):              maximal number of GCRO-DR cycles per linear system
+    """
+    def __init__(self, recycle_dimension=10, restart=40, maxiter=100):
+        self.recycle_dimension = recycle_dimension
+        self.restart = restart
+        self.maxiter = maxiter
+        self.recycle_space = None
+        self.previous_solutions = []
+        self.step_statistics = []
+
+    def initial_guesses(self, rhs, parameter=None):
+        """Candidates for the initial guess of the next linear system.
+
+        Args:
+            rhs (numpy.ndarray):        right hand side of the next linear system
+            parameter (float or None):  sweep parameter (e.g. the vacuum wavelength) of the next linear system
+
+        Returns:
+            List of candidate vectors: the right hand side, the previous solution and, if two previous solutions with
+            different sweep parameters are available, their linear extrapolation to the new sweep parameter
+        """
+        guesses = [rhs]
+        solutions = [(p, x) for p, x in self.previous_solutions if len(x) == len(rhs)]
+        if solutions:
+            guesses.append(solutions[-1][1])
+        if len(solutions) == 2 and parameter is not None and None not in (solutions[0][0], solutions[1][0]):
+            (p1, x1), (p2, x2) = solutions
+            if p1 != p2:
+                guesses.append(x2 + (x2 - x1) * (parameter - p2) / (p2 - p1))
+        return guesses
+
+    def solve(self, linear_operator, rhs, tol=1e-4, parameter=None, callback=None):
+        """Solve the next linear system of the sequence.
+
+        Args:
+            linear_operator (scipy.sparse.linalg.LinearOperator):   system matrix
+            rhs (numpy.ndarray):        right hand side
+            tol (float):                relative tolerance for the residual norm
+            parameter (float or None):  sweep parameter, used to extrapolate the initial guess
+            callback (function):        called after each iteration with the relative residual norm
+
+        Returns:
+            Tuple (x, info) where x is the solution and info is 0 if the solver converged
+        """
+        start_time = time.time()
+        guesses = self.initial_guesses(rhs, parameter)
+        if len(guesses) > 1:
+            residual_norms = [np.linalg.norm(rhs - linear_operator.matvec(guess).ravel()) for guess in guesses]
+            x0 = guesses[int(np.argmin(residual_norms))]
+        else:
+            x0 = guesses[0]
+
+        recycle_space = self.recycle_space
+        if recycle_space is not None and recycle_space.shape[0] != len(rhs):
+            recycle_space = None
+        x, info, recycle_space, iterations = gcro_dr(linear_operator, rhs, x0=x0, tol=tol, restart=self.restart,
+                                                     recycle_dimension=self.recycle_dimension,
+                                                     recycle_space=recycle_space, maxiter=self.maxiter,
+                                                     callback=callback)
+        iterations += len(guesses) - 1
+        if recycle_space is not None:
+            self.recycle_space = recycle_space
+        self.previous_solutions = (self.previous_solutions + [(parameter, x)])[-2:]
+
+        elapsed = time.time() - start_time
+        if self.step_statistics:
+            reference_iterations = self.step_statistics[0]['iterations']
+        else:
+            reference_iterations = iterations
+        time_saved = max(reference_iterations - iterations, 0) * elapsed / max(iterations, 1)
+        self.step_statistics.append({'parameter': parameter, 'iterations': iterations, 'time': elapsed,
+                                     'estimated_time_saved': time_saved})
+        sys.stdout.write('\nKrylov recycling step %i: %i operator applications (first step: %i), elapsed: %is, '
+                         'estimated time saved: %is\n' % (len(self.step_statistics), iterations, reference_iterations,
+                                                          elapsed, time_saved))
+        sys.stdout.flush()
+        return x, info
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Coupling of particles on finite regular lattices.
+
+If identical particles (i.e., particles with the same multipole cutoffs) at the same height occupy sites of a
+two-dimensional lattice, the coupling block between two particles only depends on the difference of their lattice
+indices. The coupling matrix is then block-Toeplitz (with Toeplitz blocks), such that only one coupling block per
+lattice displacement needs to be computed and the matrix-vector product can be evaluated by 2-D FFT, see
+smuthi.linear_system.CouplingMatrixLattice.
+"""
+
+import smuthi.particle_coupling as coup
+import smuthi.field_expansion as fldex
+import smuthi.particles as part
+import numpy as np
+import scipy.spatial
+import sys
+from tqdm import tqdm
+
+
+class Lattice:
+    """Finite two-dimensional lattice with sites r = origin + i * a1 + j * a2 for integer lattice indices (i, j), e.g.
+    a rectangular or hexagonal particle array. Not all sites need to be occupied.
+
+    Args:
+        origin (list):              Position of the lattice site (0, 0) in the format [x, y] or [x, y, z]
+        lattice_vectors (list):     In-plane lattice vectors in the format [[a1_x, a1_y], [a2_x, a2_y]]
+    """
+    def __init__(self, origin, lattice_vectors):
+        self.origin = np.asarray(origin, dtype=float)[:2]
+        self.lattice_vectors = np.asarray(lattice_vectors, dtype=float).reshape(2, 2)
+        if abs(np.linalg.det(self.lattice_vectors)) == 0:
+            raise ValueError('The lattice vectors must be linearly independent.')
+
+    def site_positions(self, indices):
+        """In-plane positions of lattice sites.
+
+        Args:
+            indices (numpy.ndarray):    Integer lattice indices in the format [number of sites, 2]
+
+        Returns:
+            Positions as numpy.ndarray in the format [number of sites, 2]
+        """
+        return self.origin + np.asarray(indices).reshape(-1, 2).dot(self.lattice_vectors)
+
+    def indices(self, particle_list, tolerance=1e-6):
+        """Lattice indices of the sites occupied by the particles.
+
+        Args:
+            particle_list (list):   List of smuthi.particles.Particle objects
+            tolerance (float):      Tolerated deviation from the lattice sites, relative to the shortest lattice vector
+
+        Returns:
+            Integer array in the format [number of particles, 2]
+        """
+        positions = part.particle_positions(particle_list)[:, :2]
+        coefficients = np.linalg.solve(self.lattice_vectors.T, (positions - self.origin).T).T
+        indices = np.round(coefficients).astype(int)
+        deviation = np.linalg.norm(self.site_positions(indices) - positions, axis=1)
+        if deviation.size and deviation.max() > tolerance * np.linalg.norm(self.lattice_vectors, axis=1).min():
+            raise ValueError('Particles are not located on the lattice sites.')
+        return indices
+
+
+def detect_lattice(particle_list, tolerance=1e-6):
+    """Detect whether the particles occupy the sites of a two-dimensional lattice. The lattice vectors are chosen as
+    the shortest displacement between neighboring particles and the shortest displacement that is not parallel to the
+    first one (which form a reduced basis of the lattice).
+
+    Args:
+        particle_list (list):   List of smuthi.particles.Particle objects
+        tolerance (float):      Tolerated deviation from the lattice sites, relative to the shortest lattice vector
+
+    Returns:
+        Lattice object, or None if the particles are not at the same height or not on a lattice
+    """
+    if len(particle_list) < 2:
+        return None
+    positions = part.particle_positions(particle_list)
+    if np.ptp(positions[:, 2]) > 0:
+        return None
+
+    in_plane_positions = positions[:, :2]
+    _, neighbors = scipy.spatial.cKDTree(in_plane_positions).query(in_plane_positions, k=min(7, len(particle_list)))
+    displacements = (in_plane_positions[neighbors[:, 1:]] - in_plane_positions[:, None, :]).reshape(-1, 2)
+    lengths = np.linalg.norm(displacements, axis=1)
+    if lengths.min() == 0:
+        return None
+    a1 = displacements[np.argmin(lengths)]
+    cross_products = np.abs(a1[0] * displacements[:, 1] - a1[1] * displacements[:, 0])
+    non_parallel = cross_products > 1e-3 * np.linalg.norm(a1) * lengths
+    if non_parallel.any():
+        a2 = displacements[non_parallel][np.argmin(lengths[non_parallel])]
+    else:  # particles on a line
+        a2 = np.array([-a1[1], a1[0]])
+
+    lattice = Lattice(origin=in_plane_positions[0], lattice_vectors=[a1, a2])
+    try:
+        lattice.indices(particle_list, tolerance)
+    except ValueError:
+        return None
+    return lattice
+
+
+def displacement_blocks(vacuum_wavelength, particle, lattice, lattice_shape, layer_system, k_parallel='default'):
+    """Coupling blocks (direct plus layer mediated) for all displacements between the sites of a lattice patch,
+    arranged for the circular convolution on the doubled lattice: the block for the displacement (di, dj) of the
+    receiving relative to the emitting particle is stored at [di mod 2 * Ni, dj mod 2 * Nj].
+
+    Args:
+        vacuum_wavelength (float):  Vacuum wavelength in length units
+        particle (smuthi.particles.Particle):   Particle that defines the height and the multipole cutoffs
+        lattice (Lattice):          Lattice of the particle positions
+        lattice_shape (tuple):      Number of lattice sites (Ni, Nj) of the patch along the two lattice vectors
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium
+        k_parallel (numpy.ndarray or str):  In-plane wavenumber. If 'default', use smuthi.coordinates.default_k_parallel
+
+    Returns:
+        Complex numpy.ndarray with indices [di, dj, n1, n2] of shape (2 * Ni, 2 * Nj, blocksize, blocksize)
+    """
+    padded_shape = (2 * lattice_shape[0], 2 * lattice_shape[1])
+    offsets_i = np.arange(padded_shape[0])
+    offsets_i[offsets_i >= lattice_shape[0]] -= padded_shape[0]
+    offsets_j = np.arange(padded_shape[1])
+    offsets_j[offsets_j >= lattice_shape[1]] -= padded_shape[1]
+
+    # displacements that occur within the patch (the offsets -Ni and -Nj are never needed)
+    sites = [(i, j) for i in range(padded_shape[0]) for j in range(padded_shape[1])
+             if not offsets_i[i] == -lattice_shape[0] and not offsets_j[j] == -lattice_shape[1]]
+    displacements = lattice.site_positions([(offsets_i[i], offsets_j[j]) for i, j in sites]) - lattice.origin
+
+    emitting_particle = part.Particle(position=list(particle.position), l_max=particle.l_max, m_max=particle.m_max)
+    receiving_particles = []
+    for displacement in displacements:
+        if displacement[0] == 0 and displacement[1] == 0:  # same particle: no direct self coupling
+            receiving_particles.append(emitting_particle)
+        else:
+            receiving_particles.append(part.Particle(position=[particle.position[0] + displacement[0],
+                                                               particle.position[1] + displacement[1],
+                                                               particle.position[2]],
+                                                     l_max=particle.l_max, m_max=particle.m_max))
+
+    blocksize = fldex.blocksize(particle.l_max, particle.m_max)
+    blocks = np.zeros(padded_shape + (blocksize, blocksize), dtype=complex)
+    chunksize = max(1, 2**18 // blocksize**2)
+    for start in tqdm(range(0, len(sites), chunksize), desc='Lattice coupling blocks   ', file=sys.stdout,
+                      bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+        chunk_receiving = receiving_particles[start:start + chunksize]
+        chunk_emitting = [emitting_particle for rp in chunk_receiving]
+        wr_blocks = coup.layer_mediated_coupling_block_list(vacuum_wavelength, chunk_receiving, chunk_emitting,
+                                                            layer_system, k_parallel)
+        w_blocks = coup.direct_coupling_block_list(vacuum_wavelength, chunk_receiving, chunk_emitting, layer_system)
+        for (i, j), wr, w in zip(sites[start:start + chunksize], wr_blocks, w_blocks):
+            blocks[i, j] = wr + w
+    return blocks
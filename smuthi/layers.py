@@ -6,6 +6,7 @@ import mpmath
 import smuthi.memoizing as memo
 import smuthi.field_expansion as fldex
 import smuthi.coordinates as coord
+import smuthi.disk_cache as dc
 
 
 # global variables
@@ -228,10 +229,14 @@ def interface_transition_matrix(pol, kz1, kz2, n1, n2):
         n2 (float or complex):  second medium's complex refractive index (n+ik)
 
     Returns:
-        Interface transition matrix as 2x2 numpy array or as 2x2 mpmath.matrix
+        Interface transition matrix as 2x2 numpy array or as 2x2 mpmath.matrix. If kz1 and kz2 are arrays of length N,
+        a 2x2xN numpy array is returned.
     """
     t = fresnel_t(pol, kz1, kz2, n1, n2)
     r = fresnel_r(pol, kz1, kz2, n1, n2)
+    if isinstance(r, np.ndarray):
+        one = np.ones_like(r)
+        return 1 / t * np.array([[one, r], [r, one]])
     return 1 / t * matrix_format([[1, r], [r, 1]])
 
 
@@ -239,35 +244,73 @@ def layer_propagation_matrix(kz, d):
     """Layer propagation matrix to be used in the Transfer matrix algorithm.
 
     Args:
-        kz (float or complex):  z-wavenumber (k*cos(alpha))
-        d  (float):             thickness of layer
+        kz (float, complex or array):   z-wavenumber (k*cos(alpha))
+        d  (float):                     thickness of layer
 
     Returns:
-        Layer propagation matrix as 2x2 numpy array or as 2x2 mpmath.matrix
+        Layer propagation matrix as 2x2 numpy array or as 2x2 mpmath.matrix. If kz is an array of length N, a 2x2xN
+        numpy array is returned.
     """
+    if isinstance(kz, np.ndarray):
+        zero = np.zeros_like(kz)
+        return np.array([[np.exp(-1j * kz * d), zero], [zero, np.exp(1j * kz * d)]])
     return matrix_format([[math_module.exp(-1j * kz * d), 0], [0, math_module.exp(1j * kz * d)]])
 
 
-def layersystem_transfer_matrix(pol, layer_d, layer_n, kpar, omega):
-    """Transfer matrix of a planarly layered medium.
+def layer_z_wavenumbers(layer_n, kpar, omega):
+    """z-components of the wave vectors in each layer, with the branch chosen such that the imaginary part is
+    non-negative.
 
     Args:
-        pol (int):      polarization(0=TE, 1=TM)
-        layer_d (list): layer thicknesses
-        layer_n (list): complex layer refractive indices
-        kpar (float):   in-plane wavenumber
-        omega (float):  angular frequency in units of c=1: omega=2*pi/lambda
+        layer_n (list):         complex layer refractive indices
+        kpar (float or array):  in-plane wavenumber
+        omega (float):          angular frequency in units of c=1: omega=2*pi/lambda
 
     Returns:
-        Transfer matrix as 2x2 numpy array or as 2x2 mpmath.matrix
+        List of z-wavenumbers (one float, complex or array per layer)
     """
     layer_kz = []
     for n in layer_n:
         kz = math_module.sqrt((omega * n) ** 2 - kpar ** 2 + 0j)
-        if kz.imag < 0:
+        if isinstance(kz, np.ndarray):
+            kz = np.where(kz.imag < 0, -kz, kz)
+        elif kz.imag < 0:
             kz = -kz
         layer_kz.append(kz)
-    tmat = math_module.eye(2)
+    return layer_kz
+
+
+def identity_matrix(kz):
+    """2x2 identity matrix in the format used for the layer system matrices.
+
+    Args:
+        kz (float, complex or array):   z-wavenumber. If an array of length N is given, a 2x2xN stack of identity
+                                        matrices is returned.
+
+    Returns:
+        Identity matrix as 2x2 numpy array, 2x2 mpmath.matrix or 2x2xN numpy array
+    """
+    if isinstance(kz, np.ndarray):
+        return np.repeat(np.eye(2, dtype=complex)[:, :, np.newaxis], len(kz), axis=2)
+    return math_module.eye(2)
+
+
+def layersystem_transfer_matrix(pol, layer_d, layer_n, kpar, omega):
+    """Transfer matrix of a planarly layered medium.
+
+    Args:
+        pol (int):      polarization(0=TE, 1=TM)
+        layer_d (list): layer thicknesses
+        layer_n (list): complex layer refractive indices
+        kpar (float or array):  in-plane wavenumber. Arrays are only supported with standard numpy precision.
+        omega (float):          angular frequency in units of c=1: omega=2*pi/lambda
+
+    Returns:
+        Transfer matrix as 2x2 numpy array or as 2x2 mpmath.matrix. If kpar is an array of length N, a 2x2xN numpy
+        array is returned.
+    """
+    layer_kz = layer_z_wavenumbers(layer_n, kpar, omega)
+    tmat = identity_matrix(layer_kz[0])
     for i in range(len(layer_d) - 1):
         dmat = interface_transition_matrix(pol, layer_kz[i], layer_kz[i + 1], layer_n[i], layer_n[i + 1])
         pmat = layer_propagation_matrix(layer_kz[i], layer_d[i])
@@ -282,19 +325,15 @@ def layersystem_scattering_matrix(pol, layer_d, layer_n, kpar, omega):
         pol (int):      polarization(0=TE, 1=TM)
         layer_d (list): layer thicknesses
         layer_n (list): complex layer refractive indices
-        kpar (float):   in-plane wavenumber
-        omega (float):  angular frequency in units of c=1: omega=2*pi/lambda
+        kpar (float or array):  in-plane wavenumber. Arrays are only supported with standard numpy precision.
+        omega (float):          angular frequency in units of c=1: omega=2*pi/lambda
 
     Returns:
-        Scattering matrix as 2x2 numpy array or as 2x2 mpmath.matrix
+        Scattering matrix as 2x2 numpy array or as 2x2 mpmath.matrix. If kpar is an array of length N, a 2x2xN numpy
+        array is returned.
     """
-    layer_kz = []
-    for n in layer_n:
-        kz = math_module.sqrt((omega * n) ** 2 - kpar ** 2 + 0j)
-        if kz.imag < 0:
-            kz = -kz
-        layer_kz.append(kz)
-    smat = math_module.eye(2)
+    layer_kz = layer_z_wavenumbers(layer_n, kpar, omega)
+    smat = identity_matrix(layer_kz[0])
     for i in range(len(layer_d) - 1):
         dmat = interface_transition_matrix(pol, layer_kz[i], layer_kz[i + 1], layer_n[i], layer_n[i + 1])
         pmat = layer_propagation_matrix(layer_kz[i], layer_d[i])
@@ -307,7 +346,7 @@ def layersystem_scattering_matrix(pol, layer_d, layer_n, kpar, omega):
     return smat
 
 
-@memo.Memoize
+@memo.memoize(max_bytes=2**29, max_entries=None)
 def layersystem_response_matrix(pol, layer_d, layer_n, kpar, omega, fromlayer, tolayer, prec=None):
     """Layer system response matrix of a planarly layered medium.
 
@@ -323,6 +362,8 @@ def layersystem_response_matrix(pol, layer_d, layer_n, kpar, omega, fromlayer, t
 
     Returns:
         Layer system response matrix as a 2x2 array if kpar is float, or as 2x2xN array if kpar is array with len = N.
+        If a disk cache directory is set (see smuthi.disk_cache), results for arrays of kpar are stored there and
+        returned as read-only memory maps.
     """
     if not prec == precision:
         set_precision(prec)
@@ -330,11 +371,26 @@ def layersystem_response_matrix(pol, layer_d, layer_n, kpar, omega, fromlayer, t
     if type(kpar) == str and kpar == 'default':
         kpar = coord.default_k_parallel
     
-    if hasattr(kpar, "__len__"):    # is kpar an array? then use recursive call to fill an 2 x 2 x N ndarray
-        result = np.zeros((2, 2, len(kpar)), dtype=complex)
-        for i, kp in enumerate(kpar):
-            result[:, :, i] = layersystem_response_matrix(pol, layer_d, layer_n, kp, omega, fromlayer, tolayer, prec)
-        return result
+    disk_cache_key = None
+    if hasattr(kpar, "__len__"):
+        if precision is None:   # numpy arithmetics: treat all kpar at once with 2 x 2 x N stacks of matrices
+            kpar = np.asarray(kpar)
+            if dc.cache_directory is not None:
+                disk_cache_key = dc.entry_key('layer_response', pol=pol, layer_d=layer_d, layer_n=layer_n, kpar=kpar,
+                                              omega=omega, fromlayer=fromlayer, tolayer=tolayer)
+                entry = dc.load(disk_cache_key)
+                if entry is not None:
+                    return entry['response']
+            one = np.ones(len(kpar), dtype=complex)
+            zero = np.zeros(len(kpar), dtype=complex)
+        else:   # mpmath arithmetics: use recursive call to fill an 2 x 2 x N ndarray
+            result = np.zeros((2, 2, len(kpar)), dtype=complex)
+            for i, kp in enumerate(kpar):
+                result[:, :, i] = layersystem_response_matrix(pol, layer_d, layer_n, kp, omega, fromlayer, tolayer,
+                                                              prec)
+            return result
+    else:
+        one, zero = 1, 0
 
     layer_d_above = [0] + layer_d[fromlayer:]
     layer_n_above = [layer_n[fromlayer]] + layer_n[fromlayer:]
@@ -342,16 +398,20 @@ def layersystem_response_matrix(pol, layer_d, layer_n, kpar, omega, fromlayer, t
     layer_d_below = layer_d[: fromlayer] + [0]
     layer_n_below = layer_n[: fromlayer] + [layer_n[fromlayer]]
     smat_below = layersystem_scattering_matrix(pol, layer_d_below, layer_n_below, kpar, omega)
-    lmat = matrix_product(matrix_inverse(matrix_format([[1, -smat_below[0, 1]], [-smat_above[1, 0], 1]])),
-                          matrix_format([[0, smat_below[0, 1]], [smat_above[1, 0], 0]]))
+    lmat = matrix_product(matrix_inverse(matrix_format([[one, -smat_below[0, 1]], [-smat_above[1, 0], one]])),
+                          matrix_format([[zero, smat_below[0, 1]], [smat_above[1, 0], zero]]))
     if tolayer > fromlayer:
         tmat_fromto = layersystem_transfer_matrix(pol, layer_d[fromlayer:tolayer + 1], layer_n[fromlayer:tolayer + 1],
                                                   kpar, omega)
-        lmat = matrix_product(matrix_inverse(tmat_fromto), lmat + matrix_format([[1, 0], [0, 0]]))
+        lmat = matrix_product(matrix_inverse(tmat_fromto), lmat + matrix_format([[one, zero], [zero, zero]]))
     elif tolayer < fromlayer:
         tmat_fromto = layersystem_transfer_matrix(pol, layer_d[tolayer:fromlayer + 1], layer_n[tolayer:fromlayer + 1],
                                                   kpar, omega)
-        lmat = matrix_product(tmat_fromto, lmat + matrix_format([[0, 0], [0, 1]]))
+        lmat = matrix_product(tmat_fromto, lmat + matrix_format([[zero, zero], [zero, one]]))
+    if isinstance(lmat, np.ndarray):
+        if disk_cache_key is not None:
+            return dc.store(disk_cache_key, response=lmat.astype(complex))['response']
+        return lmat.astype(complex)
     return np.array(lmat.tolist(), dtype=complex)
 
 
@@ -362,12 +422,15 @@ def matrix_product(m1, m2):
         m2 (mpmath.matrix or numpy.ndarray):    second matrix
 
     Returns:
-        matrix product m1 * m2 with same data type as m1 and m2
+        matrix product m1 * m2 with same data type as m1 and m2. Numpy arrays of shape 2x2xN are treated as stacks of N
+        matrices and multiplied point-wise in the last dimension.
     """
     if isinstance(m1, mpmath.matrix) and isinstance(m2, mpmath.matrix):
         return m1 * m2
     elif isinstance(m1, np.ndarray) and isinstance(m2, np.ndarray):
-        return np.dot(m1, m2)
+        if m1.ndim == 2 and m2.ndim == 2:
+            return np.dot(m1, m2)
+        return np.einsum('ij...,jk...->ik...', m1, m2)
 
 
 def matrix_inverse(m):
@@ -376,12 +439,16 @@ def matrix_inverse(m):
         m (mpmath.matrix or numpy.ndarray):    matrix to invert
 
     Returns:
-        inverse of m with same data type as m1 and m2
+        inverse of m with same data type as m1 and m2. Numpy arrays of shape 2x2xN are treated as stacks of N matrices
+        and inverted point-wise in the last dimension.
     """
     if isinstance(m, mpmath.matrix):
         return m ** (-1)
     elif isinstance(m, np.ndarray):
-        return np.linalg.inv(m)
+        if m.ndim == 2:
+            return np.linalg.inv(m)
+        determinant = m[0, 0] * m[1, 1] - m[0, 1] * m[1, 0]
+        return np.array([[m[1, 1], -m[0, 1]], [-m[1, 0], m[0, 0]]]) / determinant
 
 
 def set_precision(prec=None):
@@ -2,7 +2,17 @@ import smuthi.t_matrix as tmt
 import smuthi.particle_coupling as coup
 import smuthi.field_expansion as fldex
 import smuthi.coordinates as coord
+import smuthi.krylov as krylov
+import smuthi.preconditioners as precond
+import smuthi.fmm as fmm
+import smuthi.pfft as pfft
+import smuthi.lattice as latt
+import smuthi.hmatrix as hmat
+import smuthi.memoizing as memo
+import smuthi.particles as part
+import smuthi.out_of_core as ooc
 import smuthi.cuda_sources as cu
+import smuthi.numba_kernels as nk
 import numpy as np
 import sys
 import scipy.linalg
@@ -10,6 +20,7 @@ import scipy.interpolate
 import scipy.sparse.linalg
 from tqdm import tqdm
 import time
+import concurrent.futures
 import warnings
 try:
     import pycuda.autoinit
@@ -21,6 +32,14 @@ except:
     pass
 iter_num = 0
 
+# upper limit for the memory (in bytes) of coupling matrices that are precomputed from a lookup table on the CPU. If the
+# complex64 coupling matrix would need more memory, the lookup is interpolated on the fly in each matrix-vector product.
+default_lookup_memory_budget = 2**30
+
+# number of threads for the assembly of the explicit coupling matrix. The coupling blocks are computed by numpy and
+# numba functions that release the global interpreter lock.
+default_number_of_threads = 1
+
 
 class LinearSystem:
     """Manage the assembly and solution of the linear system of equations.
@@ -30,9 +49,14 @@ class LinearSystem:
         initial_field (smuthi.initial_field.InitialField):   Initial field object
         layer_system (smuthi.layers.LayerSystem):   Stratified medium
         k_parallel (numpy.ndarray or str): in-plane wavenumber. If 'default', use smuthi.coord.default_k_parallel
-        solver_type (str):  What solver to use? Options: 'LU' for LU factorization, 'gmres' for GMRES iterative solver
+        solver_type (str):  What solver to use? Options: 'LU' for LU factorization, 'gmres' for GMRES iterative solver,
+                            'hmatrix' for the factorization of the hierarchical matrix compression of the master
+                            matrix (see smuthi.hmatrix), with solver_tolerance as the compression accuracy,
+                            'LU_mixed' for LU factorization in single precision with iterative refinement to double
+                            precision (see mixed_precision_lu_solve)
         store_coupling_matrix (bool):   If True (default), the coupling matrix is stored. Otherwise it is recomputed on
-                                        the fly during each iteration of the solver.
+                                        the fly during each iteration of the solver. With a lookup table, the stored
+                                        coupling matrix is assembled by interpolation on the CPU.
         coupling_matrix_lookup_resolution (float or None): If type float, compute particle coupling by interpolation of
                                                            a lookup table with that spacial resolution. A smaller number
                                                            implies higher accuracy and memory footprint.
@@ -42,6 +66,42 @@ class LinearSystem:
         interpolator_kind (str): interpolation order to be used, e.g. 'linear' or 'cubic'. This argument is ignored if
                                  coupling_matrix_lookup_resolution is None. In general, cubic interpolation is more 
                                  accurate but a bit slower than linear.
+        lookup_memory_budget (int or None): Upper limit (in bytes) for a coupling matrix that is precomputed from the
+                                            lookup table on the CPU. Larger coupling matrices are interpolated in each
+                                            iteration. If None, use default_lookup_memory_budget.
+        krylov_recycler (smuthi.krylov.KrylovRecycler or None): If not None and solver_type is 'gmres', solve with
+                                                                GCRO-DR, reusing the recycle space and warm start of
+                                                                previous linear systems that were solved with the same
+                                                                recycler (e.g. in a wavelength sweep).
+        preconditioner (str, smuthi.preconditioners.Preconditioner, LinearOperator, function or None):
+            Right preconditioner for the 'gmres' solver type. Options: None (default) for no preconditioning,
+            'block_jacobi' for the inverse of the single particle diagonal blocks of the master matrix, 'cluster' for
+            the inverse of the diagonal blocks of spatial particle clusters, 'hmatrix' for the inverse of a coarse
+            hierarchical matrix compression of the master matrix, a smuthi.preconditioners.Preconditioner object, or a
+            user defined approximate inverse of the master matrix (see smuthi.preconditioners.UserPreconditioner).
+        fmm_tolerance (float or None): If type float, evaluate the direct particle coupling with the fast multipole
+                                       method (see smuthi.fmm) with that targeted relative accuracy. In a stratified
+                                       medium, the layer mediated coupling is interpolated from a lookup table without
+                                       the direct coupling if coupling_matrix_lookup_resolution is given, and computed
+                                       explicitly otherwise (see CouplingMatrixFMM). Requires the 'gmres' solver type.
+                                       If None (default), don't use the fast multipole method.
+        pfft_grid_spacing (float, str or None): If not None, all particles are at the same height and a lookup table is
+                                                used, apply the coupling matrix by the precorrected FFT method (see
+                                                smuthi.pfft) on a grid with that spacing. If 'default', use a quarter
+                                                of the wavelength in the layer of the particles. Requires the 'gmres'
+                                                solver type.
+        lattice (smuthi.lattice.Lattice, str or None): If not None, the particles are identical (same multipole
+                                                       cutoffs), at the same height and occupy the sites of that
+                                                       lattice. The coupling matrix is then computed from one block per
+                                                       lattice displacement and, unless it is stored, applied by FFT
+                                                       (see CouplingMatrixLattice). If 'detect', try to detect the
+                                                       lattice from the particle positions.
+        out_of_core_directory (str or None): If not None, the explicit coupling matrix and the LU factors of the master
+                                             matrix are stored in memory-mapped files in that directory instead of the
+                                             RAM (see CouplingMatrixOutOfCore). Only one panel of
+                                             smuthi.out_of_core.default_tile_memory bytes is held in memory at a time.
+        number_of_threads (int or None): Number of threads for the assembly of the explicit coupling matrix. If None,
+                                         use default_number_of_threads.
                                                            
     """
     def __init__(self, 
@@ -54,7 +114,15 @@ class LinearSystem:
                  store_coupling_matrix=True, 
                  coupling_matrix_lookup_resolution=None, 
                  interpolator_kind='cubic', 
-                 cuda_blocksize=None):
+                 cuda_blocksize=None,
+                 lookup_memory_budget=None,
+                 krylov_recycler=None,
+                 preconditioner=None,
+                 fmm_tolerance=None,
+                 pfft_grid_spacing=None,
+                 lattice=None,
+                 out_of_core_directory=None,
+                 number_of_threads=None):
         
         if cuda_blocksize is None:
             cuda_blocksize = cu.default_blocksize
@@ -69,16 +137,31 @@ class LinearSystem:
         self.coupling_matrix_lookup_resolution = coupling_matrix_lookup_resolution
         self.interpolator_kind = interpolator_kind
         self.cuda_blocksize = cuda_blocksize
+        self.lookup_memory_budget = lookup_memory_budget
+        self.krylov_recycler = krylov_recycler
+        self.preconditioner = precond.preconditioner_object(preconditioner)
+        self.fmm_tolerance = fmm_tolerance
+        self.pfft_grid_spacing = pfft_grid_spacing
+        self.lattice = lattice
+        self.out_of_core_directory = out_of_core_directory
+        self.number_of_threads = number_of_threads
 
-        dummy_matrix = SystemMatrix(self.particle_list)
-        sys.stdout.write('Number of unknowns: %i\n' % dummy_matrix.shape[0])
+        # the arrays of a ParticleArray are not synchronized with in-place changes of the particles (e.g. of the
+        # position), such that they are rebuilt here
+        if isinstance(self.particle_list, part.ParticleArray):
+            self.particle_list.update()
+        self.layout = system_index_layout(self.particle_list)
+        sys.stdout.write('Number of unknowns: %i\n' % self.layout.size)
 
     def prepare(self):
         self.compute_initial_field_coefficients()
         self.compute_t_matrix()
         self.compute_coupling_matrix()
         self.master_matrix = MasterMatrix(t_matrix=self.t_matrix,
-                                          coupling_matrix=self.coupling_matrix)
+                                          coupling_matrix=self.coupling_matrix,
+                                          explicit=not self.solver_type == 'LU_mixed')
+        if self.solver_type == 'gmres' and self.preconditioner is not None and len(self.particle_list) > 0:
+            self.preconditioner.setup(self)
 
     def compute_initial_field_coefficients(self):
         """Evaluate initial field coefficients."""
@@ -87,20 +170,73 @@ class LinearSystem:
                              file=sys.stdout,
                              bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
             particle.initial_field = self.initial_field.spherical_wave_expansion(particle, self.layer_system)
+        if isinstance(self.particle_list, part.ParticleArray) and len(self.particle_list) > 0:
+            self.particle_list.bind_coefficients('initial_field')
         
     def compute_t_matrix(self):
-        """Initialize T-matrix object."""
-        for particle in tqdm(self.particle_list, 
-                             desc='T-matrices                ', 
-                             file=sys.stdout,
-                             bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
-            iS = self.layer_system.layer_number(particle.position[2])
-            niS = self.layer_system.refractive_indices[iS]
-            particle.t_matrix = tmt.t_matrix(self.initial_field.vacuum_wavelength, niS, particle)
-        self.t_matrix = TMatrix(particle_list=self.particle_list)
+        """Initialize T-matrix object. If the particle list is a smuthi.particles.ParticleArray, the T-matrix is
+        computed once for each group of identical particles in the same layer and shared among them."""
+        layer_numbers = np.array([self.layer_system.layer_number(particle.position[2])
+                                  for particle in self.particle_list], dtype=int)
+        if isinstance(self.particle_list, part.ParticleArray):
+            groups = [group[layer_numbers[group] == iS] for group in self.particle_list.identical_particle_groups()
+                      for iS in np.unique(layer_numbers[group])]
+        else:
+            groups = [[i] for i in range(len(self.particle_list))]
+        for group in tqdm(groups,
+                          desc='T-matrices                ', 
+                          file=sys.stdout,
+                          bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            niS = self.layer_system.refractive_indices[layer_numbers[group[0]]]
+            t_matrix = tmt.t_matrix(self.initial_field.vacuum_wavelength, niS, self.particle_list[group[0]])
+            for i in group:
+                self.particle_list[i].t_matrix = t_matrix
+        self.t_matrix = TMatrix(particle_list=self.particle_list, layout=self.layout)
         
     def compute_coupling_matrix(self):
         """Initialize coupling matrix object."""
+        if self.lattice is not None:
+            if type(self.lattice) == str and self.lattice == 'detect':
+                self.lattice = None
+                if len(set((particle.l_max, particle.m_max) for particle in self.particle_list)) == 1:
+                    self.lattice = latt.detect_lattice(self.particle_list)
+                if self.lattice is None:
+                    warnings.warn("No lattice of identical particles detected. Fall back to pairwise coupling.")
+            if self.lattice is not None:
+                if self.store_coupling_matrix:
+                    sys.stdout.write('Explicit coupling matrix computation from lattice displacement blocks.\n')
+                else:
+                    sys.stdout.write('Coupling matrix by FFT of lattice displacement blocks.\n')
+                sys.stdout.flush()
+                self.coupling_matrix = CouplingMatrixLattice(vacuum_wavelength=self.initial_field.vacuum_wavelength,
+                                                             particle_list=self.particle_list,
+                                                             layer_system=self.layer_system,
+                                                             lattice=self.lattice,
+                                                             k_parallel=self.k_parallel,
+                                                             explicit=self.store_coupling_matrix)
+                return
+
+        if self.coupling_matrix_lookup_resolution is not None and not self.interpolator_kind in ('linear', 'cubic'):
+            warnings.warn(self.interpolator_kind + ' interpolation not implemented. '
+                          'Use "linear" instead')
+            self.interpolator_kind = 'linear'
+
+        if self.fmm_tolerance is not None and not self.solver_type == 'gmres':
+            warnings.warn("The fast multipole method requires the gmres solver. Fall back to pairwise coupling.")
+            self.fmm_tolerance = None
+        if self.fmm_tolerance is not None:
+            sys.stdout.write('Direct coupling by fast multipole method on CPU.\n')
+            sys.stdout.flush()
+            self.coupling_matrix = CouplingMatrixFMM(vacuum_wavelength=self.initial_field.vacuum_wavelength,
+                                                     particle_list=self.particle_list,
+                                                     layer_system=self.layer_system,
+                                                     k_parallel=self.k_parallel,
+                                                     tolerance=self.fmm_tolerance,
+                                                     resolution=self.coupling_matrix_lookup_resolution,
+                                                     interpolator_kind=self.interpolator_kind,
+                                                     memory_budget=self.lookup_memory_budget)
+            return
+
         if self.coupling_matrix_lookup_resolution is not None:
             z_list = [particle.position[2] for particle in self.particle_list]
             is_list = [self.layer_system.layer_number(z) for z in z_list]
@@ -108,19 +244,34 @@ class LinearSystem:
                 warnings.warn("Particles are not all in same layer. "
                               "Fall back to direct coupling matrix computation (no lookup).")
                 self.coupling_matrix_lookup_resolution = None
-            if self.store_coupling_matrix:
-                warnings.warn("Explicit matrix compuatation using lookup currently not implemented. "
-                              "Disabling lookup.")
-                self.coupling_matrix_lookup_resolution = None
-            else:  # use lookup
-                if not self.interpolator_kind in ('linear', 'cubic'):
-                    warnings.warn(self.interpolator_kind + ' interpolation not implemented. '
-                                  'Use "linear" instead')
-                    self.interpolator_kind = 'linear'
-
+            if self.coupling_matrix_lookup_resolution is not None:  # use lookup
                 z_list = [particle.position[2] for particle in self.particle_list]
-                if z_list.count(z_list[0]) == len(z_list):  # all particles at same height: use radial lookup
-                    if cu.use_gpu:
+                if self.pfft_grid_spacing is not None and not z_list.count(z_list[0]) == len(z_list):
+                    warnings.warn("The precorrected FFT requires all particles at the same height. "
+                                  "Fall back to 3D lookup.")
+                    self.pfft_grid_spacing = None
+                if self.pfft_grid_spacing is not None and not self.solver_type == 'gmres':
+                    warnings.warn("The precorrected FFT requires the gmres solver. Fall back to radial lookup.")
+                    self.pfft_grid_spacing = None
+
+                if self.pfft_grid_spacing is not None:
+                    sys.stdout.write('Coupling matrix computation by ' + self.interpolator_kind
+                                     + ' interpolation of radial lookup and precorrected FFT on CPU.\n')
+                    sys.stdout.flush()
+                    if type(self.pfft_grid_spacing) == str and self.pfft_grid_spacing == 'default':
+                        grid_spacing = None
+                    else:
+                        grid_spacing = self.pfft_grid_spacing
+                    self.coupling_matrix = CouplingMatrixRadialLookupFFT(
+                        vacuum_wavelength=self.initial_field.vacuum_wavelength,
+                        particle_list=self.particle_list,
+                        layer_system=self.layer_system,
+                        k_parallel=self.k_parallel,
+                        resolution=self.coupling_matrix_lookup_resolution,
+                        interpolator_kind=self.interpolator_kind,
+                        grid_spacing=grid_spacing)
+                elif z_list.count(z_list[0]) == len(z_list):  # all particles at same height: use radial lookup
+                    if cu.use_gpu and not self.store_coupling_matrix:
                         sys.stdout.write('Coupling matrix computation by ' + self.interpolator_kind 
                                          + ' interpolation of radial lookup on GPU.\n')
                         sys.stdout.flush()
@@ -142,9 +293,11 @@ class LinearSystem:
                             layer_system=self.layer_system, 
                             k_parallel=self.k_parallel,
                             resolution=self.coupling_matrix_lookup_resolution, 
-                            interpolator_kind=self.interpolator_kind)
+                            interpolator_kind=self.interpolator_kind,
+                            memory_budget=self.lookup_memory_budget,
+                            explicit=self.store_coupling_matrix)
                 else:  #  not all particles at same height: use volume lookup
-                    if cu.use_gpu:
+                    if cu.use_gpu and not self.store_coupling_matrix:
                         sys.stdout.write('Coupling matrix computation by ' + self.interpolator_kind 
                                          + ' interpolation of 3D lookup on GPU.\n')
                         sys.stdout.flush()
@@ -166,18 +319,39 @@ class LinearSystem:
                             layer_system=self.layer_system, 
                             k_parallel=self.k_parallel,
                             resolution=self.coupling_matrix_lookup_resolution, 
-                            interpolator_kind=self.interpolator_kind)
+                            interpolator_kind=self.interpolator_kind,
+                            memory_budget=self.lookup_memory_budget,
+                            explicit=self.store_coupling_matrix)
 
-        if self.coupling_matrix_lookup_resolution is None:
+        if self.coupling_matrix_lookup_resolution is None and self.solver_type == 'hmatrix':
+            sys.stdout.write('Coupling matrix compression by adaptive cross approximation on CPU.\n')
+            sys.stdout.flush()
+            self.coupling_matrix = CouplingMatrixHierarchical(vacuum_wavelength=self.initial_field.vacuum_wavelength,
+                                                              particle_list=self.particle_list,
+                                                              layer_system=self.layer_system,
+                                                              k_parallel=self.k_parallel,
+                                                              tolerance=self.solver_tolerance)
+        elif self.coupling_matrix_lookup_resolution is None:
             if not self.store_coupling_matrix:
                 warnings.warn("With lookup disabled, coupling matrix needs to be stored.")
                 self.store_coupling_matrix = True
-            sys.stdout.write('Explicit coupling matrix computation on CPU.\n')
-            sys.stdout.flush()
-            self.coupling_matrix = CouplingMatrixExplicit(vacuum_wavelength=self.initial_field.vacuum_wavelength,
-                                                          particle_list=self.particle_list, 
-                                                          layer_system=self.layer_system,
-                                                          k_parallel=self.k_parallel)
+            if self.out_of_core_directory is not None:
+                sys.stdout.write('Explicit coupling matrix computation on CPU, stored out of core.\n')
+                sys.stdout.flush()
+                self.coupling_matrix = CouplingMatrixOutOfCore(
+                    vacuum_wavelength=self.initial_field.vacuum_wavelength,
+                    particle_list=self.particle_list,
+                    layer_system=self.layer_system,
+                    k_parallel=self.k_parallel,
+                    directory=self.out_of_core_directory)
+            else:
+                sys.stdout.write('Explicit coupling matrix computation on CPU.\n')
+                sys.stdout.flush()
+                self.coupling_matrix = CouplingMatrixExplicit(vacuum_wavelength=self.initial_field.vacuum_wavelength,
+                                                              particle_list=self.particle_list,
+                                                              layer_system=self.layer_system,
+                                                              k_parallel=self.k_parallel,
+                                                              number_of_threads=self.number_of_threads)
       
     def solve(self):
         """Compute scattered field coefficients and store them 
@@ -185,17 +359,13 @@ class LinearSystem:
         if len(self.particle_list) > 0:
             if self.solver_type == 'LU':
                 sys.stdout.write('Solve (LU decomposition)  : ...')
-                if not hasattr(self.master_matrix.linear_operator, 'A'):
-                    raise ValueError('LU factorization only possible '
-                                     'with the option "store coupling matrix".')
-                if not hasattr(self.master_matrix, 'LU_piv'):
-                    lu, piv = scipy.linalg.lu_factor(self.master_matrix.linear_operator.A, 
-                                                     overwrite_a=False)
-                    self.master_matrix.LU_piv = (lu, piv)
-                b = scipy.linalg.lu_solve(self.master_matrix.LU_piv, 
-                                          self.t_matrix.right_hand_side())
+                b = self.lu_solve(self.t_matrix.right_hand_side())
                 sys.stdout.write(' done\n')
                 sys.stdout.flush()
+            elif self.solver_type == 'LU_mixed':
+                b = self.mixed_precision_lu_solve(self.t_matrix.right_hand_side())
+            elif self.solver_type == 'hmatrix':
+                b = self.hmatrix_factorization().solve(self.t_matrix.right_hand_side())
             elif self.solver_type == 'gmres':
                 rhs = self.t_matrix.right_hand_side()
                 start_time = time.time()
@@ -209,32 +379,411 @@ class LinearSystem:
                     iter_num += 1
                 global iter_num
                 iter_num = 0
-                b, info = scipy.sparse.linalg.gmres(self.master_matrix.linear_operator, rhs, rhs, 
-                                                    tol=self.solver_tolerance, callback=status_msg)
+                if self.krylov_recycler is None:
+                    y, info = scipy.sparse.linalg.gmres(self.preconditioned_operator(), rhs, rhs,
+                                                        tol=self.solver_tolerance, callback=status_msg)
+                else:
+                    y, info = self.krylov_recycler.solve(self.preconditioned_operator(), rhs,
+                                                         tol=self.solver_tolerance,
+                                                         parameter=self.initial_field.vacuum_wavelength,
+                                                         callback=status_msg)
+                b = self.apply_preconditioner(y)
 #                sys.stdout.write('\n')
             else:
                 raise ValueError('This solver type is currently not implemented.')
 
+            for particle, scattered_field in zip(self.particle_list, self.scattered_field_expansions(b)):
+                particle.scattered_field = scattered_field
+            if isinstance(self.particle_list, part.ParticleArray):
+                self.particle_list.bind_coefficients('scattered_field', b)
+
+    def solve_multiple(self, initial_field_list):
+        """Compute the scattered field coefficients for a number of initial fields, e.g. for different incidence angles
+        or polarizations. The T-matrices, the coupling matrix and the LU factorization of the master matrix are reused,
+        such that the linear system needs to be prepared only once. With the 'gmres' solver type, all right hand sides
+        are solved together with block GMRES (see smuthi.krylov). The initial_field and scattered_field attributes of
+        the particles are not altered.
+
+        Args:
+            initial_field_list (list):  List of smuthi.initial_field.InitialField objects with the same vacuum
+                                        wavelength as self.initial_field
+
+        Returns:
+            List with one entry per initial field. Each entry is a list with the scattered fields of the particles as
+            smuthi.field_expansion.SphericalWaveExpansion objects.
+        """
+        for initial_field in initial_field_list:
+            if initial_field.vacuum_wavelength != self.initial_field.vacuum_wavelength:
+                raise ValueError('All initial fields need to have the vacuum wavelength of the linear system.')
+
+        rhs = np.zeros((self.t_matrix.shape[0], len(initial_field_list)), dtype=complex)
+        for j, initial_field in enumerate(tqdm(initial_field_list,
+                                               desc='Initial field coefficients',
+                                               file=sys.stdout,
+                                               bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}')):
+            initial_field_expansions = [initial_field.spherical_wave_expansion(particle, self.layer_system)
+                                        for particle in self.particle_list]
+            rhs[:, j] = self.t_matrix.right_hand_side(initial_field_expansions)
+
+        if len(self.particle_list) == 0:
+            b = rhs
+        elif self.solver_type == 'LU':
+            sys.stdout.write('Solve (LU decomposition)  : ...')
+            b = self.lu_solve(rhs)
+            sys.stdout.write(' done\n')
+            sys.stdout.flush()
+        elif self.solver_type == 'LU_mixed':
+            b = self.mixed_precision_lu_solve(rhs)
+        elif self.solver_type == 'hmatrix':
+            b = self.hmatrix_factorization().solve(rhs)
+        elif self.solver_type == 'gmres':
+            start_time = time.time()
+            def status_msg(relative_residual):
+                global iter_num
+                iter_msg = ('Solve (block GMRES)       : Iter ' + str(iter_num)
+                            + ' | Max. rel. residual: '
+                            + "{:.2e}".format(relative_residual.max())
+                            + ' | elapsed: ' + str(int(time.time() - start_time)) + 's')
+                sys.stdout.write('\r' + iter_msg)
+                iter_num += 1
+            global iter_num
+            iter_num = 0
+            y, info = krylov.block_gmres(self.preconditioned_operator(), rhs, rhs, tol=self.solver_tolerance,
+                                         callback=status_msg)
+            b = self.apply_preconditioner(y)
+            sys.stdout.write('\n')
+            if info > 0:
+                warnings.warn('Block GMRES did not converge within %i iterations.' % info)
+        else:
+            raise ValueError('This solver type is currently not implemented.')
+
+        return [self.scattered_field_expansions(b[:, j]) for j in range(b.shape[1])]
+
+    def preconditioned_operator(self):
+        """Master matrix times the right preconditioner as linear operator. Without preconditioner, this is the master
+        matrix.
+
+        Returns:
+            scipy.sparse.linalg.LinearOperator
+        """
+        if self.preconditioner is None:
+            return self.master_matrix.linear_operator
+        return self.master_matrix.linear_operator * self.preconditioner.linear_operator
+
+    def apply_preconditioner(self, y):
+        """Map the solution of the right preconditioned system to the scattered field coefficients.
+
+        Args:
+            y (numpy.ndarray):  solution of the preconditioned system, a vector or an array of shape
+                                [number of unknowns, number of right hand sides]
+
+        Returns:
+            preconditioner times y
+        """
+        if self.preconditioner is None:
+            return y
+        if y.ndim == 1:
+            return self.preconditioner.linear_operator.matvec(y)
+        return self.preconditioner.linear_operator.matmat(y)
+
+    def lu_factorization(self):
+        """LU factorization of the master matrix. It is computed with the first call and then stored in the master
+        matrix object. For a coupling matrix that is stored out of core, the factors are stored in a memory-mapped file
+        (see CouplingMatrixOutOfCore).
+
+        Returns:
+            Tuple (lu, piv) as returned by scipy.linalg.lu_factor
+        """
+        if isinstance(self.coupling_matrix, CouplingMatrixOutOfCore):
+            if not hasattr(self.master_matrix, 'LU_piv'):
+                self.master_matrix.LU_piv = self.coupling_matrix.master_matrix_lu_factorization(self.t_matrix)
+            return self.master_matrix.LU_piv
+        if not hasattr(self.master_matrix.linear_operator, 'A'):
+            raise ValueError('LU factorization only possible '
+                             'with the option "store coupling matrix".')
+        if not hasattr(self.master_matrix, 'LU_piv'):
+            lu, piv = scipy.linalg.lu_factor(self.master_matrix.linear_operator.A, 
+                                             overwrite_a=False)
+            self.master_matrix.LU_piv = (lu, piv)
+        return self.master_matrix.LU_piv
+
+    def lu_solve(self, rhs):
+        """Solve the linear system with the LU factorization of the master matrix, see lu_factorization.
+
+        Args:
+            rhs (numpy.ndarray):    right hand side, a vector or an array of shape [number of unknowns, number of
+                                    right hand sides]
+
+        Returns:
+            solution as complex numpy.ndarray of the same shape as rhs
+        """
+        if isinstance(self.coupling_matrix, CouplingMatrixOutOfCore):
+            lu, piv = self.lu_factorization()
+            return ooc.tiled_lu_solve(lu, piv, rhs, self.coupling_matrix.panel_width)
+        return scipy.linalg.lu_solve(self.lu_factorization(), rhs)
+
+    def mixed_precision_lu_factorization(self):
+        """LU factorization of the master matrix in single precision (complex64). The factors need half the memory and
+        about half the time of the double precision factorization. The double precision coupling matrix is kept for
+        the residuals of the iterative refinement, such that the peak memory is about 24 bytes per matrix entry
+        instead of 32 bytes (coupling matrix and master matrix in double precision) for the 'LU' solver. It is
+        computed with the first call and then stored in the master matrix object.
+
+        Returns:
+            Tuple (lu, piv) as returned by scipy.linalg.lu_factor
+        """
+        if not hasattr(self.master_matrix, 'LU_piv_single'):
+            sys.stdout.write('Master matrix memory footprint (single precision): '
+                             + coup.size_format(self.master_matrix.shape[0]**2 * np.dtype(np.complex64).itemsize)
+                             + '\n')
+            sys.stdout.flush()
+            master_matrix = self.master_matrix.explicit_matrix(dtype=np.complex64)
+            self.master_matrix.LU_piv_single = scipy.linalg.lu_factor(master_matrix, overwrite_a=True)
+        return self.master_matrix.LU_piv_single
+
+    def mixed_precision_lu_solve(self, rhs, max_iterations=20):
+        """Solve the linear system with the single precision LU factorization and iterative refinement: the residual
+        is computed with the double precision master matrix operator and the correction with the single precision
+        factorization, until the relative residual stagnates at the level of the double precision accuracy. The
+        relative residuals are stored in the refinement_residuals attribute.
+
+        Args:
+            rhs (numpy.ndarray):    right hand side, a vector or an array of shape [number of unknowns, number of
+                                    right hand sides]
+            max_iterations (int):   maximal number of refinement steps
+
+        Returns:
+            solution as complex numpy.ndarray of the same shape as rhs
+        """
+        lu_piv = self.mixed_precision_lu_factorization()
+        master_operator = self.master_matrix.linear_operator
+        rhs_norm = np.linalg.norm(rhs, axis=0)
+        rhs_norm = np.where(rhs_norm == 0, 1, rhs_norm)
+
+        def single_precision_solve(vector):
+            scale = abs(vector).max(axis=0)  # avoid underflow of small residuals in single precision
+            scale = np.where(scale == 0, 1, scale)
+            return scipy.linalg.lu_solve(lu_piv, (vector / scale).astype(np.complex64)).astype(complex) * scale
+
+        b = single_precision_solve(rhs)
+        self.refinement_residuals = []
+        for iteration in range(max_iterations + 1):
+            if b.ndim == 1:
+                residual = rhs - master_operator.matvec(b)
+            else:
+                residual = rhs - master_operator.matmat(b)
+            relative_residual = (np.linalg.norm(residual, axis=0) / rhs_norm).max()
+            self.refinement_residuals.append(relative_residual)
+            sys.stdout.write('Solve (mixed precision LU): Iter ' + str(iteration) + ' | Rel. residual: '
+                             + "{:.2e}".format(relative_residual) + '\n')
+            sys.stdout.flush()
+            if relative_residual < 10 * np.finfo(float).eps or (
+                    iteration > 0 and relative_residual > 0.5 * self.refinement_residuals[-2]):
+                break
+            if iteration < max_iterations:
+                b = b + single_precision_solve(residual)
+        if self.refinement_residuals[-1] > self.solver_tolerance:
+            warnings.warn('Iterative refinement stagnated at relative residual %.2e. The master matrix is probably '
+                          'too ill-conditioned for the single precision factorization.' % self.refinement_residuals[-1])
+        return b
+
+    def hmatrix_factorization(self):
+        """Factorized hierarchical matrix compression of the master matrix. It is computed with the first call and
+        then stored in the master matrix object. If the coupling matrix is not already compressed (see
+        CouplingMatrixHierarchical), it is compressed with the accuracy solver_tolerance.
+
+        Returns:
+            smuthi.hmatrix.HierarchicalMatrix object
+        """
+        if not hasattr(self.master_matrix, 'hmatrix'):
+            if hasattr(self.coupling_matrix, 'hmatrix'):
+                coupling_hmatrix = self.coupling_matrix.hmatrix
+            else:
+                coupling_hmatrix = hmat.HierarchicalMatrix(self.particle_list,
+                                                           precond.coupling_submatrix_function(self),
+                                                           tolerance=self.solver_tolerance)
+            master_hmatrix = coupling_hmatrix.master_matrix([particle.t_matrix for particle in self.particle_list])
+            master_hmatrix.factorize()
+            self.master_matrix.hmatrix = master_hmatrix
+        return self.master_matrix.hmatrix
+
+    def scattered_field_expansions(self, b):
+        """Scattered field expansions of the particles for a given solution of the linear system.
+
+        Args:
+            b (numpy.ndarray):  system vector with the scattered field coefficients of all particles
+
+        Returns:
+            List of smuthi.field_expansion.SphericalWaveExpansion objects, one for each particle
+        """
+        scattered_fields = []
+        coefficient_blocks = self.layout.split(b)
         for iS, particle in enumerate(self.particle_list):
             i_iS = self.layer_system.layer_number(particle.position[2])
             n_iS = self.layer_system.refractive_indices[i_iS]
             k = coord.angular_frequency(self.initial_field.vacuum_wavelength) * n_iS
             loz, upz = self.layer_system.lower_zlimit(i_iS), self.layer_system.upper_zlimit(i_iS)
-            particle.scattered_field = fldex.SphericalWaveExpansion(k=k, l_max=particle.l_max, m_max=particle.m_max,
-                                                                    kind='outgoing', reference_point=particle.position,
-                                                                    lower_z=loz, upper_z=upz)
-            particle.scattered_field.coefficients = b[self.master_matrix.index_block(iS)]
+            scattered_field = fldex.SphericalWaveExpansion(k=k, l_max=particle.l_max, m_max=particle.m_max,
+                                                           kind='outgoing', reference_point=particle.position,
+                                                           lower_z=loz, upper_z=upz)
+            scattered_field.coefficients = coefficient_blocks[iS].copy()
+            scattered_fields.append(scattered_field)
+        return scattered_fields
+
+
+class SystemIndexLayout:
+    r"""Positions of the coefficients :math:`c_{\tau,l,m}^i` in a system vector, precomputed once for a particle list
+    such that the index operations of the system matrices are array operations.
+
+    Args:
+        particle_list (list):   List of smuthi.particles.Particle objects
+
+    Attributes:
+        multipole_cutoffs (list):           Distinct pairs (l_max, m_max) of the particles
+        particle_kinds (numpy.ndarray):     Position of the (l_max, m_max) pair of each particle in multipole_cutoffs
+        blocksizes (numpy.ndarray):         Number of coefficients of each particle
+        offsets (numpy.ndarray):            Position of the first coefficient of each particle, followed by the length
+                                            of the system vector
+        particle_numbers (numpy.ndarray):   Particle number of each system vector entry
+        local_indices (numpy.ndarray):      Single index within the particle block of each system vector entry
+        tau_array (numpy.ndarray):          Polarization index of each system vector entry
+        l_array (numpy.ndarray):            Multipole degree of each system vector entry
+        m_array (numpy.ndarray):            Multipole order of each system vector entry
+    """
+    def __init__(self, particle_list):
+        # particles with the same multipole cutoff (l_max, m_max) are of the same kind and share the block layout
+        kind_numbers = {}
+        self.particle_kinds = np.array([kind_numbers.setdefault((particle.l_max, particle.m_max), len(kind_numbers))
+                                        for particle in particle_list], dtype=int)
+        self.multipole_cutoffs = list(kind_numbers)
+        kind_blocksizes = np.array([fldex.blocksize(l_max, m_max) for l_max, m_max in self.multipole_cutoffs],
+                                   dtype=int)
+
+        self.number_of_particles = len(particle_list)
+        self.blocksizes = kind_blocksizes[self.particle_kinds]
+        self.offsets = np.concatenate([[0], np.cumsum(self.blocksizes)]).astype(int)
+        self.size = int(self.offsets[-1])
+        self.particle_numbers = np.repeat(np.arange(self.number_of_particles), self.blocksizes)
+        self.local_indices = np.arange(self.size) - self.offsets[self.particle_numbers]
+        self.entry_kinds = self.particle_kinds[self.particle_numbers]
+
+        self.tau_array = np.zeros(self.size, dtype=int)
+        self.l_array = np.zeros(self.size, dtype=int)
+        self.m_array = np.zeros(self.size, dtype=int)
+        for kind, (l_max, m_max) in enumerate(self.multipole_cutoffs):
+            mask = self.entry_kinds == kind
+            tau_block, l_block, m_block = coup.block_multi_indices(l_max, m_max)
+            self.tau_array[mask] = tau_block[self.local_indices[mask]]
+            self.l_array[mask] = l_block[self.local_indices[mask]]
+            self.m_array[mask] = m_block[self.local_indices[mask]]
+
+        self._lookup_index_arrays = {}
+
+    def block(self, i):
+        """
+        Args:
+            i (int): number of particle
+
+        Returns:
+            indices that correspond to the coefficients for that particle
+        """
+        return range(self.offsets[i], self.offsets[i + 1])
+
+    def index(self, i, tau, l, m):
+        r"""
+        Args:
+            i (int):    particle number
+            tau (int):  spherical polarization index
+            l (int):    multipole degree
+            m (int):    multipole order
+
+        Returns:
+            Position in a system vector that corresponds to the :math:`(\tau, l, m)` coefficient of the i-th particle.
+        """
+        l_max, m_max = self.multipole_cutoffs[self.particle_kinds[i]]
+        return self.offsets[i] + fldex.multi_to_single_index(tau, l, m, l_max, m_max)
+
+    def index_array(self, particle_indices):
+        """
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of particles
+
+        Returns:
+            integer array with the indices that correspond to the coefficients of these particles
+        """
+        particle_indices = np.asarray(particle_indices, dtype=int)
+        blocksizes = self.blocksizes[particle_indices]
+        starts = np.repeat(self.offsets[particle_indices] - np.cumsum(blocksizes) + blocksizes, blocksizes)
+        return starts + np.arange(blocksizes.sum())
+
+    def lookup_index_array(self, l_max, m_max):
+        """Map the system vector to a vector that holds for each particle a full block of size
+        blocksize(l_max, m_max), as used by the coupling lookup tables.
+
+        Args:
+            l_max (int):    maximal multipole degree of the lookup blocks
+            m_max (int):    maximal multipole order of the lookup blocks
+
+        Returns:
+            Integer array with the position in the lookup vector for each entry of the system vector
+        """
+        if (l_max, m_max) not in self._lookup_index_arrays:
+            lookup_single_indices = np.zeros(self.size, dtype=int)
+            for kind, (particle_l_max, particle_m_max) in enumerate(self.multipole_cutoffs):
+                tau_block, l_block, m_block = coup.block_multi_indices(particle_l_max, particle_m_max)
+                kind_map = np.array([fldex.multi_to_single_index(tau, l, m, l_max, m_max)
+                                     for tau, l, m in zip(tau_block, l_block, m_block)], dtype=int)
+                mask = self.entry_kinds == kind
+                lookup_single_indices[mask] = kind_map[self.local_indices[mask]]
+            self._lookup_index_arrays[(l_max, m_max)] = (self.particle_numbers * fldex.blocksize(l_max, m_max)
+                                                         + lookup_single_indices)
+        return self._lookup_index_arrays[(l_max, m_max)]
+
+    def split(self, vector):
+        """Split a system vector into the coefficient blocks of the particles.
+
+        Args:
+            vector (numpy.ndarray): system vector (or array with the system index along the first axis)
+
+        Returns:
+            list of views, one for each particle
+        """
+        return np.split(vector, self.offsets[1:-1])
+
+
+def system_index_layout(particle_list):
+    """Index layout of the system vector for a particle list. For a smuthi.particles.ParticleArray, the layout is
+    computed once and shared by all system matrices.
+
+    Args:
+        particle_list (list):   List of smuthi.particles.Particle objects or smuthi.particles.ParticleArray
+
+    Returns:
+        SystemIndexLayout object
+    """
+    if isinstance(particle_list, part.ParticleArray):
+        if particle_list.index_layout is None:
+            particle_list.index_layout = SystemIndexLayout(particle_list)
+        return particle_list.index_layout
+    return SystemIndexLayout(particle_list)
 
 
 class SystemMatrix:
     r"""A system matrix is an abstract linear operator that operates on a system coefficient vector, i.e. a vector
     :math:`c = c_{\tau,l,m}^i`, where :math:`(\tau, l, m)` are the multipole indices and :math:`i` indicates the
     particle number.
+
+    Args:
+        particle_list (list):                   List of smuthi.particles.Particle objects
+        layout (SystemIndexLayout or None):     Index layout of the system vector. If None, it is computed from the
+                                                particle list
     """
-    def __init__(self, particle_list):
+    def __init__(self, particle_list, layout=None):
         self.particle_list = particle_list
-        blocksizes = [fldex.blocksize(particle.l_max, particle.m_max) for particle in self.particle_list]
-        self.shape = (sum(blocksizes), sum(blocksizes))
+        if layout is None:
+            layout = system_index_layout(particle_list)
+        self.layout = layout
+        self.shape = (layout.size, layout.size)
   
     def index_block(self, i):
         """
@@ -244,8 +793,7 @@ class SystemMatrix:
         Returns:
             indices that correspond to the coefficients for that particle
         """
-        blocksizes = [fldex.blocksize(particle.l_max, particle.m_max) for particle in self.particle_list[:(i + 1)]]
-        return range(sum(blocksizes[:i]), sum(blocksizes))
+        return self.layout.block(i)
 
     def index(self, i, tau, l, m):
         r"""
@@ -258,9 +806,30 @@ class SystemMatrix:
         Returns:
             Position in a system vector that corresponds to the :math:`(\tau, l, m)` coefficient of the i-th particle.
         """
-        blocksizes = [fldex.blocksize(particle.l_max, particle.m_max) for particle in self.particle_list[:i]]
-        return sum(blocksizes) + fldex.multi_to_single_index(tau, l, m, self.particle_list[i].l_max,
-                                                             self.particle_list[i].m_max)
+        return self.layout.index(i, tau, l, m)
+
+    def index_array(self, particle_indices):
+        """
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of particles
+
+        Returns:
+            integer array with the indices that correspond to the coefficients of these particles
+        """
+        return self.layout.index_array(particle_indices)
+
+    def lookup_index_array(self, l_max, m_max):
+        """Map the system vector to a vector that holds for each particle a full block of size
+        blocksize(l_max, m_max), as used by the coupling lookup tables.
+
+        Args:
+            l_max (int):    maximal multipole degree of the lookup blocks
+            m_max (int):    maximal multipole order of the lookup blocks
+
+        Returns:
+            Integer array with the position in the lookup vector for each entry of the system vector
+        """
+        return self.layout.lookup_index_array(l_max, m_max)
 
 
 class CouplingMatrixExplicit(SystemMatrix):
@@ -271,25 +840,341 @@ class CouplingMatrixExplicit(SystemMatrix):
         particle_list (list):   List of smuthi.particles.Particle objects
         layer_system (smuthi.layers.LayerSystem):   Stratified medium
         k_parallell (numpy.ndarray or str): In-plane wavenumber. If 'default', use smuthi.coordinates.default_k_parallel
+        number_of_threads (int or None):    Number of threads that compute the block rows of the coupling matrix in
+                                            parallel. Each block row is written by one thread, such that the result
+                                            doesn't depend on the number of threads. If None, use
+                                            default_number_of_threads
+
+    If smuthi.particle_coupling.use_reciprocity is set, only the blocks W_ij with i <= j are computed for particles in
+    the same layer, and the blocks W_ji follow from the reciprocity relation (see
+    smuthi.particle_coupling.reciprocal_block).
     """
-    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default'):
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', number_of_threads=None):
       
         SystemMatrix.__init__(self, particle_list)
+        if number_of_threads is None:
+            number_of_threads = default_number_of_threads
         coup_mat = np.zeros(self.shape, dtype=complex)
         sys.stdout.write('Coupling matrix memory footprint: ' + coup.size_format(coup_mat.nbytes) + '\n')
         sys.stdout.flush()
-        for s1, particle1 in enumerate(tqdm(particle_list, desc='Particle coupling matrix  ', file=sys.stdout,
-                                            bar_format='{l_bar}{bar}| elapsed: {elapsed} ' 'remaining: {remaining}')):
-            idx1 = np.array(self.index_block(s1))[:, None]
-            for s2, particle2 in enumerate(particle_list):
-                idx2 = self.index_block(s2)
-                coup_mat[idx1, idx2] = (coup.layer_mediated_coupling_block(vacuum_wavelength, particle1, particle2,
-                                                                           layer_system, k_parallel)
-                                        + coup.direct_coupling_block(vacuum_wavelength, particle1, particle2,
-                                                                     layer_system))
+        offsets = self.layout.offsets
+        layer_numbers = [layer_system.layer_number(particle.position[2]) for particle in particle_list]
+        if coup.use_reciprocity == 'validate':
+            coup.validate_reciprocity(vacuum_wavelength, particle_list, layer_system, k_parallel)
+
+        def assemble_block_row(s1):
+            # with reciprocity, the blocks W_21 of particles in the same layer follow from W_12 (computed in row 1)
+            if coup.use_reciprocity:
+                emitting_indices = [s2 for s2 in range(len(particle_list))
+                                    if s2 >= s1 or not layer_numbers[s2] == layer_numbers[s1]]
+            else:
+                emitting_indices = list(range(len(particle_list)))
+            emitting_particles = [particle_list[s2] for s2 in emitting_indices]
+            receiving_particles = [particle_list[s1] for particle2 in emitting_particles]
+            wr_blocks = coup.layer_mediated_coupling_block_list(vacuum_wavelength, receiving_particles,
+                                                                emitting_particles, layer_system, k_parallel)
+            w_blocks = coup.direct_coupling_block_list(vacuum_wavelength, receiving_particles, emitting_particles,
+                                                       layer_system)
+            for s2, wr, w in zip(emitting_indices, wr_blocks, w_blocks):
+                coup_mat[offsets[s1]:offsets[s1 + 1], offsets[s2]:offsets[s2 + 1]] = wr + w
+                if coup.use_reciprocity and s2 > s1 and layer_numbers[s2] == layer_numbers[s1]:
+                    coup_mat[offsets[s2]:offsets[s2 + 1], offsets[s1]:offsets[s1 + 1]] = coup.reciprocal_block(
+                        wr + w, particle_list[s1].l_max, particle_list[s1].m_max, particle_list[s2].l_max,
+                        particle_list[s2].m_max)
+
+        progress_bar = tqdm(total=len(particle_list), desc='Particle coupling matrix  ', file=sys.stdout,
+                            bar_format='{l_bar}{bar}| elapsed: {elapsed} ' 'remaining: {remaining}')
+        if number_of_threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=number_of_threads) as executor:
+                futures = [executor.submit(assemble_block_row, s1) for s1 in range(len(particle_list))]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()  # re-raise exceptions of the worker threads
+                    progress_bar.update()
+        else:
+            for s1 in range(len(particle_list)):
+                assemble_block_row(s1)
+                progress_bar.update()
+        progress_bar.close()
         self.linear_operator = scipy.sparse.linalg.aslinearoperator(coup_mat)
+
+    def submatrix(self, particle_indices):
+        """
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of particles
+
+        Returns:
+            coupling matrix between these particles as complex numpy.ndarray
+        """
+        idx = self.index_array(particle_indices)
+        return self.linear_operator.A[np.ix_(idx, idx)]
       
         
+class CouplingMatrixOutOfCore(SystemMatrix):
+    """Explicit coupling matrix that is stored in a memory-mapped file instead of the RAM, for coupling matrices that
+    exceed the available memory. The matrix is assembled and applied in panels of the columns that belong to a group
+    of emitting particles (see smuthi.out_of_core), such that only one panel is held in memory at a time.
+
+    Args:
+        vacuum_wavelength (float):  Vacuum wavelength in length units
+        particle_list (list):   List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium
+        k_parallel (numpy.ndarray or str): In-plane wavenumber. If 'default', use smuthi.coordinates.default_k_parallel
+        filename (str or None):     Path of the .npy file that holds the coupling matrix. If None, use a temporary file
+        directory (str or None):    Directory for temporary files. If None, use the default temporary directory
+        tile_memory (int or None):  Memory of one panel in bytes. If None, use smuthi.out_of_core.default_tile_memory
+    """
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', filename=None,
+                 directory=None, tile_memory=None):
+
+        SystemMatrix.__init__(self, particle_list)
+        self.directory = directory
+        self.panel_width = ooc.panel_width(self.shape[0], complex, tile_memory)
+        self.matrix = ooc.matrix_file(self.shape, complex, filename, directory)
+        sys.stdout.write('Coupling matrix file size: ' + coup.size_format(self.matrix.nbytes) + '\n')
+        sys.stdout.flush()
+
+        # group the emitting particles into panels of at most panel_width columns (at least one particle per panel)
+        offsets = self.layout.offsets
+        self.particle_panels = []
+        start = 0
+        while start < len(particle_list):
+            end = start + 1
+            while end < len(particle_list) and offsets[end + 1] - offsets[start] <= self.panel_width:
+                end += 1
+            self.particle_panels.append((start, end))
+            start = end
+
+        for start, end in tqdm(self.particle_panels, desc='Particle coupling matrix  ', file=sys.stdout,
+                               bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            self.matrix[:, offsets[start]:offsets[end]] = coup.coupling_submatrix(vacuum_wavelength, particle_list,
+                                                              particle_list[start:end], layer_system, k_parallel)
+        self.matrix.flush()
+
+        def matmat(in_block):
+            return ooc.tiled_matmat(self.matrix, in_block, self.panel_width)
+
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=matmat, matmat=matmat,
+                                                                  dtype=complex)
+
+    def submatrix(self, particle_indices):
+        """
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of particles
+
+        Returns:
+            coupling matrix between these particles as complex numpy.ndarray
+        """
+        idx = self.index_array(particle_indices)
+        return self.matrix[np.ix_(idx, idx)]
+
+    def master_matrix_lu_factorization(self, t_matrix):
+        """Assemble the master matrix :math:`M = 1 - TW` panel by panel in a second memory-mapped file and compute
+        its LU factorization in place, see smuthi.out_of_core.tiled_lu_factor.
+
+        Args:
+            t_matrix (TMatrix):     T-matrix object
+
+        Returns:
+            Tuple (lu, piv) of the memory-mapped LU factors and the pivot indices
+        """
+        master_matrix = ooc.matrix_file(self.shape, complex, directory=self.directory)
+        for start in range(0, self.shape[1], self.panel_width):
+            columns = slice(start, min(start + self.panel_width, self.shape[1]))
+            panel = - t_matrix.linear_operator.matmat(np.array(self.matrix[:, columns]))
+            panel[columns, :] += np.eye(columns.stop - columns.start)
+            master_matrix[:, columns] = panel
+        piv = ooc.tiled_lu_factor(master_matrix, self.panel_width)
+        return master_matrix, piv
+
+
+class CouplingMatrixFMM(SystemMatrix):
+    """Coupling matrix with the direct coupling evaluated by the fast multipole method, see smuthi.fmm. In a stratified
+    medium, the layer mediated coupling is added as a separate linear operator: If a lookup resolution is given and all
+    particles are in the same layer, it is interpolated from a lookup table without the direct coupling (radial lookup
+    if all particles are at the same height, 3D lookup otherwise). Otherwise, the layer mediated coupling matrix is
+    computed explicitly (see smuthi.particle_coupling.layer_mediated_coupling_matrix). If all layers have the same
+    refractive index and all particles are in the same layer, there is no layer mediated coupling.
+
+    By default, two neighbor boxes in each direction (5x5x5 boxes) are treated as near field. The box translations are
+    dense matrices with a cost that grows with the fourth power of the expansion order, and for directly adjacent well
+    separated boxes the ratio of box radius to center distance is too close to one for a moderate expansion order.
+
+    Args:
+        vacuum_wavelength (float):  Vacuum wavelength in length units
+        particle_list (list):   List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium
+        k_parallel (numpy.ndarray or str): In-plane wavenumber for the layer mediated coupling. If 'default', use
+                                           smuthi.coordinates.default_k_parallel
+        tolerance (float):      Targeted relative accuracy of the fast multipole method
+        max_leaf_size (float):  Mean number of particles per leaf box of the octree
+        separation (int):       Number of neighbor boxes in each direction that are treated as near field
+        resolution (float or None): Spatial resolution of the layer mediated coupling lookup. If None, compute the
+                                    layer mediated coupling matrix explicitly
+        interpolator_kind (str):    'linear' or 'cubic' interpolation of the layer mediated coupling lookup
+        memory_budget (int or None):    Upper limit for the memory of the interpolated layer mediated coupling matrix
+                                        in bytes, see lookup_coupling_operator
+    """
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', tolerance=1e-4,
+                 max_leaf_size=8, separation=2, resolution=None, interpolator_kind='linear', memory_budget=None):
+
+        SystemMatrix.__init__(self, particle_list)
+        self.direct_coupling = fmm.DirectCouplingFMM(vacuum_wavelength, particle_list, layer_system, tolerance,
+                                                     max_leaf_size, separation)
+
+        z_list = [particle.position[2] for particle in particle_list]
+        is_list = [layer_system.layer_number(z) for z in z_list]
+        if len(set(layer_system.refractive_indices)) == 1 and len(set(is_list)) == 1:
+            self.layer_mediated_coupling = None
+        elif resolution is not None and len(set(is_list)) == 1:
+            if len(set(z_list)) == 1:
+                lookup = CouplingMatrixRadialLookupCPU(vacuum_wavelength, particle_list, layer_system, k_parallel,
+                                                       resolution, interpolator_kind, memory_budget,
+                                                       direct_coupling=False)
+            else:
+                lookup = CouplingMatrixVolumeLookupCPU(vacuum_wavelength, particle_list, layer_system, k_parallel,
+                                                       resolution, interpolator_kind, memory_budget,
+                                                       direct_coupling=False)
+            self.layer_mediated_coupling = lookup.linear_operator
+        else:
+            wr = coup.layer_mediated_coupling_matrix(vacuum_wavelength, particle_list, layer_system, k_parallel)
+            self.layer_mediated_coupling = scipy.sparse.linalg.aslinearoperator(wr)
+
+        if self.layer_mediated_coupling is None:
+            self.linear_operator = self.direct_coupling.linear_operator
+        else:
+            self.linear_operator = self.direct_coupling.linear_operator + self.layer_mediated_coupling
+
+
+class CouplingMatrixHierarchical(SystemMatrix):
+    """Coupling matrix compressed in the hierarchical (HODLR) format, see smuthi.hmatrix. The dense diagonal blocks of
+    the leaf clusters and the rows and columns that are sampled by the adaptive cross approximation of the off-diagonal
+    blocks are computed directly (direct plus layer mediated coupling). Compression ratio and estimated accuracy are
+    written to the log.
+
+    Args:
+        vacuum_wavelength (float):  Vacuum wavelength in length units
+        particle_list (list):   List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium
+        k_parallel (numpy.ndarray or str): In-plane wavenumber. If 'default', use smuthi.coordinates.default_k_parallel
+        tolerance (float):      Relative accuracy of the adaptive cross approximation
+        leaf_size (int):        Maximal number of particles per leaf cluster
+    """
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', tolerance=1e-4,
+                 leaf_size=16):
+
+        SystemMatrix.__init__(self, particle_list)
+
+        def submatrix(receiving, emitting):
+            return coup.coupling_submatrix(vacuum_wavelength, [particle_list[i] for i in receiving],
+                                           [particle_list[i] for i in emitting], layer_system, k_parallel)
+
+        self.hmatrix = hmat.HierarchicalMatrix(particle_list, submatrix, tolerance, leaf_size)
+        self.hmatrix.report()
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=self.hmatrix.matvec,
+                                                                  matmat=self.hmatrix.matvec, dtype=complex)
+
+    def submatrix(self, particle_indices):
+        """
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of particles
+
+        Returns:
+            coupling matrix between these particles as complex numpy.ndarray
+        """
+        return self.hmatrix.submatrix(particle_indices, particle_indices)
+
+
+def interpolated_coupling_matrix(coupling_matrix, dtype=complex):
+    """Assemble the explicit coupling matrix by interpolation of a lookup table for all particle pairs.
+
+    Args:
+        coupling_matrix (CouplingMatrixVolumeLookupCPU or CouplingMatrixRadialLookupCPU): provides the interpolated
+                                                                                          coupling blocks
+        dtype (numpy.dtype):    data type of the coupling matrix
+
+    Returns:
+        coupling matrix as numpy.ndarray of shape coupling_matrix.shape
+    """
+    nump = len(coupling_matrix.particle_list)
+    blocksize = coupling_matrix.blocksize
+    lookup_indices = coupling_matrix.lookup_indices
+    chunksize = max(1, 2**21 // (nump * blocksize**2))  # number of receiving particles per chunk
+    chunks = [(i1, min(i1 + chunksize, nump)) for i1 in range(0, nump, chunksize)]
+    coup_mat = np.zeros(coupling_matrix.shape, dtype=dtype)
+    i_system = 0
+    for i1_start, i1_end in tqdm(chunks, desc='Lookup coupling matrix    ', file=sys.stdout,
+                                 bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+        rows = coupling_matrix.coupling_rows(i1_start, i1_end)
+        rows = rows.transpose(0, 2, 1, 3).reshape((i1_end - i1_start) * blocksize, nump * blocksize)
+        row_indices = lookup_indices[(lookup_indices >= i1_start * blocksize) & (lookup_indices < i1_end * blocksize)]
+        rows = rows[row_indices - i1_start * blocksize, :]
+        coup_mat[i_system:i_system + len(row_indices), :] = rows[:, lookup_indices]
+        i_system += len(row_indices)
+    return coup_mat
+
+
+def interpolated_submatrix(coupling_matrix, particle_indices):
+    """Assemble the coupling matrix between a group of particles by interpolation of a lookup table, e.g. for the
+    diagonal blocks of a cluster preconditioner.
+
+    Args:
+        coupling_matrix (CouplingMatrixVolumeLookupCPU or CouplingMatrixRadialLookupCPU): provides the interpolated
+                                                                                          coupling blocks
+        particle_indices (list or numpy.ndarray):   numbers of the particles in ascending order
+
+    Returns:
+        coupling matrix of the particle group as complex numpy.ndarray
+    """
+    particle_indices = np.asarray(particle_indices, dtype=int)
+    nump = len(coupling_matrix.particle_list)
+    numc = len(particle_indices)
+    blocksize = coupling_matrix.blocksize
+    pairs = (particle_indices[:, None] * nump + particle_indices[None, :]).ravel()
+    blocks = coupling_matrix.coupling_blocks(pairs).reshape(numc, numc, blocksize, blocksize)
+    blocks = blocks.transpose(0, 2, 1, 3).reshape(numc * blocksize, numc * blocksize)
+
+    # position of the system vector entries of the particle group in the lookup vector of the group
+    cluster_numbers = np.zeros(nump, dtype=int)
+    cluster_numbers[particle_indices] = np.arange(numc)
+    lookup_indices = coupling_matrix.lookup_indices[coupling_matrix.index_array(particle_indices)]
+    local_indices = cluster_numbers[lookup_indices // blocksize] * blocksize + lookup_indices % blocksize
+    return blocks[np.ix_(local_indices, local_indices)]
+
+
+def lookup_coupling_operator(coupling_matrix, memory_budget=None):
+    """Linear operator of a lookup based coupling matrix on the CPU.
+
+    If the coupling matrix fits into the memory budget, the interpolated coupling blocks of all particle pairs are
+    evaluated once and stored as a complex64 matrix, such that each matrix-vector product is a single BLAS call.
+    Otherwise, the lookup table is interpolated again in each matrix-vector product by the CPU kernels in
+    smuthi.numba_kernels.
+
+    Args:
+        coupling_matrix (CouplingMatrixVolumeLookupCPU or CouplingMatrixRadialLookupCPU): provides the interpolated
+                                                                                          coupling blocks and the
+                                                                                          on-the-fly matvec
+        memory_budget (int or None):    upper limit for the memory of the precomputed matrix in bytes. If None, use
+                                        default_lookup_memory_budget
+
+    Returns:
+        scipy.sparse.linalg.LinearOperator
+    """
+    if memory_budget is None:
+        memory_budget = default_lookup_memory_budget
+    if coupling_matrix.shape[0]**2 * np.dtype(np.complex64).itemsize <= memory_budget:
+        coupling_matrix.precomputed_matrix = interpolated_coupling_matrix(coupling_matrix, dtype=np.complex64)
+
+        def matvec(in_vec):
+            return coupling_matrix.precomputed_matrix.dot(np.asarray(in_vec, dtype=np.complex64))
+    else:
+        sys.stdout.write('Coupling matrix exceeds the lookup memory budget. Interpolate in each iteration.\n')
+        sys.stdout.flush()
+        matvec = coupling_matrix.interpolation_matvec
+
+    return scipy.sparse.linalg.LinearOperator(shape=coupling_matrix.shape, matvec=matvec, matmat=matvec,
+                                              dtype=complex)
+
+
 class CouplingMatrixVolumeLookup(SystemMatrix):
     """Base class for 3D lookup based coupling matrix either on CPU or on GPU (CUDA).
   
@@ -299,8 +1184,10 @@ class CouplingMatrixVolumeLookup(SystemMatrix):
         layer_system (smuthi.layers.LayerSystem): stratified medium
         k_parallel (numpy.ndarray or str): in-plane wavenumber. If 'default', use smuthi.coord.default_k_parallel
         resolution (float or None): spatial resolution of the lookup in the radial direction
+        direct_coupling (bool): if False, the lookup includes only the layer mediated coupling (see CouplingMatrixFMM)
     """
-    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None):
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None,
+                 direct_coupling=True):
       
         z_list = [particle.position[2] for particle in particle_list]
         is_list = [layer_system.layer_number(z) for z in z_list]
@@ -314,7 +1201,7 @@ class CouplingMatrixVolumeLookup(SystemMatrix):
         self.resolution = resolution
         lkup = coup.volumetric_coupling_lookup_table(vacuum_wavelength=vacuum_wavelength, particle_list=particle_list,
                                                      layer_system=layer_system, k_parallel=k_parallel, 
-                                                     resolution=resolution)
+                                                     resolution=resolution, direct_coupling=direct_coupling)
         self.lookup_table_plus, self.lookup_table_minus = lkup[0], lkup[1]
         self.rho_array, self.sum_z_array, self.diff_z_array = lkup[2], lkup[3], lkup[4]
 
@@ -322,6 +1209,11 @@ class CouplingMatrixVolumeLookup(SystemMatrix):
 class CouplingMatrixVolumeLookupCPU(CouplingMatrixVolumeLookup):
     """Class for 3D lookup based coupling matrix running on CPU. This is used when no suitable GPU device is detected
     or when PyCuda is not installed.
+
+    If the coupling matrix fits into the memory budget, it is precomputed by interpolation, with the interpolation
+    stencils evaluated for one chunk of particle pairs at a time. Otherwise, the numba kernels in smuthi.numba_kernels
+    interpolate the lookup in each matrix-vector product (see lookup_coupling_operator). In both cases, no arrays over
+    all particle pairs are stored.
   
     Args:
         vacuum_wavelength (float): vacuum wavelength in length units
@@ -330,85 +1222,108 @@ class CouplingMatrixVolumeLookupCPU(CouplingMatrixVolumeLookup):
         k_parallel (numpy.ndarray or str): in-plane wavenumber. If 'default', use smuthi.coord.default_k_parallel
         resolution (float or None): spatial resolution of the lookup in the radial direction
         interpolator_kind (str): 'linear' or 'cubic' interpolation
+        memory_budget (int or None): upper limit for the memory of a precomputed coupling matrix in bytes. If None,
+                                     use default_lookup_memory_budget
+        explicit (bool): if True, assemble the explicit coupling matrix in double precision (as required for LU
+                         factorization), independent of the memory budget
+        direct_coupling (bool): if False, the lookup includes only the layer mediated coupling (see CouplingMatrixFMM)
     """
     def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None,
-                 interpolator_kind='cubic'):
-        
-        if interpolator_kind == 'cubic':
-            interpolation_order = 3
-        else:
-            interpolation_order = 1
-            
+                 interpolator_kind='cubic', memory_budget=None, explicit=False, direct_coupling=True):
       
         CouplingMatrixVolumeLookup.__init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel,
-                                            resolution)
+                                            resolution, direct_coupling)
 
-        x_array = np.array([particle.position[0] for particle in particle_list])
-        y_array = np.array([particle.position[1] for particle in particle_list])
-        z_array = np.array([particle.position[2] for particle in particle_list])
-      
-        self.particle_rho_array = np.sqrt((x_array[:, None] - x_array[None, :])**2
-                                          + (y_array[:, None] - y_array[None, :])**2)
-        self.particle_phi_array = np.arctan2(y_array[:, None] - y_array[None, :], x_array[:, None] - x_array[None, :])
-        self.particle_sz_array = z_array[:, None] + z_array[None, :]
-        self.particle_dz_array = z_array[:, None] - z_array[None, :]
-      
-        # contains for each n all positions in the large system arrays that correspond to n:
-        self.system_vector_index_list = [[] for i in range(self.blocksize)]
+        self.positions = part.particle_positions(particle_list)
+        x_array, y_array, z_array = self.positions.T
 
-        # same size as system_vector_index_list, contains the according particle numbers:
-        self.particle_number_list = [[] for i in range(self.blocksize)]
-        self.m_list = [None for i in range(self.blocksize)]
-        for i, particle in enumerate(particle_list):
-            for m in range(-particle.m_max, particle.m_max + 1):
-                for l in range(max(1, abs(m)), particle.l_max + 1):
-                    for tau in range(2):
-                        n_lookup = fldex.multi_to_single_index(tau=tau, l=l, m=m, l_max=self.l_max, m_max=self.m_max)
-                        self.system_vector_index_list[n_lookup].append(self.index(i, tau, l, m))
-                        self.particle_number_list[n_lookup].append(i)
-                        self.m_list[n_lookup] = m
-        for n in range(self.blocksize):
-            self.system_vector_index_list[n] = np.array(self.system_vector_index_list[n])
-            self.particle_number_list[n] = np.array(self.particle_number_list[n])
-
-        self.lookup_plus_real = [[None for i in range(self.blocksize)] for i2 in range(self.blocksize)]
-        self.lookup_plus_imag = [[None for i in range(self.blocksize)] for i2 in range(self.blocksize)]
-        self.lookup_minus_real = [[None for i in range(self.blocksize)] for i2 in range(self.blocksize)]
-        self.lookup_minus_imag = [[None for i in range(self.blocksize)] for i2 in range(self.blocksize)]
-        for n1 in range(self.blocksize):
-            for n2 in range(self.blocksize):
-                self.lookup_plus_real[n1][n2] = scipy.interpolate.RectBivariateSpline(
-                    x=self.rho_array, y=self.sum_z_array, z=self.lookup_table_plus[:, :, n1, n2].real,
-                    kx=interpolation_order, ky=interpolation_order)
-                self.lookup_plus_imag[n1][n2] = scipy.interpolate.RectBivariateSpline(
-                    x=self.rho_array, y=self.sum_z_array, z=self.lookup_table_plus[:, :, n1, n2].imag,
-                    kx=interpolation_order, ky=interpolation_order)
-                self.lookup_minus_real[n1][n2] = scipy.interpolate.RectBivariateSpline(
-                    x=self.rho_array, y=self.diff_z_array, z=self.lookup_table_minus[:, :, n1, n2].real,
-                    kx=interpolation_order, ky=interpolation_order)
-                self.lookup_minus_imag[n1][n2] = scipy.interpolate.RectBivariateSpline(
-                    x=self.rho_array, y=self.diff_z_array, z=self.lookup_table_minus[:, :, n1, n2].imag,
-                    kx=interpolation_order, ky=interpolation_order)
-        def matvec(in_vec):
-            out_vec = np.zeros(shape=in_vec.shape, dtype=complex)
-            for n1 in range(self.blocksize):
-                i1 = self.particle_number_list[n1]
-                idx1 = self.system_vector_index_list[n1]
-                m1 = self.m_list[n1]
-                for n2 in range(self.blocksize):
-                    i2 = self.particle_number_list[n2]
-                    idx2 = self.system_vector_index_list[n2]
-                    m2 = self.m_list[n2]
-                    rho = self.particle_rho_array[i1[:, None], i2[None, :]]
-                    phi = self.particle_phi_array[i1[:, None], i2[None, :]]
-                    sz = self.particle_sz_array[i1[:, None], i2[None, :]]
-                    dz = self.particle_dz_array[i1[:, None], i2[None, :]]
-                    Mpl = self.lookup_plus_real[n1][n2].ev(rho, sz) + 1j * self.lookup_plus_imag[n1][n2].ev(rho, sz)
-                    Mmn = self.lookup_minus_real[n1][n2].ev(rho, dz) + 1j * self.lookup_minus_imag[n1][n2].ev(rho, dz)
-                    M = (Mpl + Mmn) * np.exp(1j * (m2 - m1) * phi)
-                    out_vec[idx1] += M.dot(in_vec[idx2])
-            return out_vec
-        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=matvec, dtype=complex)
+        m_array = coup.block_m_array(self.l_max, self.m_max)
+        self.dm_array = m_array[None, :] - m_array[:, None]  # m2 - m1
+        self.lookup_indices = self.lookup_index_array(self.l_max, self.m_max)
+
+        # lookup multi-index, multipole order and particle position for each system vector entry, see numba_kernels
+        self.interpolator_kind = interpolator_kind
+        self.n_lookup_array = (self.lookup_indices % self.blocksize).astype(np.uint32)
+        self.m_particle_array = self.layout.m_array.astype(float)
+        self.x_array = x_array[self.lookup_indices // self.blocksize]
+        self.y_array = y_array[self.lookup_indices // self.blocksize]
+        self.z_array = z_array[self.lookup_indices // self.blocksize]
+
+        if explicit:
+            self.linear_operator = scipy.sparse.linalg.aslinearoperator(interpolated_coupling_matrix(self))
+        else:
+            self.linear_operator = lookup_coupling_operator(self, memory_budget)
+
+    def coupling_rows(self, i1_start, i1_end):
+        """Interpolate the coupling blocks between a range of receiving particles and all emitting particles.
+
+        Args:
+            i1_start (int):     number of the first receiving particle
+            i1_end (int):       number of the last receiving particle plus one
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [receiving particle, emitting particle, n1, n2]
+        """
+        nump = len(self.particle_list)
+        w = self.coupling_blocks(np.arange(i1_start * nump, i1_end * nump))
+        return w.reshape(i1_end - i1_start, nump, self.blocksize, self.blocksize)
+
+    def coupling_blocks(self, pairs):
+        """Interpolate the coupling blocks of a selection of particle pairs.
+
+        Args:
+            pairs (numpy.ndarray):  pair indices i1 * len(particle_list) + i2
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [pair, n1, n2]
+        """
+        nump = len(self.particle_list)
+        receiving_positions = self.positions[pairs // nump]
+        emitting_positions = self.positions[pairs % nump]
+        displacement = receiving_positions - emitting_positions
+        rho = np.sqrt(displacement[:, 0]**2 + displacement[:, 1]**2)
+        phi = np.arctan2(displacement[:, 1], displacement[:, 0])
+        rho_stencil = coup.lookup_interpolation_stencil(rho, self.rho_array, self.interpolator_kind)
+        sz_stencil = coup.lookup_interpolation_stencil(receiving_positions[:, 2] + emitting_positions[:, 2],
+                                                       self.sum_z_array, self.interpolator_kind)
+        dz_stencil = coup.lookup_interpolation_stencil(displacement[:, 2], self.diff_z_array, self.interpolator_kind)
+        w = coup.interpolate_lookup(self.lookup_table_plus, [rho_stencil, sz_stencil])
+        w += coup.interpolate_lookup(self.lookup_table_minus, [rho_stencil, dz_stencil])
+        w *= np.exp(1j * self.dm_array[None, :, :] * phi[:, None, None])
+        return w
+
+    def submatrix(self, particle_indices):
+        """Interpolate the coupling matrix between a group of particles, see interpolated_submatrix.
+
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of the particles in ascending order
+
+        Returns:
+            coupling matrix of the particle group as complex numpy.ndarray
+        """
+        return interpolated_submatrix(self, particle_indices)
+
+    def interpolation_matvec(self, in_vec):
+        """Multiply the coupling matrix to a vector or to a block of vectors by interpolation of the lookup table for
+        each matrix entry.
+
+        Args:
+            in_vec (numpy.ndarray):     system vector, or array of shape [number of unknowns, number of vectors]
+
+        Returns:
+            coupling matrix times in_vec as array of shape [number of unknowns, number of vectors]
+        """
+        if self.interpolator_kind == 'linear':
+            coupling_kernel = nk.linear_volume_lookup_kernel
+        else:
+            coupling_kernel = nk.cubic_volume_lookup_kernel
+        in_vec = np.asarray(in_vec, dtype=complex).reshape(self.shape[0], -1)
+        result = np.zeros(in_vec.shape, dtype=complex)
+        coupling_kernel(self.n_lookup_array, self.m_particle_array, self.x_array, self.y_array, self.z_array,
+                        np.asarray(self.lookup_table_plus), np.asarray(self.lookup_table_minus), self.rho_array[0],
+                        self.sum_z_array[0], self.diff_z_array[0], self.rho_array[1] - self.rho_array[0],
+                        in_vec, result)
+        return result
 
 
 class CouplingMatrixVolumeLookupCUDA(CouplingMatrixVolumeLookup):
@@ -448,29 +1363,13 @@ class CouplingMatrixVolumeLookupCUDA(CouplingMatrixVolumeLookup):
         
         coupling_function = SourceModule(coupling_source).get_function("coupling_kernel") 
         
-        n_lookup_array = np.zeros(self.shape[0], dtype=np.uint32)
-        m_particle_array = np.zeros(self.shape[0], dtype=np.float32)
-        x_array = np.zeros(self.shape[0], dtype=np.float32)
-        y_array = np.zeros(self.shape[0], dtype=np.float32)
-        z_array = np.zeros(self.shape[0], dtype=np.float32)
-
-        i_particle = 0
-        for i, particle in enumerate(particle_list):
-            for m in range(-particle.m_max, particle.m_max + 1):
-                for l in range(max(1, abs(m)), particle.l_max + 1):
-                    for tau in range(2):
-                        i_taulm = fldex.multi_to_single_index(tau, l, m, particle.l_max, particle.m_max)
-                        idx = i_particle + i_taulm
-
-                        n_lookup_array[idx] = fldex.multi_to_single_index(tau, l, m, self.l_max, self.m_max)
-                        m_particle_array[idx] = m
-
-                        # scale the x and y position to the lookup resolution:
-                        x_array[idx] = particle.position[0]
-                        y_array[idx] = particle.position[1]
-                        z_array[idx] = particle.position[2]
-
-            i_particle += fldex.blocksize(particle.l_max, particle.m_max)
+        lookup_indices = self.lookup_index_array(self.l_max, self.m_max)
+        positions = part.particle_positions(particle_list).astype(np.float32)
+        n_lookup_array = (lookup_indices % self.blocksize).astype(np.uint32)
+        m_particle_array = self.layout.m_array.astype(np.float32)
+        x_array = positions[self.layout.particle_numbers, 0]
+        y_array = positions[self.layout.particle_numbers, 1]
+        z_array = positions[self.layout.particle_numbers, 2]
 
         re_lookup_pl = self.lookup_table_plus.real.astype(dtype=np.float32)
         im_lookup_pl = self.lookup_table_plus.imag.astype(dtype=np.float32)
@@ -518,8 +1417,11 @@ class CouplingMatrixRadialLookup(SystemMatrix):
         layer_system (smuthi.layers.LayerSystem): stratified medium
         k_parallel (numpy.ndarray or str): in-plane wavenumber. If 'default', use smuthi.coord.default_k_parallel
         resolution (float or None): spatial resolution of the lookup in the radial direction
+        max_distance (float or None): largest radial distance of the lookup. If None, the largest particle distance
+        direct_coupling (bool): if False, the lookup includes only the layer mediated coupling (see CouplingMatrixFMM)
     """
-    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None):
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None,
+                 max_distance=None, direct_coupling=True):
       
         z_list = [particle.position[2] for particle in particle_list]
         assert z_list.count(z_list[0]) == len(z_list)
@@ -532,7 +1434,7 @@ class CouplingMatrixRadialLookup(SystemMatrix):
         self.resolution = resolution
         self.lookup_table, self.radial_distance_array = coup.radial_coupling_lookup_table(
             vacuum_wavelength=vacuum_wavelength, particle_list=particle_list, layer_system=layer_system,
-            k_parallel=k_parallel, resolution=resolution)
+            k_parallel=k_parallel, resolution=resolution, max_distance=max_distance, direct_coupling=direct_coupling)
 
 
 class CouplingMatrixRadialLookupCUDA(CouplingMatrixRadialLookup):
@@ -567,29 +1469,12 @@ class CouplingMatrixRadialLookupCUDA(CouplingMatrixRadialLookup):
             
         coupling_function = SourceModule(coupling_source).get_function("coupling_kernel") 
           
-        n_lookup_array = np.zeros(self.shape[0], dtype=np.uint32)
-        m_particle_array = np.zeros(self.shape[0], dtype=np.float32)
-        x_array = np.zeros(self.shape[0], dtype=np.float32)
-        y_array = np.zeros(self.shape[0], dtype=np.float32)
-
-        i_particle = 0
-        for i, particle in enumerate(particle_list):
-            for m in range(-particle.m_max, particle.m_max + 1):
-                for l in range(max(1, abs(m)), particle.l_max + 1):
-                    for tau in range(2):
-
-                        #idx = self.index(i, tau, l, m)
-                        i_taulm = fldex.multi_to_single_index(tau, l, m, particle.l_max, particle.m_max)
-                        idx = i_particle + i_taulm
-
-                        n_lookup_array[idx] = fldex.multi_to_single_index(tau, l, m, self.l_max, self.m_max)
-                        m_particle_array[idx] = m
-
-                        # scale the x and y position to the lookup resolution:
-                        x_array[idx] = particle.position[0]
-                        y_array[idx] = particle.position[1]
-
-            i_particle += fldex.blocksize(particle.l_max, particle.m_max)
+        lookup_indices = self.lookup_index_array(self.l_max, self.m_max)
+        positions = part.particle_positions(particle_list).astype(np.float32)
+        n_lookup_array = (lookup_indices % self.blocksize).astype(np.uint32)
+        m_particle_array = self.layout.m_array.astype(np.float32)
+        x_array = positions[self.layout.particle_numbers, 0]
+        y_array = positions[self.layout.particle_numbers, 1]
 
         # lookup as numpy array in required shape
         re_lookup = self.lookup_table.real.astype(np.float32)
@@ -625,6 +1510,11 @@ class CouplingMatrixRadialLookupCUDA(CouplingMatrixRadialLookup):
 class CouplingMatrixRadialLookupCPU(CouplingMatrixRadialLookup):
     """Class for radial lookup based coupling matrix running on CPU. This is used when no suitable GPU device is detected
     or when PyCuda is not installed.
+
+    If the coupling matrix fits into the memory budget, it is precomputed by interpolation, with the interpolation
+    stencils evaluated for one chunk of particle pairs at a time. Otherwise, the numba kernels in smuthi.numba_kernels
+    interpolate the lookup in each matrix-vector product (see lookup_coupling_operator). In both cases, no arrays over
+    all particle pairs are stored.
   
     Args:
         vacuum_wavelength (float): vacuum wavelength in length units
@@ -633,91 +1523,357 @@ class CouplingMatrixRadialLookupCPU(CouplingMatrixRadialLookup):
         k_parallel (numpy.ndarray or str): in-plane wavenumber. If 'default', use smuthi.coord.default_k_parallel
         resolution (float or None): spatial resolution of the lookup in the radial direction
         kind (str): interpolation order, e.g. 'linear' or 'cubic'
+        memory_budget (int or None): upper limit for the memory of a precomputed coupling matrix in bytes. If None,
+                                     use default_lookup_memory_budget
+        explicit (bool): if True, assemble the explicit coupling matrix in double precision (as required for LU
+                         factorization), independent of the memory budget
+        direct_coupling (bool): if False, the lookup includes only the layer mediated coupling (see CouplingMatrixFMM)
     """
     def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None,
-                 interpolator_kind='linear'):
+                 interpolator_kind='linear', memory_budget=None, explicit=False, direct_coupling=True):
       
         z_list = [particle.position[2] for particle in particle_list]
         assert z_list.count(z_list[0]) == len(z_list)
       
-        CouplingMatrixRadialLookup.__init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel, resolution)
+        CouplingMatrixRadialLookup.__init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel,
+                                            resolution, direct_coupling=direct_coupling)
 
-        x_array = np.array([particle.position[0] for particle in particle_list])
-        y_array = np.array([particle.position[1] for particle in particle_list])
-      
-        self.particle_rho_array = np.sqrt((x_array[:, None] - x_array[None, :])**2
-                                          + (y_array[:, None] - y_array[None, :])**2)
-        self.particle_phi_array = np.arctan2(y_array[:, None] - y_array[None, :], x_array[:, None] - x_array[None, :])
-      
-        # contains for each n all positions in the large system arrays that correspond to n:
-        self.system_vector_index_list = [[] for i in range(self.blocksize)]
+        self.positions = part.particle_positions(particle_list)
+        x_array, y_array = self.positions[:, :2].T
 
-        # same size as system_vector_index_list, contains the according particle numbers:
-        self.particle_number_list = [[] for i in range(self.blocksize)]
-        self.m_list = [None for i in range(self.blocksize)]
-        for i, particle in enumerate(particle_list):
-            for m in range(-particle.m_max, particle.m_max + 1):
-                for l in range(max(1, abs(m)), particle.l_max + 1):
-                    for tau in range(2):
-                        n_lookup = fldex.multi_to_single_index(tau=tau, l=l, m=m, l_max=self.l_max, m_max=self.m_max)
-                        self.system_vector_index_list[n_lookup].append(self.index(i, tau, l, m))
-                        self.particle_number_list[n_lookup].append(i)
-                        self.m_list[n_lookup] = m
-        for n in range(self.blocksize):
-            self.system_vector_index_list[n] = np.array(self.system_vector_index_list[n])
-            self.particle_number_list[n] = np.array(self.particle_number_list[n])
-
-        lookup = [[None for i in range(self.blocksize)] for i2 in range(self.blocksize)]
-        for n1 in range(self.blocksize):
-            for n2 in range(self.blocksize):
-                lookup[n1][n2] = scipy.interpolate.interp1d(x=self.radial_distance_array, y=self.lookup_table[:, n1, n2],
-                                                            kind=interpolator_kind, axis=-1, assume_sorted=True)
+        m_array = coup.block_m_array(self.l_max, self.m_max)
+        self.dm_array = m_array[None, :] - m_array[:, None]  # m2 - m1
+        self.lookup_indices = self.lookup_index_array(self.l_max, self.m_max)
 
-        def matvec(in_vec):
-            out_vec = np.zeros(shape=in_vec.shape, dtype=complex)
-            for n1 in range(self.blocksize):
-                i1 = self.particle_number_list[n1]
-                idx1 = self.system_vector_index_list[n1]
-                m1 = self.m_list[n1]
-                for n2 in range(self.blocksize):
-                    i2 = self.particle_number_list[n2]
-                    idx2 = self.system_vector_index_list[n2]
-                    m2 = self.m_list[n2]
-                    rho = self.particle_rho_array[i1[:, None], i2[None, :]]
-                    phi = self.particle_phi_array[i1[:, None], i2[None, :]]
-                    M = lookup[n1][n2](rho)
-                    M = M * np.exp(1j * (m2 - m1) * phi)
-                    out_vec[idx1] += M.dot(in_vec[idx2])
-            return out_vec
-        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=matvec, dtype=complex)
+        # lookup multi-index, multipole order and particle position for each system vector entry, see numba_kernels
+        self.interpolator_kind = interpolator_kind
+        self.n_lookup_array = (self.lookup_indices % self.blocksize).astype(np.uint32)
+        self.m_particle_array = self.layout.m_array.astype(float)
+        self.x_array = x_array[self.lookup_indices // self.blocksize]
+        self.y_array = y_array[self.lookup_indices // self.blocksize]
+
+        if explicit:
+            self.linear_operator = scipy.sparse.linalg.aslinearoperator(interpolated_coupling_matrix(self))
+        else:
+            self.linear_operator = lookup_coupling_operator(self, memory_budget)
+
+    def coupling_rows(self, i1_start, i1_end):
+        """Interpolate the coupling blocks between a range of receiving particles and all emitting particles.
+
+        Args:
+            i1_start (int):     number of the first receiving particle
+            i1_end (int):       number of the last receiving particle plus one
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [receiving particle, emitting particle, n1, n2]
+        """
+        nump = len(self.particle_list)
+        w = self.coupling_blocks(np.arange(i1_start * nump, i1_end * nump))
+        return w.reshape(i1_end - i1_start, nump, self.blocksize, self.blocksize)
+
+    def coupling_blocks(self, pairs):
+        """Interpolate the coupling blocks of a selection of particle pairs.
+
+        Args:
+            pairs (numpy.ndarray):  pair indices i1 * len(particle_list) + i2
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [pair, n1, n2]
+        """
+        nump = len(self.particle_list)
+        displacement = self.positions[pairs // nump, :2] - self.positions[pairs % nump, :2]
+        rho = np.sqrt(displacement[:, 0]**2 + displacement[:, 1]**2)
+        phi = np.arctan2(displacement[:, 1], displacement[:, 0])
+        rho_stencil = coup.lookup_interpolation_stencil(rho, self.radial_distance_array, self.interpolator_kind)
+        w = coup.interpolate_lookup(self.lookup_table, [rho_stencil])
+        w *= np.exp(1j * self.dm_array[None, :, :] * phi[:, None, None])
+        return w
+
+    def submatrix(self, particle_indices):
+        """Interpolate the coupling matrix between a group of particles, see interpolated_submatrix.
+
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of the particles in ascending order
+
+        Returns:
+            coupling matrix of the particle group as complex numpy.ndarray
+        """
+        return interpolated_submatrix(self, particle_indices)
+
+    def interpolation_matvec(self, in_vec):
+        """Multiply the coupling matrix to a vector or to a block of vectors by interpolation of the lookup table for
+        each matrix entry.
+
+        Args:
+            in_vec (numpy.ndarray):     system vector, or array of shape [number of unknowns, number of vectors]
+
+        Returns:
+            coupling matrix times in_vec as array of shape [number of unknowns, number of vectors]
+        """
+        if self.interpolator_kind == 'linear':
+            coupling_kernel = nk.linear_radial_lookup_kernel
+        else:
+            coupling_kernel = nk.cubic_radial_lookup_kernel
+        in_vec = np.asarray(in_vec, dtype=complex).reshape(self.shape[0], -1)
+        result = np.zeros(in_vec.shape, dtype=complex)
+        coupling_kernel(self.n_lookup_array, self.m_particle_array, self.x_array, self.y_array,
+                        np.asarray(self.lookup_table), self.radial_distance_array[0],
+                        self.radial_distance_array[1] - self.radial_distance_array[0],
+                        in_vec, result)
+        return result
+
+
+class CouplingMatrixRadialLookupFFT(CouplingMatrixRadialLookup):
+    """Radial lookup based coupling matrix that is applied by the precorrected FFT method on the CPU, see smuthi.pfft.
+    The memory footprint and the cost of a matrix-vector product scale like O(N) and O(N log N) with the particle number
+    N (for a fixed particle density), which makes it suitable for large monolayers of particles.
+
+    Args:
+        vacuum_wavelength (float): vacuum wavelength in length units
+        particle_list (list): list of sumthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem): stratified medium
+        k_parallel (numpy.ndarray or str): in-plane wavenumber. If 'default', use smuthi.coord.default_k_parallel
+        resolution (float or None): spatial resolution of the lookup in the radial direction
+        interpolator_kind (str): 'linear' or 'cubic' interpolation of the lookup
+        grid_spacing (float or None): distance between the nodes of the FFT grid. If None, use a quarter of the
+                                      wavelength in the layer of the particles
+        interpolation_order (int): number of grid nodes per dimension to which each particle is projected
+        correction_radius (float or None): particle pairs closer than this distance are precorrected with the
+                                           interpolated lookup. If None, use (interpolation_order + 1) * grid_spacing
+    """
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None,
+                 interpolator_kind='linear', grid_spacing=None, interpolation_order=3, correction_radius=None):
+
+        if grid_spacing is None:
+            i_s = layer_system.layer_number(particle_list[0].position[2])
+            grid_spacing = vacuum_wavelength / layer_system.refractive_indices[i_s].real / 4
+
+        positions = part.particle_positions(particle_list)[:, :2]
+        self.pfft = pfft.PrecorrectedFFT(positions, grid_spacing, interpolation_order)
+        sys.stdout.write('FFT grid: %i x %i nodes\n' % self.pfft.grid_shape)
+        sys.stdout.flush()
+
+        CouplingMatrixRadialLookup.__init__(self, vacuum_wavelength, particle_list, layer_system, k_parallel,
+                                            resolution, max_distance=self.pfft.max_distance)
+        self.pfft.setup(self.lookup_table, self.radial_distance_array, self.l_max, self.m_max, correction_radius,
+                        interpolator_kind)
+        self.lookup_indices = self.lookup_index_array(self.l_max, self.m_max)
+
+        def matmat(in_block):
+            in_block = np.asarray(in_block, dtype=complex).reshape(self.shape[0], -1)
+            lookup_block = np.zeros((len(particle_list) * self.blocksize, in_block.shape[1]), dtype=complex)
+            lookup_block[self.lookup_indices] = in_block
+            return self.pfft.matmat(lookup_block)[self.lookup_indices]
+
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=matmat, matmat=matmat,
+                                                                  dtype=complex)
+
+    def coupling_blocks(self, pairs):
+        """Interpolate the coupling blocks of a selection of particle pairs.
+
+        Args:
+            pairs (numpy.ndarray): pair indices i1 * len(particle_list) + i2
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [pair, n1, n2]
+        """
+        nump = len(self.particle_list)
+        displacement = self.pfft.positions[pairs // nump] - self.pfft.positions[pairs % nump]
+        return self.pfft.lookup_blocks(displacement[:, 0], displacement[:, 1])
+
+    def submatrix(self, particle_indices):
+        """Interpolate the coupling matrix between a group of particles, see interpolated_submatrix.
+
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of the particles in ascending order
+
+        Returns:
+            coupling matrix of the particle group as complex numpy.ndarray
+        """
+        return interpolated_submatrix(self, particle_indices)
+
+
+class CouplingMatrixLattice(SystemMatrix):
+    """Coupling matrix of identical particles (same multipole cutoffs) at the same height that occupy the sites of a
+    regular lattice, see smuthi.lattice. The coupling block is computed once per lattice displacement and the coupling
+    matrix is applied by 2-D FFT of the block-Toeplitz structure, such that memory and matrix-vector products scale like
+    O(N) and O(N log N) with the number of lattice sites N of the patch.
+
+    Args:
+        vacuum_wavelength (float):  Vacuum wavelength in length units
+        particle_list (list):   List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium
+        lattice (smuthi.lattice.Lattice or None): Lattice of the particle positions. If None, detect the lattice
+        k_parallel (numpy.ndarray or str): In-plane wavenumber. If 'default', use smuthi.coordinates.default_k_parallel
+        explicit (bool): if True, assemble the explicit coupling matrix from the displacement blocks (as required for LU
+                         factorization)
+    """
+    def __init__(self, vacuum_wavelength, particle_list, layer_system, lattice=None, k_parallel='default',
+                 explicit=False):
+
+        SystemMatrix.__init__(self, particle_list)
+        if (len(set((particle.l_max, particle.m_max) for particle in particle_list)) > 1
+                or len(set(particle.position[2] for particle in particle_list)) > 1):
+            raise ValueError('Lattice coupling requires particles with equal multipole cutoffs at the same height.')
+        if lattice is None:
+            lattice = latt.detect_lattice(particle_list)
+            if lattice is None:
+                raise ValueError('Particles are not located on a regular lattice.')
+        self.lattice = lattice
+
+        indices = lattice.indices(particle_list)
+        indices -= indices.min(axis=0)
+        if len(np.unique(indices, axis=0)) < len(particle_list):
+            raise ValueError('More than one particle on the same lattice site.')
+        self.lattice_indices = indices
+        self.lattice_shape = tuple(indices.max(axis=0) + 1)
+        self.blocksize = fldex.blocksize(particle_list[0].l_max, particle_list[0].m_max)
+        sys.stdout.write('Lattice patch: %i x %i sites\n' % self.lattice_shape)
+        sys.stdout.flush()
+
+        self.lattice_blocks = latt.displacement_blocks(vacuum_wavelength, particle_list[0], lattice,
+                                                       self.lattice_shape, layer_system, k_parallel)
+
+        if explicit:
+            coup_mat = np.zeros(self.shape, dtype=complex)
+            sys.stdout.write('Coupling matrix memory footprint: ' + coup.size_format(coup_mat.nbytes) + '\n')
+            sys.stdout.flush()
+            nump = len(particle_list)
+            chunksize = max(1, 2**21 // (nump * self.blocksize**2))
+            for start in range(0, nump, chunksize):
+                receiving = np.arange(start, min(start + chunksize, nump))
+                blocks = self.coupling_blocks(receiving, np.arange(nump))
+                coup_mat[start * self.blocksize:(start + len(receiving)) * self.blocksize, :] = \
+                    blocks.transpose(0, 2, 1, 3).reshape(len(receiving) * self.blocksize, self.shape[1])
+            self.linear_operator = scipy.sparse.linalg.aslinearoperator(coup_mat)
+        else:
+            self.kernel_fft = np.fft.fft2(self.lattice_blocks, axes=(0, 1))
+
+            def matmat(in_block):
+                in_block = np.asarray(in_block, dtype=complex).reshape(self.shape[0], -1)
+                grid = np.zeros(self.lattice_shape + (self.blocksize, in_block.shape[1]), dtype=complex)
+                grid[indices[:, 0], indices[:, 1]] = in_block.reshape(len(particle_list), self.blocksize, -1)
+                grid_fft = np.fft.fft2(grid, s=self.kernel_fft.shape[:2], axes=(0, 1))
+                result = np.fft.ifft2(np.einsum('xyij,xyjv->xyiv', self.kernel_fft, grid_fft), axes=(0, 1))
+                return result[indices[:, 0], indices[:, 1]].reshape(self.shape[0], -1)
+
+            self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=matmat, matmat=matmat,
+                                                                      dtype=complex)
+
+    def coupling_blocks(self, receiving, emitting):
+        """Coupling blocks between all combinations of receiving and emitting particles.
+
+        Args:
+            receiving (numpy.ndarray):  numbers of the receiving particles
+            emitting (numpy.ndarray):   numbers of the emitting particles
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [receiving particle, emitting particle, n1, n2]
+        """
+        displacement = self.lattice_indices[receiving, None, :] - self.lattice_indices[None, emitting, :]
+        return self.lattice_blocks[displacement[..., 0] % self.lattice_blocks.shape[0],
+                                   displacement[..., 1] % self.lattice_blocks.shape[1]]
+
+    def submatrix(self, particle_indices):
+        """
+        Args:
+            particle_indices (list or numpy.ndarray):   numbers of particles
+
+        Returns:
+            coupling matrix between these particles as complex numpy.ndarray
+        """
+        particle_indices = np.asarray(particle_indices, dtype=int)
+        blocks = self.coupling_blocks(particle_indices, particle_indices)
+        size = len(particle_indices) * self.blocksize
+        return blocks.transpose(0, 2, 1, 3).reshape(size, size)
 
 
 class TMatrix(SystemMatrix):
     """Collect the particle T-matrices in a global lienear operator.
 
+    Diagonal T-matrices (e.g. of spheres) are stored as vectors and applied by scaling. Particles with identical
+    non-diagonal T-matrices share one dense block. Each group is applied with one batched product over an array of
+    shape [number of particles, blocksize] that is gathered from the system vector.
+
     Args:
         particle_list (list):   List of smuthi.particles.Particle objects containing a t_matrix attribute.
+        layout (SystemIndexLayout or None):     Index layout of the system vector. If None, it is computed from the
+                                                particle list
     """
-    def __init__(self, particle_list):
-        SystemMatrix.__init__(self, particle_list)
-        def apply_t_matrix(vector):
-            tv = np.zeros(vector.shape, dtype=complex)
-            for i_s, particle in enumerate(particle_list):
-                tv[self.index_block(i_s)] = particle.t_matrix.dot(vector[self.index_block(i_s)])
-            return tv
-        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=apply_t_matrix,
-                                                                  matmat=apply_t_matrix, dtype=complex)
-  
-    def right_hand_side(self):
+    def __init__(self, particle_list, layout=None):
+        SystemMatrix.__init__(self, particle_list, layout)
+        offsets = self.layout.offsets
+
+        diagonal_groups = {}  # blocksize -> particle numbers
+        dense_groups = {}     # T-matrix fingerprint -> particle numbers
+        classified = {}       # id of T-matrix array -> (is diagonal, fingerprint), such that shared arrays are
+                              # inspected only once
+        for i, particle in enumerate(particle_list):
+            t = particle.t_matrix
+            if id(t) not in classified:
+                diagonal = not np.count_nonzero(t - np.diag(np.diag(t)))
+                classified[id(t)] = (diagonal, None if diagonal else memo.fingerprint(t))
+            diagonal, key = classified[id(t)]
+            if diagonal:
+                diagonal_groups.setdefault(len(t), []).append(i)
+            else:
+                dense_groups.setdefault(key, []).append(i)
+
+        # list of (system indices of shape [number of particles, blocksize], T-data, is diagonal)
+        self.particle_groups = []
+        for blocksize, group in diagonal_groups.items():
+            diagonals = np.array([np.diag(particle_list[i].t_matrix) for i in group], dtype=complex)
+            indices = offsets[group][:, None] + np.arange(blocksize)[None, :]
+            self.particle_groups.append((indices, diagonals, True))
+        for group in dense_groups.values():
+            t = np.asarray(particle_list[group[0]].t_matrix, dtype=complex)
+            indices = offsets[group][:, None] + np.arange(len(t))[None, :]
+            self.particle_groups.append((indices, t, False))
+
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=self.apply,
+                                                                  matmat=self.apply, dtype=complex)
+
+    def apply(self, block, out=None, chunk_memory=2**26):
+        """Multiply the T-matrix to a vector or to the rows of a matrix.
+
+        Args:
+            block (numpy.ndarray):      Vector or array of shape [number of unknowns, number of columns]
+            out (numpy.ndarray or None): If not None, write the result into this array (which may have a different
+                                         dtype, e.g. numpy.complex64)
+            chunk_memory (int):         Upper limit for the memory (in bytes) of the rows that are gathered at once
+
+        Returns:
+            T-matrix times block
+        """
+        block = np.asarray(block)
+        if out is None:
+            out = np.zeros(block.shape, dtype=complex)
+        row_length = int(np.prod(block.shape[1:], dtype=int))
+        for indices, t_data, diagonal in self.particle_groups:
+            chunk = max(1, int(chunk_memory // (indices.shape[1] * row_length * 16)))
+            for start in range(0, len(indices), chunk):
+                idx = indices[start:start + chunk]
+                rows = block[idx]  # shape [number of particles, blocksize, ...]
+                if diagonal:
+                    out[idx] = t_data[start:start + chunk].reshape(idx.shape + (1,) * (block.ndim - 1)) * rows
+                else:
+                    out[idx] = np.einsum('ij,pj...->pi...', t_data, rows)
+        return out
+
+    def right_hand_side(self, initial_field_expansions=None):
         r"""The right hand side of the linear system is given by :math:`\sum_{\tau l m} T^i_{\tau l m} a^i_{\tau l m }`
 
+        Args:
+            initial_field_expansions (list or None):    List of smuthi.field_expansion.SphericalWaveExpansion objects
+                                                        with the initial field coefficients of each particle. If None,
+                                                        use the initial_field attribute of the particles.
+
         Returns:
             right hand side as a complex numpy.ndarray
         """
-        tai = np.zeros(self.shape[0], dtype=complex)
-        for i_s, particle in enumerate(self.particle_list):
-            tai[self.index_block(i_s)] = particle.t_matrix.dot(particle.initial_field.coefficients)
-        return tai
+        if initial_field_expansions is None:
+            initial_field_expansions = [particle.initial_field for particle in self.particle_list]
+        return self.apply(np.concatenate([expansion.coefficients for expansion in initial_field_expansions]))
 
       
 class MasterMatrix(SystemMatrix):
@@ -726,16 +1882,41 @@ class MasterMatrix(SystemMatrix):
     Args:
         t_matrix (SystemTMatrix):    T-matrix object
         coupling_matrix (CouplingMatrix):   Coupling matrix object
+        explicit (bool):    If True (default) and the coupling matrix is stored, the master matrix is stored, too.
+                            Otherwise, it is applied from the T-matrix and the coupling matrix.
     """
-    def __init__(self, t_matrix, coupling_matrix):
-        SystemMatrix.__init__(self, t_matrix.particle_list)
-        if type(coupling_matrix.linear_operator).__name__ == 'MatrixLinearOperator':
-            M = (np.eye(self.shape[0], dtype=complex)
-                 - t_matrix.linear_operator.matmat(coupling_matrix.linear_operator.A))
-            self.linear_operator = scipy.sparse.linalg.aslinearoperator(M)
+    def __init__(self, t_matrix, coupling_matrix, explicit=True):
+        SystemMatrix.__init__(self, t_matrix.particle_list, t_matrix.layout)
+        self.t_matrix = t_matrix
+        self.coupling_matrix = coupling_matrix
+        if explicit and type(coupling_matrix.linear_operator).__name__ == 'MatrixLinearOperator':
+            self.linear_operator = scipy.sparse.linalg.aslinearoperator(self.explicit_matrix())
         else:
             def apply_master_matrix(vector):
                 return vector - t_matrix.linear_operator.dot(coupling_matrix.linear_operator.matvec(vector))             
+
+            def apply_master_matrix_to_block(block):
+                return block - t_matrix.linear_operator.matmat(coupling_matrix.linear_operator.matmat(block))
  
             self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=self.shape, matvec=apply_master_matrix,
+                                                                      matmat=apply_master_matrix_to_block,
                                                                       dtype=complex)
+
+    def explicit_matrix(self, dtype=complex):
+        """Assemble the master matrix from the stored coupling matrix by applying the T-matrix to its rows in chunks
+        (row scaling for diagonal T-matrices, batched products otherwise), such that no intermediate copy of the full
+        matrix in higher precision is needed.
+
+        Args:
+            dtype (numpy.dtype):    data type of the master matrix, e.g. numpy.complex64 for single precision
+
+        Returns:
+            master matrix as numpy.ndarray
+        """
+        if not hasattr(self.coupling_matrix.linear_operator, 'A'):
+            raise ValueError('Master matrix assembly only possible with the option "store coupling matrix".')
+        master_matrix = np.empty(self.shape, dtype=dtype)
+        self.t_matrix.apply(self.coupling_matrix.linear_operator.A, out=master_matrix)
+        master_matrix *= -1
+        master_matrix[np.diag_indices(self.shape[0])] += 1
+        return master_matrix
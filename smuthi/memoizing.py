@@ -1,25 +1,217 @@
-"""Provide functionality to store intermediate results in lookup tables (memoize)"""
+"""Provide functionality to store intermediate results in lookup tables (memoize)
+
+Each memoized function owns a least-recently-used cache that is bounded by the number of bytes held by the cached
+results. Cache keys are built from fingerprints of the arguments, where numpy arrays are represented by their dtype,
+shape and a digest of their buffer. Hit, miss and eviction counters of all caches can be queried with
+cache_statistics."""
 import pickle
 import functools
+import hashlib
+import sys
+import threading
+import collections
+import numpy as np
+
+
+# registry of all caches created by Memoize, indexed by the qualified name of the memoized function
+cache_registry = {}
+
+_atomic_types = (bool, int, float, complex, str, bytes, type(None))
+
+
+def fingerprint(obj):
+    """Hashable representation of a function argument.
+
+    Numpy arrays are represented by dtype, shape and a digest of the data buffer, such that large arrays (like the
+    in-plane wavenumbers of a Sommerfeld contour) are neither pickled nor stored in the key. Lists, tuples and dicts are
+    fingerprinted element by element. Other objects are represented by a digest of their pickled state.
+
+    Args:
+        obj (object):   argument to be fingerprinted
+
+    Returns:
+        hashable fingerprint
+    """
+    if isinstance(obj, _atomic_types):
+        return type(obj), obj
+    elif isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        data = np.ascontiguousarray(obj)
+        return np.ndarray, data.dtype.str, data.shape, hashlib.blake2b(data.view(np.uint8), digest_size=16).digest()
+    elif isinstance(obj, (list, tuple)):
+        return type(obj), tuple(fingerprint(item) for item in obj)
+    elif isinstance(obj, dict):
+        return dict, tuple(sorted((key, fingerprint(value)) for key, value in obj.items()))
+    else:
+        return object, hashlib.blake2b(pickle.dumps(obj, 1), digest_size=16).digest()
+
+
+def result_size(obj):
+    """Estimate of the memory held by a cached result.
+
+    Args:
+        obj (object):   result of a memoized function call
+
+    Returns:
+        size in bytes (int)
+    """
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(result_size(item) for item in obj)
+    else:   # for numpy arrays, this includes the data buffer if it is owned by the array
+        return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """Least-recently-used cache bounded by the total size of the stored values.
+
+    Args:
+        name (str):             name under which the cache is listed in the statistics
+        max_bytes (int):        upper limit for the total size of the stored values. If None, no limit is applied
+        max_entries (int):      upper limit for the number of entries. If None, no limit is applied
+    """
+    def __init__(self, name, max_bytes=None, max_entries=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def lookup(self, key):
+        """Look up a key and mark the entry as recently used.
+
+        Args:
+            key (hashable):     cache key
+
+        Returns:
+            Tuple (found, value) where found is a bool and value is the stored value (or None if not found)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def store(self, key, value):
+        """Store a value and evict the least recently used entries until the limits are respected. Values that are
+        larger than max_bytes on their own are not stored.
+
+        Args:
+            key (hashable):     cache key
+            value (object):     value to store
+        """
+        nbytes = result_size(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while ((self.max_bytes is not None and self.current_bytes > self.max_bytes)
+                   or (self.max_entries is not None and len(self.entries) > self.max_entries)):
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries. The counters are not reset."""
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def reset_statistics(self):
+        """Set the hit, miss and eviction counters to zero."""
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def statistics(self):
+        """Return a dictionary with the keys 'hits', 'misses', 'evictions', 'entries', 'bytes', 'max_bytes' and
+        'max_entries'."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes,
+                    'max_entries': self.max_entries}
 
 
 class Memoize:
-    """To be used as a decorator for functions that are memoized."""
-    def __init__(self, fn):
+    """To be used as a decorator for functions that are memoized.
+
+    Can be used without arguments (@Memoize), in which case the default limits apply, or through the memoize function
+    to specify a cache policy, e.g. @memoize(max_bytes=2**28).
+
+    Args:
+        fn (function):          function to be memoized
+        max_bytes (int):        upper limit for the total size of the cached results. If None, no limit is applied
+        max_entries (int):      upper limit for the number of cached results. If None, no limit is applied
+    """
+    def __init__(self, fn, max_bytes=2**28, max_entries=100000):
+        functools.update_wrapper(self, fn)
         self.fn = fn
-        self.memo = {}
+        name = fn.__module__ + '.' + fn.__qualname__
+        self.cache = LRUCache(name, max_bytes=max_bytes, max_entries=max_entries)
+        cache_registry[name] = self.cache
+
     def __call__(self, *args, **kwds):
-        if len(self.memo) > 100000:
-            self.memo.clear()
-        argstr = pickle.dumps(args, 1)+pickle.dumps(kwds, 1)
-        if not argstr in self.memo:
-            #print("miss") # DEBUG INFO
-            self.memo[argstr] = self.fn(*args, **kwds)
-        #else:
-            #print("hit") # DEBUG INFO
-        #print(len(self.memo))
-        return self.memo[argstr]
-    
+        key = (fingerprint(args), fingerprint(kwds))
+        found, value = self.cache.lookup(key)
+        if not found:
+            value = self.fn(*args, **kwds)
+            self.cache.store(key, value)
+        return value
+
     def __get__(self, obj, objtype):
         '''Support instance methods.'''
         return functools.partial(self.__call__, obj)
+
+
+def memoize(max_bytes=2**28, max_entries=100000):
+    """Decorator factory for memoized functions with a specific cache policy.
+
+    Args:
+        max_bytes (int):        upper limit for the total size of the cached results. If None, no limit is applied
+        max_entries (int):      upper limit for the number of cached results. If None, no limit is applied
+
+    Returns:
+        decorator that turns a function into a Memoize object
+    """
+    def decorator(fn):
+        return Memoize(fn, max_bytes=max_bytes, max_entries=max_entries)
+    return decorator
+
+
+def cache_statistics():
+    """Hit, miss and eviction counters as well as the memory usage of all memoized functions.
+
+    Returns:
+        dictionary with the qualified function names as keys and the LRUCache.statistics dictionaries as values
+    """
+    return {name: cache.statistics() for name, cache in cache_registry.items()}
+
+
+def clear_caches():
+    """Remove the entries of all memoized functions."""
+    for cache in cache_registry.values():
+        cache.clear()
+
+
+def set_cache_limits(name, max_bytes=None, max_entries=None):
+    """Change the cache policy of a memoized function. Entries are evicted with the next call that stores a result.
+
+    Args:
+        name (str):             qualified name of the memoized function, e.g.
+                                'smuthi.layers.layersystem_response_matrix'
+        max_bytes (int):        upper limit for the total size of the cached results. If None, no limit is applied
+        max_entries (int):      upper limit for the number of cached results. If None, no limit is applied
+    """
+    cache = cache_registry[name]
+    with cache.lock:
+        cache.max_bytes = max_bytes
+        cache.max_entries = max_entries
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""CPU counterparts of the CUDA kernels in smuthi.cuda_sources that multiply the coupling matrix to a vector by
+interpolation of a coupling lookup table. The kernels are compiled with numba and evaluate the rows of the result in
+parallel on all CPU cores.
+
+All kernels take the same input data layout as the respective CUDA kernel, but positions are in double precision and
+complex arrays are not split into real and imaginary part:
+
+n (np.uint32):          n[i] contains the mutlipole multi-index with regard to the l_max and m_max of the lookup table
+                        of the i-th entry of a system vector
+m (np.float64):         m[i] contains the multipole order of the i-th entry of a system vector
+x_pos (np.float64):     x_pos[i] contains the respective particle x-position (similarly y_pos and z_pos)
+lookup (np.complex64):  the lookup table in the format (rho, n1, n2) for radial lookups. Volume lookups take two tables
+                        lookup_pl and lookup_mn for the z1+z2 and z1-z2 parts of the Sommerfeld integral, in the format
+                        (rho, sum_z, n1, n2) and (rho, diff_z, n1, n2)
+in_vec (np.complex128): the vectors to be multiplied with the coupling matrix, in the format (n_unknowns, n_vectors),
+                        such that the interpolation of the lookup is shared by all vectors
+result (np.complex128): the zero-initialized vectors into which the result is written, same format as in_vec
+"""
+
+import numba as nb
+import numpy as np
+
+
+@nb.njit(cache=True, nogil=True)
+def cubic_interpolation(w, lookup_imn1, lookup_i, lookup_ipl1, lookup_ipl2):
+    return ((-w*w*w+2*w*w-w) * lookup_imn1 + (3*w*w*w-5*w*w+2) * lookup_i + (-3*w*w*w+4*w*w+w) * lookup_ipl1
+            + (w*w*w-w*w) * lookup_ipl2) / 2
+
+
+@nb.njit(cache=True, nogil=True)
+def linear_lookup_2d(i_rho, w_rho, i_z, w_z, n1, n2, lookup):
+    return ((1 - w_rho) * ((1 - w_z) * lookup[i_rho, i_z, n1, n2] + w_z * lookup[i_rho, i_z + 1, n1, n2])
+            + w_rho * ((1 - w_z) * lookup[i_rho + 1, i_z, n1, n2] + w_z * lookup[i_rho + 1, i_z + 1, n1, n2]))
+
+
+@nb.njit(cache=True, nogil=True)
+def cubic_lookup_1d(i_rho, i_z, w_z, n1, n2, lookup):
+    return cubic_interpolation(w_z, lookup[i_rho, i_z - 1, n1, n2], lookup[i_rho, i_z, n1, n2],
+                               lookup[i_rho, i_z + 1, n1, n2], lookup[i_rho, i_z + 2, n1, n2])
+
+
+@nb.njit(cache=True, nogil=True)
+def cubic_lookup_2d(i_rho, w_rho, i_z, w_z, n1, n2, lookup):
+    return cubic_interpolation(w_rho, cubic_lookup_1d(i_rho - 1, i_z, w_z, n1, n2, lookup),
+                               cubic_lookup_1d(i_rho, i_z, w_z, n1, n2, lookup),
+                               cubic_lookup_1d(i_rho + 1, i_z, w_z, n1, n2, lookup),
+                               cubic_lookup_1d(i_rho + 2, i_z, w_z, n1, n2, lookup))
+
+
+@nb.njit(parallel=True, cache=True)
+def linear_volume_lookup_kernel(n, m, x_pos, y_pos, z_pos, lookup_pl, lookup_mn, min_rho, min_z_sum, min_z_diff,
+                                resolution, in_vec, result):
+    for i1 in nb.prange(len(n)):
+        for i2 in range(len(n)):
+            x21 = x_pos[i1] - x_pos[i2]
+            y21 = y_pos[i1] - y_pos[i2]
+            rho = np.sqrt(x21*x21 + y21*y21)
+            phi = np.arctan2(y21, x21)
+
+            rho_idx = int(np.floor((rho - min_rho) / resolution))
+            rho_w = (rho - min_rho) / resolution - rho_idx
+            sz_idx = int(np.floor((z_pos[i1] + z_pos[i2] - min_z_sum) / resolution))
+            sz_w = (z_pos[i1] + z_pos[i2] - min_z_sum) / resolution - sz_idx
+            dz_idx = int(np.floor((z_pos[i1] - z_pos[i2] - min_z_diff) / resolution))
+            dz_w = (z_pos[i1] - z_pos[i2] - min_z_diff) / resolution - dz_idx
+
+            si = (linear_lookup_2d(rho_idx, rho_w, sz_idx, sz_w, n[i1], n[i2], lookup_pl)
+                  + linear_lookup_2d(rho_idx, rho_w, dz_idx, dz_w, n[i1], n[i2], lookup_mn))
+            w = np.exp(1j * (m[i2] - m[i1]) * phi) * si
+            for j in range(in_vec.shape[1]):
+                result[i1, j] += w * in_vec[i2, j]
+
+
+@nb.njit(parallel=True, cache=True)
+def cubic_volume_lookup_kernel(n, m, x_pos, y_pos, z_pos, lookup_pl, lookup_mn, min_rho, min_z_sum, min_z_diff,
+                               resolution, in_vec, result):
+    for i1 in nb.prange(len(n)):
+        for i2 in range(len(n)):
+            x21 = x_pos[i1] - x_pos[i2]
+            y21 = y_pos[i1] - y_pos[i2]
+            rho = np.sqrt(x21*x21 + y21*y21)
+            phi = np.arctan2(y21, x21)
+
+            rho_idx = int(np.floor((rho - min_rho) / resolution))
+            rho_w = (rho - min_rho) / resolution - rho_idx
+            sz_idx = int(np.floor((z_pos[i1] + z_pos[i2] - min_z_sum) / resolution))
+            sz_w = (z_pos[i1] + z_pos[i2] - min_z_sum) / resolution - sz_idx
+            dz_idx = int(np.floor((z_pos[i1] - z_pos[i2] - min_z_diff) / resolution))
+            dz_w = (z_pos[i1] - z_pos[i2] - min_z_diff) / resolution - dz_idx
+
+            si = (cubic_lookup_2d(rho_idx, rho_w, sz_idx, sz_w, n[i1], n[i2], lookup_pl)
+                  + cubic_lookup_2d(rho_idx, rho_w, dz_idx, dz_w, n[i1], n[i2], lookup_mn))
+            w = np.exp(1j * (m[i2] - m[i1]) * phi) * si
+            for j in range(in_vec.shape[1]):
+                result[i1, j] += w * in_vec[i2, j]
+
+
+@nb.njit(parallel=True, cache=True)
+def linear_radial_lookup_kernel(n, m, x_pos, y_pos, lookup, min_rho, resolution, in_vec, result):
+    for i1 in nb.prange(len(n)):
+        for i2 in range(len(n)):
+            x21 = x_pos[i1] - x_pos[i2]
+            y21 = y_pos[i1] - y_pos[i2]
+            rho = np.sqrt(x21*x21 + y21*y21)
+            phi = np.arctan2(y21, x21)
+
+            rho_idx = int(np.floor((rho - min_rho) / resolution))
+            rho_w = (rho - min_rho) / resolution - rho_idx
+
+            si = (1 - rho_w) * lookup[rho_idx, n[i1], n[i2]] + rho_w * lookup[rho_idx + 1, n[i1], n[i2]]
+            w = np.exp(1j * (m[i2] - m[i1]) * phi) * si
+            for j in range(in_vec.shape[1]):
+                result[i1, j] += w * in_vec[i2, j]
+
+
+@nb.njit(parallel=True, cache=True)
+def cubic_radial_lookup_kernel(n, m, x_pos, y_pos, lookup, min_rho, resolution, in_vec, result):
+    for i1 in nb.prange(len(n)):
+        for i2 in range(len(n)):
+            x21 = x_pos[i1] - x_pos[i2]
+            y21 = y_pos[i1] - y_pos[i2]
+            rho = np.sqrt(x21*x21 + y21*y21)
+            phi = np.arctan2(y21, x21)
+
+            rho_idx = int(np.floor((rho - min_rho) / resolution))
+            rho_w = (rho - min_rho) / resolution - rho_idx
+
+            si = cubic_interpolation(rho_w, lookup[rho_idx - 1, n[i1], n[i2]], lookup[rho_idx, n[i1], n[i2]],
+                                     lookup[rho_idx + 1, n[i1], n[i2]], lookup[rho_idx + 2, n[i1], n[i2]])
+            w = np.exp(1j * (m[i2] - m[i1]) * phi) * si
+            for j in range(in_vec.shape[1]):
+                result[i1, j] += w * in_vec[i2, j]
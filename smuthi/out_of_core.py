@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Out-of-core storage of large explicit matrices in memory-mapped files.
+
+The matrices are stored in Fortran (column major) order in .npy files, such that a panel of consecutive columns is a
+contiguous section of the file. They are written and read one column panel at a time, such that only one panel needs
+to fit into memory. The LU factorization is computed panel by panel in a left-looking manner with partial pivoting,
+see tiled_lu_factor.
+"""
+
+import os
+import sys
+import tempfile
+import warnings
+import numpy as np
+import scipy.linalg
+from tqdm import tqdm
+
+
+# upper limit for the memory (in bytes) of a matrix panel that is held in memory during out-of-core operations
+default_tile_memory = 2**28
+
+
+def matrix_file(shape, dtype=complex, filename=None, directory=None):
+    """Create a memory-mapped matrix in Fortran order.
+
+    Args:
+        shape (tuple):              Shape of the matrix
+        dtype (numpy.dtype):        Data type
+        filename (str or None):     Path of the .npy file. If None, a temporary file is created in directory and
+                                    removed from the file system as soon as the memory map is closed
+        directory (str or None):    Directory of the temporary file. If None, use the default temporary directory
+
+    Returns:
+        numpy.memmap
+    """
+    if filename is not None:
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+    file_descriptor, filename = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(file_descriptor)
+    matrix = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+    try:
+        os.remove(filename)  # the mapped data remains accessible until the memory map is closed
+    except OSError:          # not possible on all platforms
+        pass
+    return matrix
+
+
+def panel_width(number_rows, dtype=complex, tile_memory=None):
+    """Number of matrix columns that fit into the tile memory.
+
+    Args:
+        number_rows (int):          Number of matrix rows
+        dtype (numpy.dtype):        Data type
+        tile_memory (int or None):  Memory per panel in bytes. If None, use default_tile_memory
+
+    Returns:
+        panel width (int), at least 1
+    """
+    if tile_memory is None:
+        tile_memory = default_tile_memory
+    return max(1, int(tile_memory // (number_rows * np.dtype(dtype).itemsize)))
+
+
+def tiled_matmat(matrix, in_block, panel_width):
+    """Multiply a memory-mapped matrix to a vector or a block of vectors, reading one column panel at a time.
+
+    Args:
+        matrix (numpy.ndarray):     Matrix in Fortran order
+        in_block (numpy.ndarray):   Vector or array of shape [number of columns, number of vectors]
+        panel_width (int):          Number of columns per panel
+
+    Returns:
+        matrix times in_block
+    """
+    in_block = np.asarray(in_block)
+    result = np.zeros((matrix.shape[0],) + in_block.shape[1:], dtype=np.result_type(matrix.dtype, in_block.dtype))
+    for start in range(0, matrix.shape[1], panel_width):
+        result += matrix[:, start:start + panel_width].dot(in_block[start:start + panel_width])
+    return result
+
+
+def swap_rows(block, piv, first_pivot, first_row):
+    """Apply a sequence of row interchanges in place.
+
+    Args:
+        block (numpy.ndarray):  Array whose first row is the global row first_row
+        piv (numpy.ndarray):    Global pivot rows, i.e., the global row first_pivot + k is interchanged with piv[k]
+        first_pivot (int):      Global row of the first interchange
+        first_row (int):        Global row of the first row of block
+    """
+    for k, p in enumerate(piv):
+        i = first_pivot + k
+        if not p == i:
+            block[[i - first_row, p - first_row]] = block[[p - first_row, i - first_row]]
+
+
+def tiled_lu_factor(matrix, panel_width):
+    """LU factorization with partial pivoting of a memory-mapped matrix in place, one column panel at a time. Each
+    panel is loaded, updated with the previous panels (left-looking), factorized and written back. The row interchanges
+    of later panels are not applied to the stored L factors of earlier panels, which avoids strided writes to the file.
+    They are accounted for in tiled_lu_solve.
+
+    Args:
+        matrix (numpy.ndarray): Square matrix in Fortran order, e.g. from matrix_file. Is overwritten by the factors
+        panel_width (int):      Number of columns per panel
+
+    Returns:
+        pivot indices (numpy.ndarray): row i was interchanged with row piv[i]
+    """
+    n = matrix.shape[0]
+    piv = np.arange(n)
+    getrf, = scipy.linalg.get_lapack_funcs(('getrf',), (matrix[:1, :1],))
+    for c0 in tqdm(range(0, n, panel_width), desc='Out-of-core LU            ', file=sys.stdout,
+                   bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+        c1 = min(c0 + panel_width, n)
+        panel = np.array(matrix[:, c0:c1])
+        swap_rows(panel, piv[:c0], 0, 0)
+        for j0 in range(0, c0, panel_width):
+            j1 = j0 + panel_width
+            lower = np.array(matrix[j0:, j0:j1])
+            swap_rows(lower, piv[j1:c0], j1, j0)
+            panel[j0:j1] = scipy.linalg.solve_triangular(lower[:j1 - j0], panel[j0:j1], lower=True,
+                                                         unit_diagonal=True)
+            panel[j1:] -= lower[j1 - j0:].dot(panel[j0:j1])
+        lu, panel_piv, info = getrf(panel[c0:])
+        if info > 0:
+            warnings.warn('Diagonal number %i is exactly zero. Singular matrix.' % (c0 + info))
+        panel[c0:] = lu
+        piv[c0:c1] = panel_piv[:c1 - c0] + c0
+        matrix[:, c0:c1] = panel
+    if isinstance(matrix, np.memmap):
+        matrix.flush()
+    return piv
+
+
+def tiled_lu_solve(lu, piv, rhs, panel_width):
+    """Solve a linear system with the factorization from tiled_lu_factor, reading one column panel of the factors at a
+    time for the forward and for the backward substitution.
+
+    Args:
+        lu (numpy.ndarray):     LU factors as computed by tiled_lu_factor
+        piv (numpy.ndarray):    Pivot indices as returned by tiled_lu_factor
+        rhs (numpy.ndarray):    Right hand side, a vector or an array of shape [number of unknowns, number of vectors]
+        panel_width (int):      Number of columns per panel, the same as for the factorization
+
+    Returns:
+        solution of the same shape as rhs
+    """
+    n = lu.shape[0]
+    rhs = np.asarray(rhs)
+    y = np.array(rhs, dtype=np.result_type(lu.dtype, rhs.dtype))
+    swap_rows(y, piv, 0, 0)
+    for j0 in range(0, n, panel_width):
+        j1 = min(j0 + panel_width, n)
+        lower = np.array(lu[j0:, j0:j1])
+        swap_rows(lower, piv[j1:], j1, j0)
+        y[j0:j1] = scipy.linalg.solve_triangular(lower[:j1 - j0], y[j0:j1], lower=True, unit_diagonal=True)
+        y[j1:] -= lower[j1 - j0:].dot(y[j0:j1])
+    for j0 in reversed(range(0, n, panel_width)):
+        j1 = min(j0 + panel_width, n)
+        upper = np.array(lu[:j1, j0:j1])
+        y[j0:j1] = scipy.linalg.solve_triangular(upper[j0:j1], y[j0:j1], lower=False)
+        y[:j0] -= upper[:j0].dot(y[j0:j1])
+    return y
@@ -3,20 +3,25 @@
 coupling matrix entries. The second half of the module contains functions for the preparation of lookup tables that 
 are used to approximate the coupling matrices by interoplation."""
 
-from numba import complex128,int64,jit
 from scipy.signal.filter_design import bessel
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+import itertools
 import numpy as np
 import scipy.interpolate
+import scipy.spatial
 import scipy.special
 import smuthi.coordinates as coord
 import smuthi.cuda_sources as cu
+import smuthi.disk_cache as dc
 import smuthi.field_expansion as fldex
 import smuthi.layers as lay
+import smuthi.memoizing as memo
+import smuthi.particles as part
 import smuthi.spherical_functions as sf
 import smuthi.vector_wave_functions as vwf
 import sys
+import warnings
 try:
     import pycuda.autoinit
     import pycuda.driver as drv
@@ -26,37 +31,174 @@ try:
 except:
     pass
 
+# If True, the explicit coupling matrix and the coupling lookup tables are computed for one half of the particle pairs
+# (or of the multipole index pairs) and completed with the reciprocity relation, see reciprocal_block. If 'validate',
+# the reciprocity relation is in addition checked numerically for a few random particle pairs, see validate_reciprocity.
+use_reciprocity = False
+
+# relative deviation from the reciprocity relation above which validate_reciprocity issues a warning
+reciprocity_tolerance = 1e-6
+
+
+@memo.memoize(max_bytes=2**28, max_entries=None)
+def transformation_coefficient_array(k, kz, k_parallel, l_max, m_max, dagger):
+    """Transformation coefficients between spherical and plane vector wave functions for all multipole indices, plane
+    wave propagation directions (upwards/downwards) and polarizations.
+
+    Args:
+        k (float or complex):   Wavenumber in the layer
+        kz (numpy.ndarray):     z-component of the wavevector for each in-plane wavenumber
+        k_parallel (numpy.ndarray):     In-plane wavenumbers
+        l_max (int):            Maximal multipole degree
+        m_max (int):            Maximal multipole order
+        dagger (bool):          If True, the coefficients of the inverse transformation are returned
+
+    Returns:
+        Array of shape (2, 2, blocksize, len(k_parallel)). Indices are polarization, plus/minus, n, kpar_idx
+    """
+    B = np.zeros((2, 2, fldex.blocksize(l_max, m_max), len(k_parallel)), dtype=complex)
+    ct = kz / k
+    st = k_parallel / k
+    _, pilm_list_pl, taulm_list_pl = sf.legendre_normalized(ct, st, l_max)
+    _, pilm_list_mn, taulm_list_mn = sf.legendre_normalized(-ct, st, l_max)
+    pilm = (pilm_list_pl, pilm_list_mn)
+    taulm = (taulm_list_pl, taulm_list_mn)
+    for tau in range(2):
+        for m in range(-m_max, m_max + 1):
+            for l in range(max(1, abs(m)), l_max + 1):
+                n = fldex.multi_to_single_index(tau, l, m, l_max, m_max)
+                for iplmn in range(2):
+                    for pol in range(2):
+                        B[pol, iplmn, n, :] = vwf.transformation_coefficients_vwf(tau, l, m, pol, pilm_list=pilm[iplmn],
+                                                                                  taulm_list=taulm[iplmn],
+                                                                                  dagger=dagger)
+    return B
+
+
+def trapezoidal_weights(x):
+    """Weights w such that sum(w * y) is the trapezoidal rule approximation to the integral of y over x.
+
+    Args:
+        x (numpy.ndarray):  Integration nodes (can be complex)
+
+    Returns:
+        Array of weights with the same length as x
+    """
+    dx = np.diff(x)
+    weights = np.zeros(len(x), dtype=dx.dtype)
+    weights[:-1] += dx / 2
+    weights[1:] += dx / 2
+    return weights
+
+
+def layer_mediated_coupling_block_list(vacuum_wavelength, receiving_particles, emitting_particles, layer_system,
+                                       k_parallel='default'):
+    r"""Layer-system mediated particle coupling matrix blocks :math:`W^R` for many particle pairs.
+
+    The pairs are grouped by the layers and z-positions of the particles and by the multipole cutoffs. For each group,
+    the layer response, the plane wave transformation coefficients and the phase factors are computed once. The
+    Bessel functions are evaluated once per unique in-plane distance and the Sommerfeld integrals of all pairs in the
+    group are evaluated as matrix products over the in-plane wavenumbers (trapezoidal rule).
+
+    Args:
+        vacuum_wavelength (float):      Vacuum wavelength :math:`\lambda` (length unit)
+        receiving_particles (list):     Particles that receive the scattered field, one per pair
+        emitting_particles (list):      Particles that emit the scattered field, one per pair
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium in which the coupling takes place
+        k_parallel (numpy ndarray):     In-plane wavenumbers for Sommerfeld integral
+                                        If 'default', use smuthi.coordinates.default_k_parallel
+
+    Returns:
+        List of layer mediated coupling matrix blocks as numpy arrays, one per pair
+    """
+    if type(k_parallel) == str and k_parallel == 'default':
+        k_parallel = coord.default_k_parallel
+    k_parallel = np.asarray(k_parallel)
+    omega = coord.angular_frequency(vacuum_wavelength)
+    blocks = [None for rp in receiving_particles]
+
+    groups = {}
+    for ipair, (rp, ep) in enumerate(zip(receiving_particles, emitting_particles)):
+        is1 = layer_system.layer_number(rp.position[2])
+        is2 = layer_system.layer_number(ep.position[2])
+        key = (is1, is2, rp.position[2], ep.position[2], rp.l_max, rp.m_max, ep.l_max, ep.m_max)
+        groups.setdefault(key, []).append(ipair)
+
+    for (is1, is2, z1, z2, lmax1, mmax1, lmax2, mmax2), pair_indices in groups.items():
+        blocksize1 = fldex.blocksize(lmax1, mmax1)
+        blocksize2 = fldex.blocksize(lmax2, mmax2)
+        ziss1 = z1 - layer_system.reference_z(is1)
+        ziss2 = z2 - layer_system.reference_z(is2)
+
+        # wave numbers
+        kis1 = omega * layer_system.refractive_indices[is1]
+        kis2 = omega * layer_system.refractive_indices[is2]
+        kzis1 = coord.k_z(k_parallel=k_parallel, k=kis1)
+        kzis2 = coord.k_z(k_parallel=k_parallel, k=kis2)
+
+        # phase factors
+        ejkz = np.zeros((2, 2, len(k_parallel)), dtype=complex)  # indices are: particle, plus/minus, kpar_idx
+        ejkz[0, 0, :] = np.exp(1j * kzis1 * ziss1)
+        ejkz[0, 1, :] = np.exp(- 1j * kzis1 * ziss1)
+        ejkz[1, 0, :] = np.exp(1j * kzis2 * ziss2)
+        ejkz[1, 1, :] = np.exp(- 1j * kzis2 * ziss2)
+
+        # layer response
+        L = np.zeros((2, 2, 2, len(k_parallel)), dtype=complex)  # polarization, pl/mn1, pl/mn2, kpar_idx
+        for pol in range(2):
+            L[pol, :, :, :] = lay.layersystem_response_matrix(pol, layer_system.thicknesses,
+                                                              layer_system.refractive_indices, k_parallel, omega, is2,
+                                                              is1)
+
+        # transformation coefficients, indices are: pol, plus/minus, n, kpar_idx
+        B1 = transformation_coefficient_array(kis1, kzis1, k_parallel, lmax1, mmax1, dagger=True)
+        B2 = transformation_coefficient_array(kis2, kzis2, k_parallel, lmax2, mmax2, dagger=False)
+
+        # BeL[pol, plmn2, n1, kpar_idx] and eB[pol, plmn2, n2, kpar_idx], such that the integrand of the (n1, n2) entry
+        # is sum over pol and plmn2 of BeL[pol, plmn2, n1, :] * eB[pol, plmn2, n2, :]
+        BeL = np.einsum('pijk,pink,ik->pjnk', L, B1, ejkz[0])
+        eB = B2 * ejkz[1, ::-1, :][None, :, None, :]
+
+        # cylindrical coordinates of relative position vectors
+        rs1 = np.array([receiving_particles[ipair].position for ipair in pair_indices], dtype=float)
+        rs2 = np.array([emitting_particles[ipair].position for ipair in pair_indices], dtype=float)
+        rs2s1 = rs1 - rs2
+        rhos2s1 = np.sqrt(rs2s1[:, 0]**2 + rs2s1[:, 1]**2)
+        phis2s1 = np.arctan2(rs2s1[:, 1], rs2s1[:, 0])
+        unique_rho, rho_inverse = np.unique(rhos2s1, return_inverse=True)
+
+        # jacobi factor and integration weights
+        weights = k_parallel / (kzis2 * kis2) * trapezoidal_weights(k_parallel)
+
+        m1 = block_m_array(lmax1, mmax1)
+        m2 = block_m_array(lmax2, mmax2)
+        m2_minus_m1 = m2[None, :] - m1[:, None]
+        abs_dm_flat = abs(m2_minus_m1).ravel()
+        integral = np.zeros((len(pair_indices), blocksize1 * blocksize2), dtype=complex)
+        chunksize = max(1, 2**20 // len(k_parallel))
+        for dm in np.unique(abs_dm_flat):
+            bessel_weights = scipy.special.jv(dm, k_parallel[None, :] * unique_rho[:, None]) * weights[None, :]
+            flat_indices = np.where(abs_dm_flat == dm)[0]
+            for i_chunk in range(0, len(flat_indices), chunksize):
+                chunk = flat_indices[i_chunk:i_chunk + chunksize]
+                n1, n2 = chunk // blocksize2, chunk % blocksize2
+                BeLBe = np.einsum('pjrk,pjrk->rk', BeL[:, :, n1, :], eB[:, :, n2, :])
+                integral[:, chunk] = np.dot(bessel_weights, BeLBe.T)[rho_inverse, :]
+
+        wr_const = 4 * (1j) ** abs(m2_minus_m1[None, :, :]) * np.exp(1j * m2_minus_m1[None, :, :]
+                                                                      * phis2s1[:, None, None])
+        wr = wr_const * integral.reshape((len(pair_indices), blocksize1, blocksize2))
+        for i, ipair in enumerate(pair_indices):
+            blocks[ipair] = wr[i]
+
+    return blocks
 
-@jit(complex128(complex128[:], complex128[:]),
-     nopython=True, cache=True, nogil=True)
-def numba_trapz(y, x):
-    out = 0.0 + 0.0j
-    #TODO implement some (optional) advanced summation?
-    #e.g. https://github.com/nschloe/accupy/blob/master/accupy/sums.py
-    #or better Sum2  from https://doi.org/10.1137/030601818 (Algorithm 4.4)
-    #Note, that this may need to have exact summation for x and y, and exact product.
-    for i in range( len(y) - 2 ):
-        out += (x[i+1]-x[i]) * (y[i+1] + y[i])/2.0
-    return out
-
-
-@jit((complex128[:], complex128[:,:,:],
-      complex128[:,:,:,:],complex128[:,:,:], int64),
-     nopython=True,cache=True
-     ,nogil=True
-     # , parallel=True
-)
-def eval_BeLBe(BeLBe, BeL, B1, ejkz, n2):
-    for k in range(len(BeLBe)):
-        for iplmn2 in range(2):
-            for pol in range(2):
-                BeLBe[k] += BeL[pol, iplmn2, k] * B1[pol, iplmn2, n2, k
-                                     ] * ejkz[1, 1 - iplmn2, k]
-        
 
 def layer_mediated_coupling_block(vacuum_wavelength, receiving_particle, emitting_particle, layer_system,
                                   k_parallel='default', show_integrand=False):
-    """Layer-system mediated particle coupling matrix :math:`W^R` for two particles. This routine is explicit, but slow.
+    r"""Layer-system mediated particle coupling matrix :math:`W^R` for two particles, evaluated with
+    layer_mediated_coupling_block_list for the single pair. To compute many blocks, pass all pairs to
+    layer_mediated_coupling_block_list at once.
 
     Args:
         vacuum_wavelength (float):                          Vacuum wavelength :math:`\lambda` (length unit)
@@ -65,121 +207,13 @@ def layer_mediated_coupling_block(vacuum_wavelength, receiving_particle, emittin
         layer_system (smuthi.layers.LayerSystem):           Stratified medium in which the coupling takes place
         k_parallel (numpy ndarray):                         In-plane wavenumbers for Sommerfeld integral
                                                             If 'default', use smuthi.coordinates.default_k_parallel
-        show_integrand (bool):                              If True, the norm of the integrand is plotted.
+        show_integrand (bool):                              Accepted for backwards compatibility, but ignored.
 
     Returns:
         Layer mediated coupling matrix block as numpy array.
     """
-    if type(k_parallel) == str and k_parallel == 'default':
-        k_parallel = coord.default_k_parallel
-       
-    omega = coord.angular_frequency(vacuum_wavelength)
-
-    # index specs
-    lmax1 = receiving_particle.l_max
-    mmax1 = receiving_particle.m_max
-    lmax2 = emitting_particle.l_max
-    mmax2 = emitting_particle.m_max
-    blocksize1 = fldex.blocksize(lmax1, mmax1)
-    blocksize2 = fldex.blocksize(lmax2, mmax2)
-
-    # cylindrical coordinates of relative position vectors
-    rs1 = np.array(receiving_particle.position)
-    rs2 = np.array(emitting_particle.position)
-    rs2s1 = rs1 - rs2
-    rhos2s1 = np.linalg.norm(rs2s1[0:2])
-    phis2s1 = np.arctan2(rs2s1[1], rs2s1[0])
-    is1 = layer_system.layer_number(rs1[2])
-    ziss1 = rs1[2] - layer_system.reference_z(is1)
-    is2 = layer_system.layer_number(rs2[2])
-    ziss2 = rs2[2] - layer_system.reference_z(is2)
-
-    # wave numbers
-    kis1 = omega * layer_system.refractive_indices[is1]
-    kis2 = omega * layer_system.refractive_indices[is2]
-    kzis1 = coord.k_z(k_parallel=k_parallel, k=kis1)
-    kzis2 = coord.k_z(k_parallel=k_parallel, k=kis2)
-
-    # phase factors
-    ejkz = np.zeros((2, 2, len(k_parallel)), dtype=complex)  # indices are: particle, plus/minus, kpar_idx
-    ejkz[0, 0, :] = np.exp(1j * kzis1 * ziss1)
-    ejkz[0, 1, :] = np.exp(- 1j * kzis1 * ziss1)
-    ejkz[1, 0, :] = np.exp(1j * kzis2 * ziss2)
-    ejkz[1, 1, :] = np.exp(- 1j * kzis2 * ziss2)
-
-    # layer response
-    L = np.zeros((2, 2, 2, len(k_parallel)), dtype=complex)  # polarization, pl/mn1, pl/mn2, kpar_idx
-    for pol in range(2):
-        L[pol, :, :, :] = lay.layersystem_response_matrix(pol, layer_system.thicknesses,
-                                                          layer_system.refractive_indices, k_parallel, omega, is2, is1)
-
-    # transformation coefficients
-    B = [np.zeros((2, 2, blocksize1, len(k_parallel)), dtype=complex),
-         np.zeros((2, 2, blocksize2, len(k_parallel)), dtype=complex)]
-    # list index: particle, np indices: pol, plus/minus, n, kpar_idx
-
-    m_vec = [np.zeros(blocksize1, dtype=int), np.zeros(blocksize2, dtype=int)]
-   
-    # precompute spherical functions
-    ct = kzis1 / kis1
-    st = k_parallel / kis1
-    _, pilm_list_pl, taulm_list_pl = sf.legendre_normalized(ct, st, lmax1)
-    _, pilm_list_mn, taulm_list_mn = sf.legendre_normalized(-ct, st, lmax1)
-    pilm = (pilm_list_pl, pilm_list_mn)
-    taulm = (taulm_list_pl, taulm_list_mn)
-   
-    for tau in range(2):
-        for m in range(-mmax1, mmax1 + 1):
-            for l in range(max(1, abs(m)), lmax1 + 1):
-                n = fldex.multi_to_single_index(tau, l, m, lmax1, mmax1)
-                m_vec[0][n] = m
-                for iplmn in range(2):
-                    for pol in range(2):
-                        B[0][pol, iplmn, n, :] = vwf.transformation_coefficients_vwf(tau, l, m, pol, pilm_list=pilm[iplmn],
-                                                                                     taulm_list=taulm[iplmn], dagger=True)
-   
-    ct = kzis2 / kis2
-    st = k_parallel / kis2
-    _, pilm_list_pl, taulm_list_pl = sf.legendre_normalized(ct, st, lmax2)
-    _, pilm_list_mn, taulm_list_mn = sf.legendre_normalized(-ct, st, lmax2)
-    pilm = (pilm_list_pl, pilm_list_mn)
-    taulm = (taulm_list_pl, taulm_list_mn)
-                       
-    for tau in range(2):
-        for m in range(-mmax2, mmax2 + 1):
-            for l in range(max(1, abs(m)), lmax2 + 1):
-                n = fldex.multi_to_single_index(tau, l, m, lmax2, mmax2)
-                m_vec[1][n] = m
-                for iplmn in range(2):
-                    for pol in range(2):
-                        B[1][pol, iplmn, n, :] = vwf.transformation_coefficients_vwf(tau, l, m, pol, pilm_list=pilm[iplmn],
-                                                                                     taulm_list=taulm[iplmn], dagger=False)
-
-    # bessel function and jacobi factor
-    bessel_list = []
-    for dm in range(lmax1 + lmax2 + 1):
-        bessel_list.append(scipy.special.jv(dm, k_parallel * rhos2s1))
-    jacobi_vector = k_parallel / (kzis2 * kis2)
-    m2_minus_m1 = m_vec[1] - m_vec[0][np.newaxis].T
-    wr_const = 4 * (1j) ** abs(m2_minus_m1) * np.exp(1j * m2_minus_m1 * phis2s1) 
-
-    integral = np.zeros((blocksize1, blocksize2), dtype=complex) 
-    for n1 in range(blocksize1):
-        BeL = np.zeros((2, 2, len(k_parallel)), dtype=complex)  # indices are: pol, plmn2, n1, kpar_idx
-        for iplmn1 in range(2):
-            for pol in range(2):
-                BeL[pol, :, :] += (L[pol, iplmn1, :, :]
-                                        * B[0][pol, iplmn1, n1, :]
-                                        * ejkz[0, iplmn1, :])
-        for n2 in range(blocksize2):
-            bessel_full = bessel_list[abs(m_vec[0][n1] - m_vec[1][n2])]
-            BeLBe = np.zeros((len(k_parallel)), dtype=complex)
-            eval_BeLBe(BeLBe, BeL, B[1], ejkz, n2)
-            integrand = bessel_full * jacobi_vector * BeLBe
-            integral[n1,n2] = numba_trapz(integrand, k_parallel)
-    wr = wr_const * integral
-
-    return wr
+    return layer_mediated_coupling_block_list(vacuum_wavelength, [receiving_particle], [emitting_particle],
+                                              layer_system, k_parallel)[0]
 
 
 def layer_mediated_coupling_matrix(vacuum_wavelength, particle_list, layer_system, k_parallel='default'):
@@ -198,87 +232,335 @@ def layer_mediated_coupling_matrix(vacuum_wavelength, particle_list, layer_syste
    
     # indices
     blocksizes = [fldex.blocksize(particle.l_max, particle.m_max) for particle in particle_list]
+    offsets = np.concatenate([[0], np.cumsum(blocksizes, dtype=int)])
 
     # initialize result
-    wr = np.zeros((sum(blocksizes), sum(blocksizes)), dtype=complex)
+    wr = np.zeros((offsets[-1], offsets[-1]), dtype=complex)
 
+    # one block row per receiving particle, such that the intermediate arrays scale with the number of particles
     for s1, particle1 in enumerate(particle_list):
-        idx1 = np.array(range(sum(blocksizes[:s1]), sum(blocksizes[:s1]) + blocksizes[s1]))
-        for s2, particle2 in enumerate(particle_list):
-            idx2 = range(sum(blocksizes[:s2]), sum(blocksizes[:s2]) + blocksizes[s2])
-            wr[idx1[:, None], idx2] = layer_mediated_coupling_block(vacuum_wavelength, particle1, particle2,
-                                                                    layer_system, k_parallel)
+        blocks = layer_mediated_coupling_block_list(vacuum_wavelength, [particle1] * len(particle_list), particle_list,
+                                                    layer_system, k_parallel)
+        for s2, block in enumerate(blocks):
+            wr[offsets[s1]:offsets[s1 + 1], offsets[s2]:offsets[s2 + 1]] = block
 
     return wr
 
 
-def direct_coupling_block(vacuum_wavelength, receiving_particle, emitting_particle, layer_system):
-    """Direct particle coupling matrix :math:`W` for two particles. This routine is explicit, but slow.
+@memo.memoize(max_bytes=2**28, max_entries=None)
+def translation_coefficient_tensor(l_max1, m_max1, l_max2, m_max2):
+    """Precomputed a5 and b5 coefficients of the direct coupling operator, arranged such that a coupling block can be
+    evaluated by a matrix product with the spherical Hankel and Legendre functions.
+
+    The direct coupling block entry (n1, n2) is the sum over ld of a5 * h_ld * P_ld^|m1-m2| (if tau1==tau2, b5 otherwise)
+    where (a5, b5) = ab5_coefficients(l2, m2, l1, m1, ld). The coefficients are grouped by dm=|m1-m2|.
 
     Args:
-        vacuum_wavelength (float):                          Vacuum wavelength :math:`\lambda` (length unit)
-        receiving_particle (smuthi.particles.Particle):     Particle that receives the scattered field
-        emitting_particle (smuthi.particles.Particle):      Particle that emits the scattered field
-        layer_system (smuthi.layers.LayerSystem):           Stratified medium in which the coupling takes place
+        l_max1 (int):   Maximal multipole degree of the receiving particle
+        m_max1 (int):   Maximal multipole order of the receiving particle
+        l_max2 (int):   Maximal multipole degree of the emitting particle
+        m_max2 (int):   Maximal multipole order of the emitting particle
 
     Returns:
-        Direct coupling matrix block as numpy array.
+        List with one entry per dm=0,...,m_max1+m_max2. Each entry is a tuple (indices, coefficients) where indices is
+        an integer array of the flattened block indices n1 * blocksize2 + n2 with abs(m1-m2)=dm and coefficients is a
+        complex array of shape (l_max1 + l_max2 + 1 - dm, len(indices)) with the coefficients for ld=dm,...,l_max1+l_max2
     """
-    omega = coord.angular_frequency(vacuum_wavelength)
+    ld_max = l_max1 + l_max2
+    blocksize2 = fldex.blocksize(l_max2, m_max2)
+    indices = [[] for dm in range(m_max1 + m_max2 + 1)]
+    coefficients = [[] for dm in range(m_max1 + m_max2 + 1)]
+    for tau1 in range(2):
+        for m1 in range(-m_max1, m_max1 + 1):
+            for l1 in range(max(1, abs(m1)), l_max1 + 1):
+                n1 = fldex.multi_to_single_index(tau1, l1, m1, l_max1, m_max1)
+                for tau2 in range(2):
+                    for m2 in range(-m_max2, m_max2 + 1):
+                        for l2 in range(max(1, abs(m2)), l_max2 + 1):
+                            n2 = fldex.multi_to_single_index(tau2, l2, m2, l_max2, m_max2)
+                            dm = abs(m1 - m2)
+                            coefficient_column = np.zeros(ld_max + 1 - dm, dtype=complex)
+                            # if ld<abs(m1-m2) then P=0
+                            for ld in range(max(abs(l1 - l2), dm), l1 + l2 + 1):
+                                # the particle coupling operator is the transpose of the SVWF translation operator
+                                # therefore, (l1,m1) and (l2,m2) are interchanged:
+                                a5, b5 = vwf.ab5_coefficients(l2, m2, l1, m1, ld)
+                                coefficient_column[ld - dm] = complex(a5 if tau1 == tau2 else b5)
+                            indices[dm].append(n1 * blocksize2 + n2)
+                            coefficients[dm].append(coefficient_column)
+    return [(np.array(indices[dm], dtype=int), np.array(coefficients[dm], dtype=complex).reshape(-1, ld_max + 1 - dm).T)
+            for dm in range(m_max1 + m_max2 + 1)]
+
+
+def direct_coupling_kernel(k, distance, cos_theta, sin_theta, l_max1, m_max1, l_max2, m_max2, regular=False):
+    """Direct coupling matrix blocks without the azimuthal phase factor exp(1j * (m2 - m1) * phi), evaluated for arrays
+    of relative positions at once.
+
+    With regular=True, the spherical Hankel functions are replaced by spherical Bessel functions. The result is then the
+    (transposed) translation operator from outgoing to outgoing or from regular to regular spherical waves, as used by
+    the multipole to multipole and local to local translations of the fast multipole method (see smuthi.fmm).
 
-    # index specs
-    lmax1 = receiving_particle.l_max
-    mmax1 = receiving_particle.m_max
-    lmax2 = emitting_particle.l_max
-    mmax2 = emitting_particle.m_max
-    blocksize1 = fldex.blocksize(lmax1, mmax1)
-    blocksize2 = fldex.blocksize(lmax2, mmax2)
+    Args:
+        k (float or complex):       Wavenumber in the layer that contains both particles
+        distance (ndarray):         Distances between receiving and emitting particle (length unit)
+        cos_theta (ndarray):        Cosine of polar angle of the relative position (same shape as distance)
+        sin_theta (ndarray):        Sine of polar angle of the relative position (same shape as distance)
+        l_max1 (int):               Maximal multipole degree of the receiving particle
+        m_max1 (int):               Maximal multipole order of the receiving particle
+        l_max2 (int):               Maximal multipole degree of the emitting particle
+        m_max2 (int):               Maximal multipole order of the emitting particle
+        regular (bool):             If True, use spherical Bessel instead of spherical Hankel functions
 
-    # initialize result
-    w = np.zeros((blocksize1, blocksize2), dtype=complex)
+    Returns:
+        Array of shape distance.shape + (blocksize1, blocksize2)
+    """
+    distance = np.asarray(distance)
+    ld_max = l_max1 + l_max2
+    blocksize1 = fldex.blocksize(l_max1, m_max1)
+    blocksize2 = fldex.blocksize(l_max2, m_max2)
+    if regular:
+        bessel_h = [sf.spherical_bessel(ld, k * distance) for ld in range(ld_max + 1)]
+    else:
+        bessel_h = [sf.spherical_hankel(ld, k * distance) for ld in range(ld_max + 1)]
+    legendre, _, _ = sf.legendre_normalized(np.asarray(cos_theta), np.asarray(sin_theta), ld_max)
+
+    w = np.zeros((distance.size, blocksize1 * blocksize2), dtype=complex)
+    for dm, (indices, coefficients) in enumerate(translation_coefficient_tensor(l_max1, m_max1, l_max2, m_max2)):
+        hankel_legendre = np.array([(bessel_h[ld] * legendre[ld][dm]).ravel() for ld in range(dm, ld_max + 1)])
+        w[:, indices] = np.dot(hankel_legendre.T, coefficients)
+    return w.reshape(distance.shape + (blocksize1, blocksize2))
 
-    # check if particles are in same layer
-    rS1 = receiving_particle.position
-    rS2 = emitting_particle.position
-    iS1 = layer_system.layer_number(rS1[2])
-    iS2 = layer_system.layer_number(rS2[2])
-    if iS1 == iS2 and not emitting_particle == receiving_particle:
-        k = omega * layer_system.refractive_indices[iS1]
-        dx = rS1[0] - rS2[0]
-        dy = rS1[1] - rS2[1]
-        dz = rS1[2] - rS2[2]
+
+def direct_coupling_block_list(vacuum_wavelength, receiving_particles, emitting_particles, layer_system):
+    r"""Direct particle coupling matrix blocks :math:`W` for many particle pairs. Pairs with the same multipole cutoffs
+    in the same layer are evaluated together.
+
+    Args:
+        vacuum_wavelength (float):      Vacuum wavelength :math:`\lambda` (length unit)
+        receiving_particles (list):     Particles that receive the scattered field, one per pair
+        emitting_particles (list):      Particles that emit the scattered field, one per pair
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium in which the coupling takes place
+
+    Returns:
+        List of direct coupling matrix blocks as numpy arrays, one per pair
+    """
+    omega = coord.angular_frequency(vacuum_wavelength)
+    blocks = [np.zeros((fldex.blocksize(rp.l_max, rp.m_max), fldex.blocksize(ep.l_max, ep.m_max)), dtype=complex)
+              for rp, ep in zip(receiving_particles, emitting_particles)]
+
+    # group the pairs of distinct particles in the same layer by layer number and multipole cutoffs
+    groups = {}
+    for ipair, (rp, ep) in enumerate(zip(receiving_particles, emitting_particles)):
+        iS1 = layer_system.layer_number(rp.position[2])
+        iS2 = layer_system.layer_number(ep.position[2])
+        if iS1 == iS2 and not ep == rp:
+            groups.setdefault((iS1, rp.l_max, rp.m_max, ep.l_max, ep.m_max), []).append(ipair)
+
+    for (iS, lmax1, mmax1, lmax2, mmax2), pair_indices in groups.items():
+        k = omega * layer_system.refractive_indices[iS]
+        rS1 = np.array([receiving_particles[ipair].position for ipair in pair_indices], dtype=float)
+        rS2 = np.array([emitting_particles[ipair].position for ipair in pair_indices], dtype=float)
+        dx, dy, dz = (rS1 - rS2).T
         d = np.sqrt(dx**2 + dy**2 + dz**2)
         cos_theta = dz / d
         sin_theta = np.sqrt(dx**2 + dy**2) / d
         phi = np.arctan2(dy, dx)
 
-        # spherical functions
-        bessel_h = [sf.spherical_hankel(n, k * d) for n in range(lmax1 + lmax2 + 1)]
-        legendre, _, _ = sf.legendre_normalized(cos_theta, sin_theta, lmax1 + lmax2)
-        
-        # the particle coupling operator is the transpose of the SVWF translation operator
-        # therefore, (l1,m1) and (l2,m2) are interchanged:
-        for m1 in range(-mmax1, mmax1 + 1):
-            for m2 in range(-mmax2, mmax2 + 1):
-                eimph = np.exp(1j * (m2 - m1) * phi)
-                for l1 in range(max(1, abs(m1)), lmax1 + 1):
-                    for l2 in range(max(1, abs(m2)), lmax2 + 1):
-                        A, B = complex(0), complex(0)
-                        for ld in range(max(abs(l1 - l2), abs(m1 - m2)), l1 + l2 + 1):  # if ld<abs(m1-m2) then P=0
-                            a5, b5 = vwf.ab5_coefficients(l2, m2, l1, m1, ld)
-                            A += a5 * bessel_h[ld] * legendre[ld][abs(m1 - m2)]
-                            B += b5 * bessel_h[ld] * legendre[ld][abs(m1 - m2)]
-                        A, B = eimph * A, eimph * B
-                        for tau1 in range(2):
-                            n1 = fldex.multi_to_single_index(tau1, l1, m1, lmax1, mmax1)
-                            for tau2 in range(2):
-                                n2 = fldex.multi_to_single_index(tau2, l2, m2, lmax2, mmax2)
-                                if tau1 == tau2:
-                                    w[n1, n2] = A
-                                else:
-                                    w[n1, n2] = B
+        m1 = block_m_array(lmax1, mmax1)
+        m2 = block_m_array(lmax2, mmax2)
+        eimph = np.exp(1j * (m2[None, None, :] - m1[None, :, None]) * phi[:, None, None])
+        w = direct_coupling_kernel(k, d, cos_theta, sin_theta, lmax1, mmax1, lmax2, mmax2) * eimph
+        for i, ipair in enumerate(pair_indices):
+            blocks[ipair] = w[i]
 
-    return w
+    return blocks
+
+
+@memo.memoize(max_bytes=2**24, max_entries=None)
+def block_multi_indices(l_max, m_max):
+    """Multipole indices for each single index n of a particle block, in the order of
+    smuthi.field_expansion.multi_to_single_index.
+
+    Args:
+        l_max (int):    Maximal multipole degree
+        m_max (int):    Maximal multipole order
+
+    Returns:
+        Integer arrays tau, l, m of length blocksize(l_max, m_max)
+    """
+    size = fldex.blocksize(l_max, m_max)
+    tau_array, l_array, m_array = np.zeros(size, dtype=int), np.zeros(size, dtype=int), np.zeros(size, dtype=int)
+    for tau in range(2):
+        for m in range(-m_max, m_max + 1):
+            for l in range(max(1, abs(m)), l_max + 1):
+                n = fldex.multi_to_single_index(tau, l, m, l_max, m_max)
+                tau_array[n], l_array[n], m_array[n] = tau, l, m
+    return tau_array, l_array, m_array
+
+
+def block_m_array(l_max, m_max):
+    """Multipole order m for each single index n of a coupling matrix block.
+
+    Args:
+        l_max (int):    Maximal multipole degree
+        m_max (int):    Maximal multipole order
+
+    Returns:
+        Integer array of length blocksize(l_max, m_max)
+    """
+    return block_multi_indices(l_max, m_max)[2]
+
+
+def multipole_reversal_index(l_max, m_max):
+    """Single index of the multipole with reversed order m for each single index n of a coupling matrix block.
+
+    For fixed tau and l, the single index runs over m in ascending order, such that (tau, l, -m) is 2m entries before
+    (tau, l, m).
+
+    Args:
+        l_max (int):    Maximal multipole degree
+        m_max (int):    Maximal multipole order
+
+    Returns:
+        Integer array p of length blocksize(l_max, m_max) such that n = (tau, l, m) implies p[n] = (tau, l, -m)
+    """
+    m_array = block_m_array(l_max, m_max)
+    return np.arange(len(m_array)) - 2 * m_array
+
+
+def reciprocal_block(block, l_max1, m_max1, l_max2, m_max2):
+    r"""Coupling block of the reversed particle pair from reciprocity. For two particles in the same layer, the
+    coupling matrix (direct plus layer mediated) satisfies
+
+    .. math::
+        W^{ji}_{\tau_2 l_2 (-m_2), \tau_1 l_1 (-m_1)} = W^{ij}_{\tau_1 l_1 m_1, \tau_2 l_2 m_2},
+
+    which follows from the symmetry of the layer response under reversal of the propagation directions and the parity
+    of the plane wave transformation coefficients.
+
+    Args:
+        block (numpy.ndarray):  Coupling block :math:`W^{ij}` with particle i receiving and particle j emitting
+        l_max1 (int):           Maximal multipole degree of particle i
+        m_max1 (int):           Maximal multipole order of particle i
+        l_max2 (int):           Maximal multipole degree of particle j
+        m_max2 (int):           Maximal multipole order of particle j
+
+    Returns:
+        Coupling block :math:`W^{ji}` with particle j receiving and particle i emitting
+    """
+    return block[np.ix_(multipole_reversal_index(l_max1, m_max1), multipole_reversal_index(l_max2, m_max2))].T
+
+
+def lookup_reciprocity_pairs(l_max, m_max):
+    """Multipole index pairs of a coupling lookup table (particles in the same layer) that follow from other entries
+    by reciprocity, see reciprocal_block. Swapping the particles rotates the in-plane direction by pi, such that
+    table[..., n1, n2] = (-1)^(m2 - m1) * table[..., p[n2], p[n1]] with p = multipole_reversal_index(l_max, m_max).
+
+    Args:
+        l_max (int):    Maximal multipole degree
+        m_max (int):    Maximal multipole order
+
+    Returns:
+        Tuple (computed, dependent_pairs) of a boolean array of shape [blocksize, blocksize] that marks the entries
+        that need to be computed, and a list of tuples (n1, n2, partner_n1, partner_n2, sign) for the other entries
+    """
+    reversal_index = multipole_reversal_index(l_max, m_max)
+    m_array = block_m_array(l_max, m_max)
+    blocksize = len(m_array)
+    computed = np.ones((blocksize, blocksize), dtype=bool)
+    dependent_pairs = []
+    for n1 in range(blocksize):
+        for n2 in range(blocksize):
+            partner = (reversal_index[n2], reversal_index[n1])
+            if (n1, n2) > partner:
+                computed[n1, n2] = False
+                dependent_pairs.append((n1, n2, partner[0], partner[1], (-1) ** abs(m_array[n2] - m_array[n1])))
+    return computed, dependent_pairs
+
+
+def complete_lookup_by_reciprocity(lookup_table, dependent_pairs):
+    """Fill the entries of a lookup table that were not computed, see lookup_reciprocity_pairs.
+
+    Args:
+        lookup_table (numpy.ndarray):   Lookup table with the multipole indices [..., n1, n2] in the last two axes
+        dependent_pairs (list):         As returned by lookup_reciprocity_pairs
+    """
+    for n1, n2, partner_n1, partner_n2, sign in dependent_pairs:
+        lookup_table[..., n1, n2] = sign * lookup_table[..., partner_n1, partner_n2]
+
+
+def reciprocity_deviation(vacuum_wavelength, particle_list, layer_system, k_parallel='default', number_of_pairs=10,
+                          random_seed=0):
+    r"""Largest relative deviation from the reciprocity relation (see reciprocal_block) for random pairs of distinct
+    particles in the same layer. Both coupling blocks of each pair are computed directly.
+
+    Args:
+        vacuum_wavelength (float):      Vacuum wavelength :math:`\lambda` (length unit)
+        particle_list (list):           List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium in which the coupling takes place
+        k_parallel (numpy.ndarray or str):          In-plane wavenumber for Sommerfeld integrals.
+                                                    If 'default', smuthi.coordinates.default_k_parallel
+        number_of_pairs (int):          Number of random particle pairs
+        random_seed (int):              Seed of the random pair selection
+
+    Returns:
+        Largest relative deviation in the Frobenius norm (float), 0 if there are no pairs in the same layer
+    """
+    layer_numbers = [layer_system.layer_number(particle.position[2]) for particle in particle_list]
+    candidates = [(i, j) for i in range(len(particle_list)) for j in range(i + 1, len(particle_list))
+                  if layer_numbers[i] == layer_numbers[j]]
+    if not candidates:
+        return 0
+    random_state = np.random.RandomState(random_seed)
+    pairs = [candidates[k] for k in random_state.choice(len(candidates), min(number_of_pairs, len(candidates)),
+                                                        replace=False)]
+    receiving_particles = [particle_list[i] for i, j in pairs] + [particle_list[j] for i, j in pairs]
+    emitting_particles = [particle_list[j] for i, j in pairs] + [particle_list[i] for i, j in pairs]
+    wr_blocks = layer_mediated_coupling_block_list(vacuum_wavelength, receiving_particles, emitting_particles,
+                                                   layer_system, k_parallel)
+    w_blocks = direct_coupling_block_list(vacuum_wavelength, receiving_particles, emitting_particles, layer_system)
+    blocks = [wr + w for wr, w in zip(wr_blocks, w_blocks)]
+    deviation = 0
+    for k, (i, j) in enumerate(pairs):
+        w_ji = blocks[len(pairs) + k]
+        w_ji_reciprocal = reciprocal_block(blocks[k], particle_list[i].l_max, particle_list[i].m_max,
+                                           particle_list[j].l_max, particle_list[j].m_max)
+        deviation = max(deviation, np.linalg.norm(w_ji_reciprocal - w_ji) / np.linalg.norm(w_ji))
+    return deviation
+
+
+def validate_reciprocity(vacuum_wavelength, particle_list, layer_system, k_parallel='default'):
+    r"""Write the deviation from the reciprocity relation for random particle pairs to the log (see
+    reciprocity_deviation) and warn if it exceeds reciprocity_tolerance.
+
+    Args:
+        vacuum_wavelength (float):      Vacuum wavelength :math:`\lambda` (length unit)
+        particle_list (list):           List of smuthi.particles.Particle objects
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium in which the coupling takes place
+        k_parallel (numpy.ndarray or str):          In-plane wavenumber for Sommerfeld integrals.
+                                                    If 'default', smuthi.coordinates.default_k_parallel
+    """
+    deviation = reciprocity_deviation(vacuum_wavelength, particle_list, layer_system, k_parallel)
+    sys.stdout.write('Reciprocity check: max. relative deviation %.2e\n' % deviation)
+    sys.stdout.flush()
+    if deviation > reciprocity_tolerance:
+        warnings.warn('The coupling blocks violate the reciprocity relation (relative deviation %.2e). Set '
+                      'smuthi.particle_coupling.use_reciprocity = False.' % deviation)
+
+
+def direct_coupling_block(vacuum_wavelength, receiving_particle, emitting_particle, layer_system):
+    r"""Direct particle coupling matrix :math:`W` for two particles.
+
+    Args:
+        vacuum_wavelength (float):                          Vacuum wavelength :math:`\lambda` (length unit)
+        receiving_particle (smuthi.particles.Particle):     Particle that receives the scattered field
+        emitting_particle (smuthi.particles.Particle):      Particle that emits the scattered field
+        layer_system (smuthi.layers.LayerSystem):           Stratified medium in which the coupling takes place
+
+    Returns:
+        Direct coupling matrix block as numpy array.
+    """
+    return direct_coupling_block_list(vacuum_wavelength, [receiving_particle], [emitting_particle], layer_system)[0]
 
 
 def direct_coupling_matrix(vacuum_wavelength, particle_list, layer_system):
@@ -295,25 +577,52 @@ def direct_coupling_matrix(vacuum_wavelength, particle_list, layer_system):
     # indices
     blocksizes = [fldex.blocksize(particle.l_max, particle.m_max)
                   for particle in particle_list]
+    offsets = np.concatenate([[0], np.cumsum(blocksizes, dtype=int)])
 
     # initialize result
-    w = np.zeros((sum(blocksizes), sum(blocksizes)), dtype=complex)
+    w = np.zeros((offsets[-1], offsets[-1]), dtype=complex)
 
+    # one block row per receiving particle, such that the intermediate arrays scale with the number of particles
     for s1, particle1 in enumerate(particle_list):
-        idx1 = np.array(range(sum(blocksizes[:s1]), sum(blocksizes[:s1+1])))
-        for s2, particle2 in enumerate(particle_list):
-            idx2 = range(sum(blocksizes[:s2]), sum(blocksizes[:s2+1]))
-            w[idx1[:, None], idx2] = direct_coupling_block(vacuum_wavelength, particle1, particle2, layer_system)
+        blocks = direct_coupling_block_list(vacuum_wavelength, [particle1] * len(particle_list), particle_list,
+                                            layer_system)
+        for s2, block in enumerate(blocks):
+            w[offsets[s1]:offsets[s1 + 1], offsets[s2]:offsets[s2 + 1]] = block
 
     return w
 
 
+def coupling_submatrix(vacuum_wavelength, receiving_particles, emitting_particles, layer_system, k_parallel='default'):
+    r"""Coupling matrix W + W^R between a group of receiving and a group of emitting particles, e.g. for the evaluation
+    of selected rows and columns of the coupling matrix by adaptive cross approximation (see smuthi.hmatrix).
+
+    Args:
+        vacuum_wavelength (float):      Vacuum wavelength :math:`\lambda` (length unit)
+        receiving_particles (list):     Particles that receive the scattered field
+        emitting_particles (list):      Particles that emit the scattered field
+        layer_system (smuthi.layers.LayerSystem):   Stratified medium in which the coupling takes place
+        k_parallel (numpy.ndarray or str):          In-plane wavenumber for Sommerfeld integrals.
+                                                    If 'default', smuthi.coordinates.default_k_parallel
+
+    Returns:
+        Coupling matrix as numpy array with the rows of the receiving and the columns of the emitting particles.
+    """
+    pairs_receiving = [rp for rp in receiving_particles for ep in emitting_particles]
+    pairs_emitting = [ep for rp in receiving_particles for ep in emitting_particles]
+    wr_blocks = layer_mediated_coupling_block_list(vacuum_wavelength, pairs_receiving, pairs_emitting, layer_system,
+                                                   k_parallel)
+    w_blocks = direct_coupling_block_list(vacuum_wavelength, pairs_receiving, pairs_emitting, layer_system)
+    blocks = [wr + w for wr, w in zip(wr_blocks, w_blocks)]
+    number_emitting = len(emitting_particles)
+    return np.block([blocks[i * number_emitting:(i + 1) * number_emitting] for i in range(len(receiving_particles))])
+
 
 
 def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system, k_parallel='default', 
-                                     resolution=None):
+                                     resolution=None, direct_coupling=True):
     """Prepare Sommerfeld integral lookup table to allow for a fast calculation of the coupling matrix by interpolation.
-    This function is called when not all particles are on the same z-position.
+    This function is called when not all particles are on the same z-position. If a disk cache directory is set (see
+    smuthi.disk_cache), the table is stored there and reused for identical parameters.
     
     Args:
         vacuum_wavelength (float):  Vacuum wavelength in length units
@@ -323,6 +632,8 @@ def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_sys
                                                      If 'default', smuthi.coordinates.default_k_parallel
         resolution (float): Spatial resolution of lookup table in length units. (default: vacuum_wavelength / 100)        
                             Smaller means more accurate but higher memory footprint 
+        direct_coupling (bool): If False, w_mn includes only the layer mediated coupling, e.g. if the direct coupling
+                                is evaluated by the fast multipole method (see smuthi.fmm)
                             
     Returns:
         (tuple): tuple containing:
@@ -348,18 +659,15 @@ def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_sys
     m_max = max([particle.m_max for particle in particle_list])
     blocksize = fldex.blocksize(l_max, m_max)
     
-    particle_x_array = np.array([particle.position[0] for particle in particle_list])
-    particle_y_array = np.array([particle.position[1] for particle in particle_list])
-    particle_z_array = np.array([particle.position[2] for particle in particle_list])
-    particle_rho_array = np.sqrt((particle_x_array[:, None] - particle_x_array[None, :]) ** 2 
-                                 + (particle_y_array[:, None] - particle_y_array[None, :]) ** 2)
+    positions = part.particle_positions(particle_list)
+    particle_z_array = positions[:, 2]
     
     dz_min = particle_z_array.min() - particle_z_array.max()
     dz_max = particle_z_array.max() - particle_z_array.min()
     sz_min = 2 * particle_z_array.min()
     sz_max = 2 * particle_z_array.max()
     
-    rho_array = np.arange(- 3 * resolution, particle_rho_array.max() + 3 * resolution, resolution)
+    rho_array = np.arange(- 3 * resolution, largest_distance(positions[:, :2]) + 3 * resolution, resolution)
     sz_array = np.arange(sz_min - 3 * resolution, sz_max + 3 * resolution, resolution)
     dz_array = np.arange(dz_min - 3 * resolution, dz_max + 3 * resolution, resolution)
     
@@ -371,51 +679,43 @@ def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_sys
     i_s = layer_system.layer_number(particle_list[0].position[2])
     k_is = layer_system.wavenumber(i_s, vacuum_wavelength)
     z_is = layer_system.reference_z(i_s)
+    rho_cutoff = smallest_distance(positions[:, :2]) / 2
+
+    if type(k_parallel) == str and k_parallel == 'default':
+        k_parallel = coord.default_k_parallel
+    if dc.cache_directory is not None:
+        disk_cache_key = dc.entry_key('volumetric_lookup', vacuum_wavelength=vacuum_wavelength,
+                                      thicknesses=layer_system.thicknesses,
+                                      refractive_indices=layer_system.refractive_indices, k_parallel=k_parallel,
+                                      l_max=l_max, m_max=m_max, resolution=resolution, rho_array=rho_array,
+                                      sz_array=sz_array, dz_array=dz_array, rho_cutoff=rho_cutoff,
+                                      direct_coupling=direct_coupling, use_gpu=cu.use_gpu)
+        entry = dc.load(disk_cache_key)
+        if entry is not None:
+            sys.stdout.write('Loaded lookup table from disk cache\n')
+            sys.stdout.flush()
+            return entry['w_pl'], entry['w_mn'], rho_array, sz_array, dz_array
     
     # direct -----------------------------------------------------------------------------------------------------------
     w = np.zeros((len_rho, len_dz, blocksize, blocksize), dtype=np.complex64)
     sys.stdout.write('Lookup table memory footprint: ' + size_format(2 * w.nbytes) + '\n')
     sys.stdout.flush()
 
-    r_array = np.sqrt(dz_array[None, :]**2 + rho_array[:, None]**2)
-    r_array[r_array==0] = 1e-20
-    ct = dz_array[None, :] / r_array
-    st = rho_array[:, None] / r_array
-    legendre, _, _ = sf.legendre_normalized(ct, st, 2 * l_max)
-    
-    bessel_h = []
-    for dm in tqdm(range(2 * l_max + 1), desc='Spherical Hankel lookup   ', file=sys.stdout,
-                   bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
-        bessel_h.append(sf.spherical_hankel(dm, k_is * r_array))
-    
-    pbar = tqdm(total=blocksize**2, 
-                desc='Direct coupling           ', 
-                file=sys.stdout,
-                bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}')
-            
-    for m1 in range(-m_max, m_max+1):
-        for m2 in range(-m_max, m_max+1):
-            for l1 in range(max(1, abs(m1)), l_max + 1):
-                for l2 in range(max(1, abs(m2)), l_max + 1):
-                    A = np.zeros((len_rho, len_dz), dtype=complex)
-                    B = np.zeros((len_rho, len_dz), dtype=complex)
-                    for ld in range(max(abs(l1 - l2), abs(m1 - m2)), l1 + l2 + 1):  # if ld<abs(m1-m2) then P=0
-                        a5, b5 = vwf.ab5_coefficients(l2, m2, l1, m1, ld)    # remember that w = A.T
-                        A += a5 * bessel_h[ld] * legendre[ld][abs(m1 - m2)]   # remember that w = A.T
-                        B += b5 * bessel_h[ld] * legendre[ld][abs(m1 - m2)]   # remember that w = A.T
-                    for tau1 in range(2):
-                        n1 = fldex.multi_to_single_index(tau1, l1, m1, l_max, m_max)
-                        for tau2 in range(2):
-                            n2 = fldex.multi_to_single_index(tau2, l2, m2, l_max, m_max)
-                            if tau1 == tau2:
-                                w[:, :, n1, n2] = A
-                            else:
-                                w[:, :, n1, n2] = B
-                            pbar.update()
-    pbar.close()
+    if direct_coupling:
+        r_array = np.sqrt(dz_array[None, :]**2 + rho_array[:, None]**2)
+        r_array[r_array==0] = 1e-20
+        ct = dz_array[None, :] / r_array
+        st = rho_array[:, None] / r_array
 
-    # switch off direct coupling contribution near rho=0:
-    w[rho_array < particle_rho_array[~np.eye(particle_rho_array.shape[0],dtype=bool)].min() / 2, :, :, :] = 0  
+        # evaluate in chunks of rho values to limit the memory overhead of the complex128 intermediate results
+        chunksize = max(1, 2**22 // (len_dz * blocksize**2))
+        for i_rho in tqdm(range(0, len_rho, chunksize), desc='Direct coupling           ', file=sys.stdout,
+                          bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            chunk = slice(i_rho, i_rho + chunksize)
+            w[chunk] = direct_coupling_kernel(k_is, r_array[chunk], ct[chunk], st[chunk], l_max, m_max, l_max, m_max)
+
+        # switch off direct coupling contribution near rho=0:
+        w[rho_array < rho_cutoff, :, :, :] = 0
 
     # layer mediated ---------------------------------------------------------------------------------------------------
     sys.stdout.write('Layer mediated coupling   : ...')
@@ -469,6 +769,15 @@ def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_sys
         for n2 in range(blocksize):
             m2 = m_list[n2]
             n1n2_combinations[abs(m1-m2)].append((n1,n2))
+
+    # the part that depends on z1 + z2 is invariant under exchange of the particles, such that half of its entries
+    # follow from reciprocity (the part that depends on z1 - z2 would require a lookup grid symmetric in z1 - z2)
+    if use_reciprocity:
+        if use_reciprocity == 'validate':
+            validate_reciprocity(vacuum_wavelength, particle_list, layer_system, k_parallel)
+        compute_pl, dependent_pairs = lookup_reciprocity_pairs(l_max, m_max)
+    else:
+        compute_pl, dependent_pairs = np.ones((blocksize, blocksize), dtype=bool), []
                    
     wr_pl = np.zeros((len_rho, len_dz, blocksize, blocksize), dtype=np.complex64)
     wr_mn = np.zeros((len_rho, len_dz, blocksize, blocksize), dtype=np.complex64)
@@ -503,8 +812,9 @@ def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_sys
             belbee_pl = np.zeros((len_dz, len_kp), dtype=complex)
             belbee_mn = np.zeros((len_dz, len_kp), dtype=complex)
             for pol in range(2):
-                belbee_pl += ((L[pol, 0, 1, :] * B_dag[pol, 0, n1, :] * B[pol, 1, n2, :])[None, :] * epljksz
-                              + (L[pol, 1, 0, :] * B_dag[pol, 1, n1, :] * B[pol, 0, n2, :])[None, :] * emnjksz)
+                if compute_pl[n1, n2]:
+                    belbee_pl += ((L[pol, 0, 1, :] * B_dag[pol, 0, n1, :] * B[pol, 1, n2, :])[None, :] * epljksz
+                                  + (L[pol, 1, 0, :] * B_dag[pol, 1, n1, :] * B[pol, 0, n2, :])[None, :] * emnjksz)
                 belbee_mn += ((L[pol, 0, 0, :] * B_dag[pol, 0, n1, :] * B[pol, 0, n2, :])[None, :] * epljkdz
                               + (L[pol, 1, 1, :] * B_dag[pol, 1, n1, :] * B[pol, 1, n2, :])[None, :] * emnjkdz)
             
@@ -517,32 +827,41 @@ def volumetric_coupling_lookup_table(vacuum_wavelength, particle_list, layer_sys
                 re_besjac_d = gpuarray.to_gpu(np.float32(besjac[:, None, :].real))
                 im_besjac_d = gpuarray.to_gpu(np.float32(besjac[:, None, :].imag))
             
-                helper_function(re_besjac_d.gpudata, im_besjac_d.gpudata, re_belbee_pl_d.gpudata,
-                                im_belbee_pl_d.gpudata, re_dkp_d.gpudata, im_dkp_d.gpudata, re_dwr_d.gpudata, 
-                                im_dwr_d.gpudata, block=(cuda_blocksize, 1, 1), grid=(cuda_gridsize, 1))
-                wr_pl[:, :, n1, n2] = 4 * (1j)**abs(m2 - m1) * (re_dwr_d.get() + 1j * im_dwr_d.get()) 
+                if compute_pl[n1, n2]:
+                    helper_function(re_besjac_d.gpudata, im_besjac_d.gpudata, re_belbee_pl_d.gpudata,
+                                    im_belbee_pl_d.gpudata, re_dkp_d.gpudata, im_dkp_d.gpudata, re_dwr_d.gpudata,
+                                    im_dwr_d.gpudata, block=(cuda_blocksize, 1, 1), grid=(cuda_gridsize, 1))
+                    wr_pl[:, :, n1, n2] = 4 * (1j)**abs(m2 - m1) * (re_dwr_d.get() + 1j * im_dwr_d.get())
                 
                 helper_function(re_besjac_d.gpudata, im_besjac_d.gpudata, re_belbee_mn_d.gpudata, 
                                 im_belbee_mn_d.gpudata, re_dkp_d.gpudata, im_dkp_d.gpudata, re_dwr_d.gpudata, 
                                 im_dwr_d.gpudata, block=(cuda_blocksize, 1, 1), grid=(cuda_gridsize, 1))
                 wr_mn[:, :, n1, n2] = 4 * (1j)**abs(m2 - m1) * (re_dwr_d.get() + 1j * im_dwr_d.get()) 
             else:
-                integrand = besjac[:, None, :] * belbee_pl[None, :, :] 
-                wr_pl[:, :, n1, n2] = 2 * (1j)**abs(m2 - m1) * ((integrand[:, :, :-1] + integrand[:, :, 1:]) 
-                                                                * dkp[None, None, :]).sum(axis=-1)   # trapezoidal rule
+                if compute_pl[n1, n2]:
+                    integrand = besjac[:, None, :] * belbee_pl[None, :, :]
+                    wr_pl[:, :, n1, n2] = 2 * (1j)**abs(m2 - m1) * ((integrand[:, :, :-1] + integrand[:, :, 1:])
+                                                                    * dkp[None, None, :]).sum(axis=-1)  # trapezoidal
                 
                 integrand = besjac[:, None, :] * belbee_mn[None, :, :]
                 wr_mn[:, :, n1, n2] = 2 * (1j)**abs(m2 - m1) * ((integrand[:, :, :-1] + integrand[:, :, 1:])
                                                                 * dkp[None, None, :]).sum(axis=-1)
             pbar.update()
     pbar.close()
+    complete_lookup_by_reciprocity(wr_pl, dependent_pairs)
+
+    if dc.cache_directory is not None:
+        entry = dc.store(disk_cache_key, w_pl=wr_pl, w_mn=w + wr_mn)
+        return entry['w_pl'], entry['w_mn'], rho_array, sz_array, dz_array
     
     return wr_pl, w + wr_mn, rho_array, sz_array, dz_array
 
 
-def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None):
+def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system, k_parallel='default', resolution=None,
+                                 max_distance=None, direct_coupling=True):
     """Prepare Sommerfeld integral lookup table to allow for a fast calculation of the coupling matrix by interpolation.
-    This function is called when all particles are on the same z-position.
+    This function is called when all particles are on the same z-position. If a disk cache directory is set (see
+    smuthi.disk_cache), the table is stored there and reused for identical parameters.
     
     Args:
         vacuum_wavelength (float):  Vacuum wavelength in length units
@@ -552,6 +871,12 @@ def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system,
                                                      If 'default', smuthi.coordinates.default_k_parallel
         resolution (float): Spatial resolution of lookup table in length units. (default: vacuum_wavelength / 100)       
                             Smaller means more accurate but higher memory footprint 
+        max_distance (float or None):   Largest radial distance covered by the lookup table. If None (default), the
+                                        largest distance between two particles. If specified, the particle distances are
+                                        not evaluated pairwise, such that the memory footprint is linear in the number
+                                        of particles (see smuthi.pfft).
+        direct_coupling (bool): If False, the lookup includes only the layer mediated coupling, e.g. if the direct
+                                coupling is evaluated by the fast multipole method (see smuthi.fmm)
                             
     Returns:
         (tuple) tuple containing:
@@ -574,11 +899,12 @@ def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system,
     m_max = max([particle.m_max for particle in particle_list])
     blocksize = fldex.blocksize(l_max, m_max)
     
-    x_array = np.array([particle.position[0] for particle in particle_list])
-    y_array = np.array([particle.position[1] for particle in particle_list])
-    rho_array = np.sqrt((x_array[:, None] - x_array[None, :]) ** 2 + (y_array[:, None] - y_array[None, :]) ** 2)
+    in_plane_positions = part.particle_positions(particle_list)[:, :2]
+    if max_distance is None:
+        max_distance = largest_distance(in_plane_positions)
+    rho_cutoff = smallest_distance(in_plane_positions) / 2
 
-    radial_distance_array = np.arange(- 3 * resolution, rho_array.max() + 3 * resolution, resolution)
+    radial_distance_array = np.arange(- 3 * resolution, max_distance + 3 * resolution, resolution)
     
     z = particle_list[0].position[2]
     i_s = layer_system.layer_number(z)
@@ -586,48 +912,34 @@ def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system,
     dz = z - layer_system.reference_z(i_s)
     
     len_rho = len(radial_distance_array)
+
+    if type(k_parallel) == str and k_parallel == 'default':
+        k_parallel = coord.default_k_parallel
+    if dc.cache_directory is not None:
+        disk_cache_key = dc.entry_key('radial_lookup', vacuum_wavelength=vacuum_wavelength,
+                                      thicknesses=layer_system.thicknesses,
+                                      refractive_indices=layer_system.refractive_indices, k_parallel=k_parallel,
+                                      l_max=l_max, m_max=m_max, resolution=resolution, z=z,
+                                      radial_distance_array=radial_distance_array, rho_cutoff=rho_cutoff,
+                                      direct_coupling=direct_coupling, use_gpu=cu.use_gpu)
+        entry = dc.load(disk_cache_key)
+        if entry is not None:
+            sys.stdout.write('Loaded lookup table from disk cache\n')
+            sys.stdout.flush()
+            return entry['w'], radial_distance_array
         
     # direct -----------------------------------------------------------------------------------------------------------
     w = np.zeros((len_rho, blocksize, blocksize), dtype=np.complex64)
     sys.stdout.write('Memory footprint: ' + size_format(w.nbytes) + '\n')
     sys.stdout.flush()
 
-    ct = np.array([0.0])
-    st = np.array([1.0])
-    bessel_h = []
-    for n in range(2* l_max + 1):
-        bessel_h.append(sf.spherical_hankel(n, k_is * radial_distance_array))
-        bessel_h[-1][radial_distance_array <= 0] = np.nan
-        
-    legendre, _, _ = sf.legendre_normalized(ct, st, 2 * l_max)
-
-    pbar = tqdm(total=blocksize**2, 
-                desc='Direct coupling           ', 
-                file=sys.stdout,
-                bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}')
-
-    for m1 in range(-m_max, m_max+1):
-        for m2 in range(-m_max, m_max+1):
-            for l1 in range(max(1, abs(m1)), l_max + 1):
-                for l2 in range(max(1, abs(m2)), l_max + 1):
-                    A = np.zeros(len_rho, dtype=complex)
-                    B = np.zeros(len_rho, dtype=complex)
-                    for ld in range(max(abs(l1 - l2), abs(m1 - m2)), l1 + l2 + 1):  # if ld<abs(m1-m2) then P=0
-                        a5, b5 = vwf.ab5_coefficients(l2, m2, l1, m1, ld)
-                        A += a5 * bessel_h[ld] * legendre[ld][abs(m1 - m2)]
-                        B += b5 * bessel_h[ld] * legendre[ld][abs(m1 - m2)]
-                    for tau1 in range(2):
-                        n1 = fldex.multi_to_single_index(tau1, l1, m1, l_max, m_max)
-                        for tau2 in range(2):
-                            n2 = fldex.multi_to_single_index(tau2, l2, m2, l_max, m_max)
-                            if tau1 == tau2:
-                                w[:, n1, n2] = A  # remember that w = A.T
-                            else:
-                                w[:, n1, n2] = B
-                            pbar.update()
-    pbar.close()
-    close_to_zero = radial_distance_array < rho_array[~np.eye(rho_array.shape[0],dtype=bool)].min() / 2 
-    w[close_to_zero, :, :] = 0  # switch off direct coupling contribution near rho=0
+    if direct_coupling:
+        distance = radial_distance_array.copy()
+        distance[distance <= 0] = np.nan
+        w[:, :, :] = direct_coupling_kernel(k_is, distance, np.zeros(len_rho), np.ones(len_rho), l_max, m_max, l_max,
+                                            m_max)
+        close_to_zero = radial_distance_array < rho_cutoff
+        w[close_to_zero, :, :] = 0  # switch off direct coupling contribution near rho=0
 
     # layer mediated ---------------------------------------------------------------------------------------------------
     sys.stdout.write('Layer mediated coupling   : ...')
@@ -673,14 +985,6 @@ def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system,
                     B[pol,1,n,:] = vwf.transformation_coefficients_vwf(tau, l, m, pol, pilm_list=pilm_mn,
                                                                        taulm_list=taulm_mn, dagger=False)
     
-    # pairs of (n1, n2), listed by abs(m1-m2)
-    n1n2_combinations = [[] for dm in range(2*m_max+1)]
-    for n1 in range(blocksize):
-        m1 = m_list[n1]
-        for n2 in range(blocksize):
-            m2 = m_list[n2]
-            n1n2_combinations[abs(m1-m2)].append((n1,n2))
-                   
     wr = np.zeros((len_rho, blocksize, blocksize), dtype=complex)
     
     dkp = np.diff(k_parallel)
@@ -695,14 +999,24 @@ def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system,
         re_dwr_d = gpuarray.to_gpu(np.zeros(len_rho, dtype=np.float32))
         im_dwr_d = gpuarray.to_gpu(np.zeros(len_rho, dtype=np.float32))    
     
+    # with reciprocity, only about half of the (n1, n2) entries are computed
+    if use_reciprocity:
+        if use_reciprocity == 'validate':
+            validate_reciprocity(vacuum_wavelength, particle_list, layer_system, k_parallel)
+        computed, dependent_pairs = lookup_reciprocity_pairs(l_max, m_max)
+    else:
+        computed, dependent_pairs = np.ones((blocksize, blocksize), dtype=bool), []
+
+    # pairs of (n1, n2), listed by abs(m1-m2)
     n1n2_combinations = [[] for dm in range(2*m_max+1)]
     for n1 in range(blocksize):
         m1 = m_list[n1]
         for n2 in range(blocksize):
             m2 = m_list[n2]
-            n1n2_combinations[abs(m1-m2)].append((n1,n2))
+            if computed[n1, n2]:
+                n1n2_combinations[abs(m1-m2)].append((n1,n2))
     
-    pbar = tqdm(total=blocksize**2, 
+    pbar = tqdm(total=np.count_nonzero(computed),
                 desc='Layer mediated coupling   ', 
                 file=sys.stdout,
                 bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}')
@@ -744,10 +1058,100 @@ def radial_coupling_lookup_table(vacuum_wavelength, particle_list, layer_system,
                                                             * dkp[None,:]).sum(axis=-1)  # trapezoidal rule
             pbar.update()
     pbar.close()
+    complete_lookup_by_reciprocity(wr, dependent_pairs)
+
+    if dc.cache_directory is not None:
+        return dc.store(disk_cache_key, w=w + wr)['w'], radial_distance_array
     
     return w + wr, radial_distance_array
 
 
+def largest_distance(points):
+    """Largest distance between two points, evaluated for chunks of points such that the memory footprint is linear in
+    the number of points.
+
+    Args:
+        points (numpy.ndarray):     Coordinates, array of shape [number of points, dimension]
+
+    Returns:
+        Largest distance (float)
+    """
+    chunksize = max(1, 2**22 // len(points))
+    return max(scipy.spatial.distance.cdist(points[start:start + chunksize], points).max()
+               for start in range(0, len(points), chunksize))
+
+
+def smallest_distance(points):
+    """Smallest distance between two different points (zero if two points coincide).
+
+    Args:
+        points (numpy.ndarray):     Coordinates, array of shape [number of points, dimension]
+
+    Returns:
+        Smallest distance (float)
+    """
+    nearest_distances, _ = scipy.spatial.cKDTree(points).query(points, k=2)
+    return nearest_distances[:, 1].min()
+
+
+def lookup_interpolation_stencil(x, lookup_grid, kind='linear'):
+    """Indices and weights of the interpolation stencils for a number of points on an equidistant lookup grid. The
+    cubic interpolation is the same Catmull-Rom scheme as used by the CUDA lookup kernels, see smuthi.cuda_sources.
+
+    Args:
+        x (numpy.ndarray):              Points at which to interpolate
+        lookup_grid (numpy.ndarray):    Equidistant grid of the lookup table, e.g. the rho_array returned by
+                                        volumetric_coupling_lookup_table
+        kind (str):                     'linear' or 'cubic'
+
+    Returns:
+        Tuple (indices, weights) of arrays with shape x.shape + (2,) for linear or x.shape + (4,) for cubic
+        interpolation, such that the interpolated value of a table f is (weights * f[indices]).sum(axis=-1)
+    """
+    resolution = lookup_grid[1] - lookup_grid[0]
+    scaled_x = (np.asarray(x, dtype=float) - lookup_grid[0]) / resolution
+    idx = np.floor(scaled_x)
+    w = scaled_x - idx
+    idx = idx.astype(np.int32)
+    if kind == 'linear':
+        offsets = np.arange(2, dtype=np.int32)
+        weights = np.stack([1 - w, w], axis=-1)
+    elif kind == 'cubic':
+        offsets = np.arange(-1, 3, dtype=np.int32)
+        weights = np.stack([-w**3 + 2 * w**2 - w, 3 * w**3 - 5 * w**2 + 2, -3 * w**3 + 4 * w**2 + w, w**3 - w**2],
+                           axis=-1) / 2
+    else:
+        raise ValueError(kind + ' interpolation not implemented')
+    indices = np.clip(idx[..., None] + offsets, 0, len(lookup_grid) - 1)
+    return indices, weights
+
+
+def interpolate_lookup(lookup_table, stencils):
+    """Interpolate a coupling lookup table at a number of particle pairs. All (n1, n2) entries of the coupling blocks
+    are gathered at once for each stencil point.
+
+    Args:
+        lookup_table (numpy.ndarray):   Lookup table with indices [rho, n1, n2] (radial lookup) or [rho, z, n1, n2]
+                                        (volumetric lookup)
+        stencils (list):                One (indices, weights) tuple per interpolated table dimension, as returned
+                                        by lookup_interpolation_stencil for the npairs particle pairs
+
+    Returns:
+        Interpolated coupling blocks as complex numpy.ndarray of shape [npairs, n1, n2]
+    """
+    npairs = stencils[0][0].shape[0]
+    blocks = np.zeros((npairs,) + lookup_table.shape[len(stencils):], dtype=complex)
+    stencil_points = [range(indices.shape[1]) for indices, _ in stencils]
+    for point in itertools.product(*stencil_points):
+        weight = np.ones(npairs)
+        table_indices = []
+        for (indices, weights), p in zip(stencils, point):
+            weight = weight * weights[:, p]
+            table_indices.append(indices[:, p])
+        blocks += weight[:, None, None] * lookup_table[tuple(table_indices)]
+    return blocks
+
+
 def size_format(b):
     if b < 1000:
               return '%i' % b + 'B'
@@ -880,7 +1284,7 @@ def spheroids_closest_points(ab_halfaxis1, c_halfaxis1, center1, orientation1, a
 
 def direct_coupling_block_pvwf_mediated(vacuum_wavelength, receiving_particle, emitting_particle, layer_system, 
                                         k_parallel):
-    """Direct particle coupling matrix :math:`W` for two particles (via plane vector wave functions).
+    r"""Direct particle coupling matrix :math:`W` for two particles (via plane vector wave functions).
     For details, see: 
     Dominik Theobald et al., Phys. Rev. A 96, 033822, DOI: 10.1103/PhysRevA.96.033822 or arXiv:1708.04808 
 
@@ -2,7 +2,9 @@
 """Provide class for the representation of scattering particles."""
 import smuthi.field_expansion as fldex
 import smuthi.t_matrix as tmt
+import smuthi.memoizing as memo
 import numpy as np
+import functools
 
 class Particle:
     """Base class for scattering particles.
@@ -205,3 +207,129 @@ class FiniteCylinder(Particle):
     def circumscribing_sphere_radius(self):
         return np.sqrt((self.cylinder_height / 2)**2 + self.cylinder_radius**2)
 
+
+# particle attributes that don't enter the T-matrix
+_non_t_matrix_attributes = ('position', 'initial_field', 'scattered_field', 't_matrix')
+
+
+def _rebuild_arrays_after(method):
+    """Wrap a list method of ParticleArray such that the arrays are rebuilt after the list was modified."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.update()
+        return result
+    return wrapper
+
+
+class ParticleArray(list):
+    """List of particles with the per-particle data also stored in contiguous arrays (structure of arrays), for
+    large particle ensembles.
+
+    The position attribute of each particle remains a list, the positions array is a copy of the particle positions.
+    Particles that only differ in their position can share one T-matrix, see identical_particle_groups. The initial
+    and scattered field coefficients of all particles can be stored in one system vector, with the coefficients of
+    each particle's field expansion being a view into it, see bind_coefficients.
+
+    A ParticleArray can be used wherever a list of particles is expected. If particles are added, removed or replaced
+    through the list methods, the arrays are rebuilt. If attributes of the particles are changed (including the
+    position), call update. smuthi.linear_system.LinearSystem calls update when it is created.
+
+    Args:
+        particles (iterable):   smuthi.particles.Particle objects
+
+    Attributes:
+        positions (numpy.ndarray):      Particle positions, array of shape [number of particles, 3]
+        euler_angles (numpy.ndarray):   Particle Euler angles, array of shape [number of particles, 3]
+        l_max (numpy.ndarray):          Maximal multipole degree of each particle
+        m_max (numpy.ndarray):          Maximal multipole order of each particle
+        blocksizes (numpy.ndarray):     Number of spherical wave coefficients of each particle
+        radii (numpy.ndarray):          Circumscribing sphere radius of each particle (nan if not defined)
+        particle_types (list):          Distinct particle classes
+        type_indices (numpy.ndarray):   Position of the class of each particle in particle_types
+        index_layout (object):          System vector index layout, cached by smuthi.linear_system
+    """
+    def __init__(self, particles=()):
+        list.__init__(self, particles)
+        self.update()
+
+    def update(self):
+        """Rebuild the arrays from the particle attributes."""
+        number_of_particles = len(self)
+        self.positions = np.array([particle.position for particle in self],
+                                  dtype=float).reshape(number_of_particles, 3)
+        self.euler_angles = np.array([particle.euler_angles for particle in self],
+                                     dtype=float).reshape(number_of_particles, 3)
+        self.l_max = np.array([particle.l_max for particle in self], dtype=int)
+        self.m_max = np.array([particle.m_max for particle in self], dtype=int)
+        self.blocksizes = np.array([fldex.blocksize(l_max, m_max) for l_max, m_max in zip(self.l_max, self.m_max)],
+                                   dtype=int)
+        self.radii = np.array([particle.circumscribing_sphere_radius() for particle in self], dtype=float)
+        type_numbers = {}
+        self.type_indices = np.array([type_numbers.setdefault(type(particle), len(type_numbers))
+                                      for particle in self], dtype=int)
+        self.particle_types = list(type_numbers)
+        self.index_layout = None
+        self.initial_field_coefficients = None
+        self.scattered_field_coefficients = None
+
+    append = _rebuild_arrays_after(list.append)
+    extend = _rebuild_arrays_after(list.extend)
+    insert = _rebuild_arrays_after(list.insert)
+    remove = _rebuild_arrays_after(list.remove)
+    pop = _rebuild_arrays_after(list.pop)
+    clear = _rebuild_arrays_after(list.clear)
+    sort = _rebuild_arrays_after(list.sort)
+    reverse = _rebuild_arrays_after(list.reverse)
+    __setitem__ = _rebuild_arrays_after(list.__setitem__)
+    __delitem__ = _rebuild_arrays_after(list.__delitem__)
+    __iadd__ = _rebuild_arrays_after(list.__iadd__)
+    __imul__ = _rebuild_arrays_after(list.__imul__)
+
+    def identical_particle_groups(self):
+        """Group the particles that only differ in their position (and fields), such that they have the same T-matrix
+        if they are embedded in the same medium.
+
+        Returns:
+            list of integer arrays with the particle numbers of each group
+        """
+        groups = {}
+        for i, particle in enumerate(self):
+            attributes = {key: value for key, value in vars(particle).items() if key not in _non_t_matrix_attributes}
+            groups.setdefault((type(particle), memo.fingerprint(attributes)), []).append(i)
+        return [np.array(group, dtype=int) for group in groups.values()]
+
+    def bind_coefficients(self, field, vector=None):
+        """Store the coefficients of the initial or scattered field expansions of all particles in one system vector
+        and replace the coefficients of each particle's expansion by a view into it.
+
+        Args:
+            field (str):                    'initial_field' or 'scattered_field'
+            vector (numpy.ndarray or None): System vector with the coefficients. If None, concatenate the present
+                                            coefficients of the particles' field expansions
+
+        Returns:
+            the system vector
+        """
+        expansions = [getattr(particle, field) for particle in self]
+        if vector is None:
+            vector = np.concatenate([expansion.coefficients for expansion in expansions])
+        offsets = np.cumsum(self.blocksizes)
+        for expansion, coefficients in zip(expansions, np.split(vector, offsets[:-1])):
+            expansion.coefficients = coefficients
+        setattr(self, field + '_coefficients', vector)
+        return vector
+
+
+def particle_positions(particle_list):
+    """Positions of the particles.
+
+    Args:
+        particle_list (list):   List of smuthi.particles.Particle objects or ParticleArray
+
+    Returns:
+        numpy.ndarray of shape [number of particles, 3]
+    """
+    if isinstance(particle_list, ParticleArray):
+        return particle_list.positions
+    return np.array([particle.position for particle in particle_list], dtype=float).reshape(-1, 3)
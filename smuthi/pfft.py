@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Precorrected fast Fourier transform (pFFT) for the coupling between particles at the same height.
+
+If all particles are located at the same z-position, the coupling block between two particles depends only on their
+in-plane displacement (see smuthi.particle_coupling.radial_coupling_lookup_table), such that the coupling matrix-vector
+product is a two-dimensional discrete convolution. It is evaluated in four steps:
+
+- projection: the coefficients of each particle are distributed to the p x p nearest nodes of a regular in-plane grid,
+  with the weights of Lagrange interpolation with p points per dimension,
+- convolution: the grid coefficients are convolved with the coupling kernel, sampled at the displacements between grid
+  nodes, by 2-D FFT,
+- interpolation: the convolved grid coefficients are interpolated back to the particle positions with the same weights,
+- precorrection: for pairs of particles closer than a correction radius, the grid approximation of the coupling block
+  is replaced by the interpolated lookup table.
+
+The matrix-vector product then costs O(G log G) operations for a grid with G nodes, and O(N) operations for the
+projection, interpolation and precorrection of N particles.
+"""
+
+import smuthi.particle_coupling as coup
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+import sys
+from tqdm import tqdm
+
+
+def lagrange_stencil(x, grid_origin, grid_spacing, order):
+    """Indices and weights of the Lagrange interpolation on an equidistant grid.
+
+    Args:
+        x (numpy.ndarray):      Points at which to interpolate
+        grid_origin (float):    Position of the first grid node
+        grid_spacing (float):   Distance between neighboring grid nodes
+        order (int):            Number of stencil nodes
+
+    Returns:
+        Tuple (indices, weights) of arrays with shape x.shape + (order,), such that the interpolated value of a function
+        f sampled on the grid is (weights * f[indices]).sum(axis=-1)
+    """
+    scaled_x = (np.asarray(x, dtype=float) - grid_origin) / grid_spacing
+    first = np.floor(scaled_x).astype(int) - (order - 1) // 2
+    t = scaled_x - first
+    weights = np.ones(t.shape + (order,))
+    for k in range(order):
+        for j in range(order):
+            if j != k:
+                weights[..., k] *= (t - j) / (k - j)
+    return first[..., None] + np.arange(order), weights
+
+
+class PrecorrectedFFT:
+    """Coupling matrix between particles at the same height, applied by the precorrected FFT method. The matrix acts on
+    vectors in the layout of the lookup tables, i.e., with a full block of size blocksize(l_max, m_max) per particle.
+
+    The grid is defined by the particle positions at construction, such that the radial lookup table can be prepared up
+    to max_distance. The kernel and the precorrection are then computed by setup.
+
+    Args:
+        positions (numpy.ndarray):  In-plane particle positions in the format [number of particles, 2]
+        grid_spacing (float):       Distance between neighboring grid nodes (length unit). Should be a fraction of the
+                                    wavelength in the layer of the particles
+        interpolation_order (int):  Number of grid nodes per dimension of the projection stencils
+
+    Attributes:
+        grid_origin (numpy.ndarray):    Position of the grid node with indices (0, 0)
+        grid_shape (tuple):             Number of grid nodes in x and y direction
+        max_distance (float):           Largest displacement between grid nodes, as required for the lookup table
+        projection_matrix (scipy.sparse.csr_matrix):    Projection weights with indices [grid node, particle]
+        kernel_fft (numpy.ndarray):     2-D FFT of the coupling kernel on the doubled grid, indices [x, y, n1, n2]
+        correction_matrix (scipy.sparse.csr_matrix):    Precorrection of the near particle pairs in lookup layout
+    """
+    def __init__(self, positions, grid_spacing, interpolation_order=3):
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.grid_spacing = grid_spacing
+        self.interpolation_order = interpolation_order
+        self.grid_origin = (self.positions.min(axis=0)
+                            - ((interpolation_order - 1) // 2 + 0.5) * grid_spacing)
+
+        self.stencil_x = lagrange_stencil(self.positions[:, 0], self.grid_origin[0], grid_spacing, interpolation_order)
+        self.stencil_y = lagrange_stencil(self.positions[:, 1], self.grid_origin[1], grid_spacing, interpolation_order)
+        self.grid_shape = (self.stencil_x[0].max() + 1, self.stencil_y[0].max() + 1)
+        self.max_distance = grid_spacing * np.hypot(*self.grid_shape)
+
+        nump = len(self.positions)
+        nodes = (self.stencil_x[0][:, :, None] * self.grid_shape[1] + self.stencil_y[0][:, None, :]).reshape(nump, -1)
+        weights = (self.stencil_x[1][:, :, None] * self.stencil_y[1][:, None, :]).reshape(nump, -1)
+        particles = np.repeat(np.arange(nump), interpolation_order**2)
+        self.projection_matrix = scipy.sparse.csr_matrix((weights.ravel(), (nodes.ravel(), particles)),
+                                                         shape=(self.grid_shape[0] * self.grid_shape[1], nump))
+
+    def setup(self, lookup_table, radial_distance_array, l_max, m_max, correction_radius=None,
+              interpolator_kind='linear'):
+        """Sample the coupling kernel on the grid and compute the precorrection of the near particle pairs.
+
+        Args:
+            lookup_table (numpy.ndarray):   Radial coupling lookup with indices [rho, n1, n2], covering radial distances
+                                            up to max_distance
+            radial_distance_array (numpy.ndarray):  Radial distances of the lookup table
+            l_max (int):                    Maximal multipole degree of the lookup blocks
+            m_max (int):                    Maximal multipole order of the lookup blocks
+            correction_radius (float or None):  Particle pairs closer than this distance are precorrected. If None,
+                                                use (interpolation_order + 1) * grid_spacing
+            interpolator_kind (str):        'linear' or 'cubic' interpolation of the lookup table
+        """
+        self.lookup_table = lookup_table
+        self.radial_distance_array = radial_distance_array
+        self.interpolator_kind = interpolator_kind
+        m_array = coup.block_m_array(l_max, m_max)
+        self.dm_array = m_array[None, :] - m_array[:, None]  # m2 - m1
+        self.blocksize = len(m_array)
+        if correction_radius is None:
+            correction_radius = (self.interpolation_order + 1) * self.grid_spacing
+
+        # kernel at the displacements between grid nodes, arranged for a circular convolution on the doubled grid
+        padded_shape = (2 * self.grid_shape[0], 2 * self.grid_shape[1])
+        offsets_x = np.arange(padded_shape[0])
+        offsets_x[offsets_x >= self.grid_shape[0]] -= padded_shape[0]
+        offsets_y = np.arange(padded_shape[1])
+        offsets_y[offsets_y >= self.grid_shape[1]] -= padded_shape[1]
+        kernel = np.zeros(padded_shape + (self.blocksize, self.blocksize), dtype=complex)
+        sys.stdout.write('Grid coupling kernel memory footprint: ' + coup.size_format(2 * kernel.nbytes) + '\n')
+        sys.stdout.flush()
+        for ix in tqdm(range(padded_shape[0]), desc='Grid coupling kernel      ', file=sys.stdout,
+                       bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            kernel[ix] = self.lookup_blocks(np.full(padded_shape[1], offsets_x[ix] * self.grid_spacing),
+                                            offsets_y * self.grid_spacing)
+
+        # near pairs, including the self interaction of each particle (which is layer mediated)
+        pairs = scipy.spatial.cKDTree(self.positions).query_pairs(correction_radius, output_type='ndarray')
+        nump = len(self.positions)
+        receiving = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(nump)])
+        emitting = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(nump)])
+
+        rows = []
+        columns = []
+        data = []
+        n_array = np.arange(self.blocksize)
+        chunksize = max(1, 2**20 // self.blocksize**2)
+        for start in tqdm(range(0, len(receiving), chunksize), desc='Precorrection             ', file=sys.stdout,
+                          bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            chunk_receiving = receiving[start:start + chunksize]
+            chunk_emitting = emitting[start:start + chunksize]
+            displacement = self.positions[chunk_receiving] - self.positions[chunk_emitting]
+            blocks = self.lookup_blocks(displacement[:, 0], displacement[:, 1])
+            blocks -= self.grid_blocks(kernel, chunk_receiving, chunk_emitting)
+            rows.append(np.broadcast_to((chunk_receiving * self.blocksize)[:, None, None] + n_array[None, :, None],
+                                        blocks.shape).ravel())
+            columns.append(np.broadcast_to((chunk_emitting * self.blocksize)[:, None, None] + n_array[None, None, :],
+                                           blocks.shape).ravel())
+            data.append(blocks.ravel())
+        self.correction_matrix = scipy.sparse.csr_matrix(
+            (np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+            shape=(nump * self.blocksize, nump * self.blocksize))
+
+        self.kernel_fft = np.fft.fft2(kernel, axes=(0, 1))
+
+    def lookup_blocks(self, displacement_x, displacement_y):
+        """Interpolate the coupling blocks for arrays of in-plane displacements.
+
+        Args:
+            displacement_x (numpy.ndarray):     x-component of receiving minus emitting position
+            displacement_y (numpy.ndarray):     y-component of receiving minus emitting position
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [displacement, n1, n2]
+        """
+        rho = np.hypot(displacement_x, displacement_y)
+        phi = np.arctan2(displacement_y, displacement_x)
+        rho_stencil = coup.lookup_interpolation_stencil(rho, self.radial_distance_array, self.interpolator_kind)
+        w = coup.interpolate_lookup(self.lookup_table, [rho_stencil])
+        w *= np.exp(1j * self.dm_array[None, :, :] * phi[:, None, None])
+        return w
+
+    def grid_blocks(self, kernel, receiving, emitting):
+        """Coupling blocks between pairs of particles as approximated by projection to the grid, convolution with the
+        grid kernel and interpolation.
+
+        Args:
+            kernel (numpy.ndarray):     Grid kernel on the doubled grid with indices [x, y, n1, n2]
+            receiving (numpy.ndarray):  Numbers of the receiving particles
+            emitting (numpy.ndarray):   Numbers of the emitting particles
+
+        Returns:
+            Coupling blocks as complex numpy.ndarray with indices [pair, n1, n2]
+        """
+        (indices_x, weights_x), (indices_y, weights_y) = self.stencil_x, self.stencil_y
+        blocks = np.zeros((len(receiving), self.blocksize, self.blocksize), dtype=complex)
+        order = self.interpolation_order
+        for ax in range(order):
+            for bx in range(order):
+                offset_x = (indices_x[receiving, ax] - indices_x[emitting, bx]) % kernel.shape[0]
+                weight_x = weights_x[receiving, ax] * weights_x[emitting, bx]
+                for ay in range(order):
+                    for by in range(order):
+                        offset_y = (indices_y[receiving, ay] - indices_y[emitting, by]) % kernel.shape[1]
+                        weight = weight_x * weights_y[receiving, ay] * weights_y[emitting, by]
+                        blocks += weight[:, None, None] * kernel[offset_x, offset_y]
+        return blocks
+
+    def matmat(self, in_block):
+        """Multiply the coupling matrix to a block of vectors in lookup layout.
+
+        Args:
+            in_block (numpy.ndarray):   Array of shape [number of particles * blocksize, number of vectors]
+
+        Returns:
+            Coupling matrix times in_block as array of the same shape
+        """
+        nump = len(self.positions)
+        number_vectors = in_block.shape[1]
+        grid = self.projection_matrix.dot(in_block.reshape(nump, -1))
+        grid = grid.reshape(self.grid_shape + (self.blocksize, number_vectors))
+        grid_fft = np.fft.fft2(grid, s=self.kernel_fft.shape[:2], axes=(0, 1))
+        result_fft = np.einsum('xyij,xyjv->xyiv', self.kernel_fft, grid_fft)
+        result_grid = np.fft.ifft2(result_fft, axes=(0, 1))[:self.grid_shape[0], :self.grid_shape[1]]
+        result = self.projection_matrix.T.dot(result_grid.reshape(self.grid_shape[0] * self.grid_shape[1], -1))
+        return result.reshape(in_block.shape) + self.correction_matrix.dot(in_block)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Preconditioners for the iterative solution of the linear system with the master matrix :math:`M = 1 - TW`.
+
+The preconditioners approximate the inverse of the master matrix and are applied from the right, i.e., GMRES solves
+:math:`M P y = T a` and the scattered field coefficients follow from :math:`b = P y`. A preconditioner is set up by
+LinearSystem.prepare, after the T-matrices and the coupling matrix have been computed.
+"""
+
+import smuthi.particle_coupling as coup
+import smuthi.hmatrix as hmat
+import smuthi.particles as part
+import numpy as np
+import scipy.linalg
+import scipy.sparse.linalg
+import sys
+from tqdm import tqdm
+
+
+def spatial_clusters(particle_list, max_cluster_size=10):
+    """Group the particles into spatially compact clusters by recursive coordinate bisection: each group is split at
+    the median particle position along the coordinate axis with the largest extent, until no group has more than
+    max_cluster_size particles.
+
+    Args:
+        particle_list (list):       List of smuthi.particles.Particle objects
+        max_cluster_size (int):     Maximal number of particles per cluster
+
+    Returns:
+        List of integer arrays with the (ascending) particle numbers of each cluster
+    """
+    if max_cluster_size < 1:
+        raise ValueError('The maximal cluster size must be at least 1.')
+    positions = part.particle_positions(particle_list)
+    clusters = []
+    groups = [np.arange(len(particle_list))]
+    while groups:
+        group = groups.pop()
+        if len(group) <= max_cluster_size:
+            clusters.append(np.sort(group))
+            continue
+        group_positions = positions[group]
+        axis = np.argmax(group_positions.max(axis=0) - group_positions.min(axis=0))
+        order = np.argsort(group_positions[:, axis], kind='stable')
+        groups.append(group[order[len(group) // 2:]])
+        groups.append(group[order[:len(group) // 2]])
+    return clusters
+
+
+def cluster_coupling_matrix(linear_system, particle_indices):
+    """Coupling matrix between a group of particles. If the coupling matrix object of the linear system provides a
+    submatrix method (explicit coupling matrix or lookup on the CPU), use it. Otherwise (e.g. lookup on the GPU), the
+    coupling blocks of the group are computed directly.
+
+    Args:
+        linear_system (smuthi.linear_system.LinearSystem):  Linear system with computed T-matrices and coupling matrix
+        particle_indices (numpy.ndarray):                   Numbers of the particles in ascending order
+
+    Returns:
+        Coupling matrix of the particle group as complex numpy.ndarray
+    """
+    coupling_matrix = linear_system.coupling_matrix
+    if hasattr(coupling_matrix, 'submatrix'):
+        return coupling_matrix.submatrix(particle_indices)
+
+    particles = [linear_system.particle_list[i] for i in particle_indices]
+    return coup.coupling_submatrix(linear_system.initial_field.vacuum_wavelength, particles, particles,
+                                   linear_system.layer_system, linear_system.k_parallel)
+
+
+def coupling_submatrix_function(linear_system):
+    """Function that evaluates the coupling matrix between a group of receiving and a group of emitting particles, as
+    required for the compression into a smuthi.hmatrix.HierarchicalMatrix. If the coupling matrix of the linear system
+    is stored, the blocks are copied from it. Otherwise, they are computed directly.
+
+    Args:
+        linear_system (smuthi.linear_system.LinearSystem):  Linear system with computed coupling matrix
+
+    Returns:
+        Function of two arrays of particle numbers (receiving, emitting) that returns a complex numpy.ndarray
+    """
+    coupling_matrix = linear_system.coupling_matrix
+    if hasattr(coupling_matrix.linear_operator, 'A'):
+        def submatrix(receiving, emitting):
+            return coupling_matrix.linear_operator.A[np.ix_(coupling_matrix.index_array(receiving),
+                                                            coupling_matrix.index_array(emitting))]
+    else:
+        particle_list = linear_system.particle_list
+
+        def submatrix(receiving, emitting):
+            return coup.coupling_submatrix(linear_system.initial_field.vacuum_wavelength,
+                                           [particle_list[i] for i in receiving], [particle_list[i] for i in emitting],
+                                           linear_system.layer_system, linear_system.k_parallel)
+    return submatrix
+
+
+class Preconditioner:
+    """Base class for preconditioners of the master matrix. Derived classes implement setup, which is called with the
+    prepared linear system and has to set the linear_operator attribute to a scipy.sparse.linalg.LinearOperator that
+    approximates the inverse of the master matrix.
+    """
+    def __init__(self):
+        self.linear_operator = None
+
+    def setup(self, linear_system):
+        """Compute the preconditioner for a linear system.
+
+        Args:
+            linear_system (smuthi.linear_system.LinearSystem):  Linear system with computed T-matrices and coupling
+                                                                matrix
+        """
+        raise NotImplementedError
+
+
+class ClusterPreconditioner(Preconditioner):
+    r"""Cluster preconditioner: the particles are grouped into spatially compact clusters and for each cluster
+    :math:`c`, the diagonal block :math:`M_{cc} = 1 - T_c W_{cc}` of the master matrix is LU factorized. The
+    preconditioner applies the inverse of the diagonal blocks, such that the strong near-field interactions inside each
+    cluster are resolved exactly.
+
+    Args:
+        max_cluster_size (int):     Maximal number of particles per cluster, see spatial_clusters
+        clusters (list or None):    List of arrays with particle numbers, one per cluster. Each particle needs to be
+                                    in exactly one cluster. If None, the clusters are computed with spatial_clusters
+    """
+    def __init__(self, max_cluster_size=10, clusters=None):
+        Preconditioner.__init__(self)
+        self.max_cluster_size = max_cluster_size
+        self.clusters = clusters
+
+    def setup(self, linear_system):
+        particle_list = linear_system.particle_list
+        t_matrix = linear_system.t_matrix
+        if self.clusters is None:
+            clusters = spatial_clusters(particle_list, self.max_cluster_size)
+        else:
+            clusters = [np.sort(np.asarray(cluster, dtype=int)) for cluster in self.clusters]
+            if not np.array_equal(np.sort(np.concatenate(clusters)), np.arange(len(particle_list))):
+                raise ValueError('Each particle needs to be in exactly one cluster.')
+
+        index_arrays = []
+        lu_factors = []
+        for cluster in tqdm(clusters, desc='Preconditioner            ', file=sys.stdout,
+                            bar_format='{l_bar}{bar}| elapsed: {elapsed} remaining: {remaining}'):
+            t_cluster = scipy.linalg.block_diag(*[particle_list[i].t_matrix for i in cluster])
+            m_cluster = np.eye(len(t_cluster), dtype=complex) - t_cluster.dot(
+                cluster_coupling_matrix(linear_system, cluster))
+            index_arrays.append(t_matrix.index_array(cluster))
+            lu_factors.append(scipy.linalg.lu_factor(m_cluster))
+        self.index_arrays = index_arrays
+        self.lu_factors = lu_factors
+
+        def apply_preconditioner(vector):
+            result = np.zeros(vector.shape, dtype=complex)
+            for idx, lu_piv in zip(index_arrays, lu_factors):
+                result[idx] = scipy.linalg.lu_solve(lu_piv, vector[idx])
+            return result
+
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=t_matrix.shape, matvec=apply_preconditioner,
+                                                                  matmat=apply_preconditioner, dtype=complex)
+
+
+class BlockJacobiPreconditioner(ClusterPreconditioner):
+    r"""Block Jacobi preconditioner: inverse of the single particle diagonal blocks :math:`1 - T_i W_{ii}` of the master
+    matrix. The self coupling :math:`W_{ii}` is due to the layer system and vanishes for particles in a homogeneous
+    medium, in which case this preconditioner is the identity.
+    """
+    def __init__(self):
+        ClusterPreconditioner.__init__(self, max_cluster_size=1)
+
+
+class UserPreconditioner(Preconditioner):
+    """Wrap a preconditioner that is provided by the user.
+
+    Args:
+        preconditioner (scipy.sparse.linalg.LinearOperator or function): Approximate inverse of the master matrix, or
+                                                                         a function that takes the prepared linear
+                                                                         system and returns such a linear operator
+                                                                         (or a matrix)
+    """
+    def __init__(self, preconditioner):
+        Preconditioner.__init__(self)
+        self.preconditioner = preconditioner
+
+    def setup(self, linear_system):
+        if isinstance(self.preconditioner, scipy.sparse.linalg.LinearOperator):
+            preconditioner = self.preconditioner
+        else:
+            preconditioner = self.preconditioner(linear_system)
+        linear_operator = scipy.sparse.linalg.aslinearoperator(preconditioner)
+        if linear_operator.shape != linear_system.t_matrix.shape:
+            raise ValueError('The preconditioner needs to have the shape of the master matrix.')
+        self.linear_operator = linear_operator
+
+
+class HMatrixPreconditioner(Preconditioner):
+    """Inverse of a coarse hierarchical matrix compression of the master matrix, see smuthi.hmatrix. The near-field
+    interactions inside the leaf clusters are resolved exactly and the interactions between clusters up to the
+    compression accuracy, such that GMRES typically converges within a few iterations.
+
+    Args:
+        tolerance (float):  Relative accuracy of the adaptive cross approximation
+        leaf_size (int):    Maximal number of particles per leaf cluster
+    """
+    def __init__(self, tolerance=1e-2, leaf_size=16):
+        Preconditioner.__init__(self)
+        self.tolerance = tolerance
+        self.leaf_size = leaf_size
+
+    def setup(self, linear_system):
+        coupling_hmatrix = hmat.HierarchicalMatrix(linear_system.particle_list,
+                                                   coupling_submatrix_function(linear_system), self.tolerance,
+                                                   self.leaf_size)
+        self.hmatrix = coupling_hmatrix.master_matrix([particle.t_matrix for particle in linear_system.particle_list])
+        self.hmatrix.factorize()
+        self.linear_operator = scipy.sparse.linalg.LinearOperator(shape=linear_system.t_matrix.shape,
+                                                                  matvec=self.hmatrix.solve, matmat=self.hmatrix.solve,
+                                                                  dtype=complex)
+
+
+def preconditioner_object(preconditioner):
+    """Convert the preconditioner argument of a LinearSystem into a Preconditioner object.
+
+    Args:
+        preconditioner (str, Preconditioner, scipy.sparse.linalg.LinearOperator, function or None):
+            'block_jacobi' for BlockJacobiPreconditioner, 'cluster' for ClusterPreconditioner and 'hmatrix' for
+            HMatrixPreconditioner with default settings, a Preconditioner object, or a user preconditioner, see
+            UserPreconditioner.
+
+    Returns:
+        Preconditioner object or None
+    """
+    if preconditioner is None or isinstance(preconditioner, Preconditioner):
+        return preconditioner
+    if isinstance(preconditioner, str):
+        if preconditioner == 'block_jacobi':
+            return BlockJacobiPreconditioner()
+        elif preconditioner == 'cluster':
+            return ClusterPreconditioner()
+        elif preconditioner == 'hmatrix':
+            return HMatrixPreconditioner()
+        raise ValueError('Preconditioner ' + preconditioner + ' is not implemented.')
+    if isinstance(preconditioner, scipy.sparse.linalg.LinearOperator) or callable(preconditioner):
+        return UserPreconditioner(preconditioner)
+    raise ValueError('Invalid preconditioner.')
@@ -9,6 +9,154 @@ import smuthi.layers as lay
 import smuthi.cuda_sources as cu
 import smuthi.post_processing as pp
 import os
+try:
+    import h5py
+    h5py_available = True
+except ImportError:
+    h5py_available = False
+
+# use the C implementation of the YAML parser if libyaml is available
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# columns of the sections of a particle specification file, which are also the columns of the arrays in binary
+# particle specification files
+particle_spec_columns = {
+    'spheres': ['x', 'y', 'z', 'radius', 'refractive index', 'extinction coefficient', 'l_max', 'm_max'],
+    'spheroids': ['x', 'y', 'z', 'semi-axis c', 'semi-axis a', 'polar angle', 'azimuthal angle', 'refractive index',
+                  'extinction coefficient', 'l_max', 'm_max'],
+    'cylinders': ['x', 'y', 'z', 'cylinder radius', 'cylinder height', 'polar angle', 'azimuthal angle',
+                  'refractive index', 'extinction coefficient', 'l_max', 'm_max']}
+
+# file name extensions of binary particle specification files
+npz_extensions = ('.npz',)
+hdf5_extensions = ('.h5', '.hdf5')
+
+
+def particles_from_array(section, data):
+    """Create particle objects from the rows of a particle specification array.
+
+    Args:
+        section (str):          'spheres', 'spheroids' or 'cylinders'
+        data (numpy.ndarray):   Array of shape [number of particles, number of columns], with the columns as listed in
+                                particle_spec_columns[section]
+
+    Returns:
+        list of smuthi.particles.Particle objects
+    """
+    data = np.asarray(data, dtype=float).reshape(-1, len(particle_spec_columns[section]))
+    positions = data[:, :3].tolist()
+    refractive_indices = (data[:, -4] + 1j * data[:, -3]).tolist()
+    l_max = data[:, -2].astype(int).tolist()
+    m_max = data[:, -1].astype(int).tolist()
+    if section == 'spheres':
+        radii = data[:, 3].tolist()
+        return [part.Sphere(position=positions[i], refractive_index=refractive_indices[i], radius=radii[i],
+                            l_max=l_max[i], m_max=m_max[i]) for i in range(len(data))]
+    size_1, size_2, polar_angles, azimuthal_angles = data[:, 3:7].T.tolist()
+    if section == 'spheroids':
+        return [part.Spheroid(position=positions[i], polar_angle=polar_angles[i], azimuthal_angle=azimuthal_angles[i],
+                              refractive_index=refractive_indices[i], semi_axis_c=size_1[i], semi_axis_a=size_2[i],
+                              l_max=l_max[i], m_max=m_max[i]) for i in range(len(data))]
+    if section == 'cylinders':
+        return [part.FiniteCylinder(position=positions[i], polar_angle=polar_angles[i],
+                                    azimuthal_angle=azimuthal_angles[i], refractive_index=refractive_indices[i],
+                                    cylinder_radius=size_1[i], cylinder_height=size_2[i], l_max=l_max[i],
+                                    m_max=m_max[i]) for i in range(len(data))]
+    raise ValueError('Unknown particle section: ' + section)
+
+
+def particle_spec_arrays(filename):
+    """Read a particle specification file into one array per section.
+
+    Text files consist of sections of whitespace separated numbers. Each section starts with a comment line that ends
+    with 'spheres', 'spheroids' or 'cylinders' (if the first section has no such line, it contains spheres). The
+    sections are parsed with numpy.loadtxt. Binary files (.npz, or .h5/.hdf5 if h5py is installed) contain one array
+    per section type, named after it.
+
+    Args:
+        filename (str):    path and filename of the particle specification file
+
+    Returns:
+        list of (section, array) tuples in the order of the file, with the columns as listed in particle_spec_columns
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in npz_extensions:
+        with np.load(filename) as data:
+            return [(section, data[section]) for section in particle_spec_columns if section in data.files]
+    if extension in hdf5_extensions:
+        if not h5py_available:
+            raise ImportError('Reading HDF5 particle specification files requires h5py.')
+        with h5py.File(filename, 'r') as data:
+            return [(section, data[section][()]) for section in particle_spec_columns if section in data]
+
+    with open(filename, 'r') as particle_specs_file:
+        lines = particle_specs_file.read().splitlines()
+    header_rows = [i for i, line in enumerate(lines)
+                   if line.lstrip().startswith('#') and line.split()[-1] in particle_spec_columns]
+    section_names = ['spheres'] + [lines[i].split()[-1] for i in header_rows]
+    section_starts = [0] + [i + 1 for i in header_rows]
+    section_ends = header_rows + [len(lines)]
+    sections = []
+    for section, start, end in zip(section_names, section_starts, section_ends):
+        section_lines = lines[start:end]
+        if any(line.strip() and not line.lstrip().startswith('#') for line in section_lines):
+            sections.append((section, np.loadtxt(section_lines, comments='#', ndmin=2)))
+    return sections
+
+
+def read_particle_specs(filename):
+    """Read the particles from a particle specification file, see particle_spec_arrays.
+
+    Args:
+        filename (str):    path and filename of the particle specification file
+
+    Returns:
+        list of smuthi.particles.Particle objects
+    """
+    particle_list = []
+    for section, data in particle_spec_arrays(filename):
+        particle_list.extend(particles_from_array(section, data))
+    return particle_list
+
+
+def write_particle_specs(filename, particle_list):
+    """Write spheres, spheroids and finite cylinders to a binary particle specification file (.npz, or .h5/.hdf5 if
+    h5py is installed). The particles are stored grouped by their type, i.e., the order is only preserved within each
+    type.
+
+    Args:
+        filename (str):         path and filename of the particle specification file
+        particle_list (list):   list of smuthi.particles.Particle objects
+    """
+    rows = {section: [] for section in particle_spec_columns}
+    for particle in particle_list:
+        common = [particle.refractive_index.real, particle.refractive_index.imag, particle.l_max, particle.m_max]
+        if type(particle).__name__ == 'Sphere':
+            rows['spheres'].append(list(particle.position) + [particle.radius] + common)
+        elif type(particle).__name__ == 'Spheroid':
+            rows['spheroids'].append(list(particle.position) + [particle.semi_axis_c, particle.semi_axis_a,
+                                                                particle.euler_angles[1], particle.euler_angles[0]]
+                                     + common)
+        elif type(particle).__name__ == 'FiniteCylinder':
+            rows['cylinders'].append(list(particle.position) + [particle.cylinder_radius, particle.cylinder_height,
+                                                                particle.euler_angles[1], particle.euler_angles[0]]
+                                     + common)
+        else:
+            raise ValueError('Currently, only spheres, spheroids and finite cylinders are implemented')
+    arrays = {section: np.array(rows[section], dtype=float).reshape(-1, len(columns))
+              for section, columns in particle_spec_columns.items() if rows[section]}
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in npz_extensions:
+        np.savez(filename, **arrays)
+    elif extension in hdf5_extensions:
+        if not h5py_available:
+            raise ImportError('Writing HDF5 particle specification files requires h5py.')
+        with h5py.File(filename, 'w') as data:
+            for section, array in arrays.items():
+                data.create_dataset(section, data=array)
+    else:
+        raise ValueError('Binary particle specification files need the extension .npz, .h5 or .hdf5')
 
 
 def read_input_yaml(filename):
@@ -22,7 +170,7 @@ def read_input_yaml(filename):
     """
     print('Reading ' + os.path.abspath(filename))
     with open(filename, 'r') as input_file:
-        input_data = yaml.load(input_file.read())
+        input_data = yaml.load(input_file.read(), Loader=yaml_loader)
 
     cu.enable_gpu(input_data.get('enable GPU', False))
 
@@ -68,49 +216,7 @@ def read_input_yaml(filename):
     particle_list = []
     particle_input = input_data['scattering particles']
     if isinstance(particle_input, str):
-        particle_type = 'sphere'
-        with open(particle_input, 'r') as particle_specs_file:
-            for line in particle_specs_file:
-                if len(line.split()) > 0:
-                    if line.split()[-1] == 'spheres':
-                        particle_type = 'sphere'
-                    elif line.split()[-1] == 'spheroids':
-                        particle_type = 'spheroid'
-                    elif line.split()[-1] == 'cylinders':
-                        particle_type = 'finite cylinder'
-                    if not line.split()[0] == '#':
-                        numeric_line_data = [float(x) for x in line.split()]
-                        pos = numeric_line_data[:3]
-                        if particle_type == 'sphere':
-                            r = numeric_line_data[3]
-                            n = numeric_line_data[4] + 1j * numeric_line_data[5]
-                            l_max = int(numeric_line_data[6])
-                            m_max = int(numeric_line_data[7])
-                            particle_list.append(part.Sphere(position=pos, refractive_index=n, radius=r, l_max=l_max,
-                                                             m_max=m_max))
-                        if particle_type == 'spheroid':
-                            c = numeric_line_data[3]
-                            a = numeric_line_data[4]
-                            beta = numeric_line_data[5]
-                            alpha = numeric_line_data[6]
-                            n = numeric_line_data[7] + 1j * numeric_line_data[8]
-                            l_max = int(numeric_line_data[9])
-                            m_max = int(numeric_line_data[10])
-                            particle_list.append(part.Spheroid(position=pos, polar_angle=beta, azimuthal_angle=beta, 
-                                                               refractive_index=n, semi_axis_c=c, semi_axis_a=a, 
-                                                               l_max=l_max, m_max=m_max))
-                        if particle_type == 'finite cylinder':
-                            r = numeric_line_data[3]
-                            h = numeric_line_data[4]
-                            beta = numeric_line_data[5]
-                            alpha = numeric_line_data[6]
-                            n = numeric_line_data[7] + 1j * numeric_line_data[8]
-                            l_max = int(numeric_line_data[9])
-                            m_max = int(numeric_line_data[10])
-                            particle_list.append(part.FiniteCylinder(position=pos, polar_angle=beta, 
-                                                                     azimuthal_angle=beta, refractive_index=n,
-                                                                     cylinder_radius=r, cylinder_height=h, l_max=l_max,
-                                                                     m_max=m_max))
+        particle_list = read_particle_specs(particle_input)
     else:
         for prtcl in input_data['scattering particles']:
             n = (float(prtcl['refractive index']) + 1j * float(prtcl['extinction coefficient']))
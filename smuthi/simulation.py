@@ -24,7 +24,9 @@ class Simulation:
         k_parallel (numpy.ndarray or str):      in-plane wavenumber for Sommerfeld integrals. if 'default', keep what is
                                                 in smuthi.coordinates.default_k_parallel
         solver_type (str):                      What solver type to use? 
-                                                Options: 'LU' for LU factorization, 'gmres' for GMRES iterative solver
+                                                Options: 'LU' for LU factorization, 'gmres' for GMRES iterative solver,
+                                                'hmatrix' for hierarchical matrix factorization, 'LU_mixed' for
+                                                single precision LU factorization with iterative refinement
         coupling_matrix_lookup_resolution (float or None): If type float, compute particle coupling by interpolation of
                                                            a lookup table with that spacial resolution. If None
                                                            (default), don't use a lookup table but compute the coupling
@@ -38,13 +40,36 @@ class Simulation:
         save_after_run(bool):   if true, the simulation object is exported to disc when over
         log_to_file(bool):      if true, the simulation log will be written to a log file
         log_to_terminal(bool):  if true, the simulation progress will be displayed in the terminal
+        krylov_recycler (smuthi.krylov.KrylovRecycler or None): if not None and solver_type is 'gmres', the linear
+                                                                system is solved with GCRO-DR, recycling the Krylov
+                                                                subspace of previous simulations with the same recycler
+        preconditioner (str, smuthi.preconditioners.Preconditioner or None): right preconditioner for the 'gmres'
+                                                                             solver type, see
+                                                                             smuthi.linear_system.LinearSystem
+        fmm_tolerance (float or None):          if type float, evaluate the direct particle coupling with the fast
+                                                multipole method with that targeted accuracy and the layer mediated
+                                                coupling separately (gmres solver type only), see
+                                                smuthi.linear_system.LinearSystem
+        pfft_grid_spacing (float, str or None): if not None, apply the radial lookup based coupling matrix by the
+                                                precorrected FFT method on a grid with that spacing (gmres solver type
+                                                only), see smuthi.linear_system.LinearSystem
+        lattice (smuthi.lattice.Lattice, str or None):  if not None, compute the coupling matrix from the blocks of
+                                                        the lattice displacements ('detect' to detect the lattice), see
+                                                        smuthi.linear_system.LinearSystem
+        out_of_core_directory (str or None):    if not None, store the explicit coupling matrix and its LU factors in
+                                                memory-mapped files in that directory, see
+                                                smuthi.linear_system.LinearSystem
+        number_of_threads (int or None):        number of threads for the assembly of the explicit coupling matrix. If
+                                                None, use smuthi.linear_system.default_number_of_threads
     """
 
     def __init__(self, layer_system=None, particle_list=None, initial_field=None, post_processing=None,
                  k_parallel='default', solver_type='LU', solver_tolerance=1e-4, store_coupling_matrix=True,
                  coupling_matrix_lookup_resolution=None, coupling_matrix_interpolator_kind='linear',
                  length_unit='length unit', input_file=None, output_dir='smuthi_output', save_after_run=False,
-                 log_to_file=False, log_to_terminal=True):
+                 log_to_file=False, log_to_terminal=True, krylov_recycler=None, preconditioner=None,
+                 fmm_tolerance=None, pfft_grid_spacing=None, lattice=None, out_of_core_directory=None,
+                 number_of_threads=None):
 
         # initialize attributes
         self.layer_system = layer_system
@@ -59,6 +84,13 @@ class Simulation:
         self.post_processing = post_processing
         self.length_unit = length_unit
         self.save_after_run = save_after_run
+        self.krylov_recycler = krylov_recycler
+        self.preconditioner = preconditioner
+        self.fmm_tolerance = fmm_tolerance
+        self.pfft_grid_spacing = pfft_grid_spacing
+        self.lattice = lattice
+        self.out_of_core_directory = out_of_core_directory
+        self.number_of_threads = number_of_threads
 
         # output
         timestamp = '{:%Y%m%d%H%M%S}'.format(datetime.datetime.now())
@@ -83,6 +115,13 @@ class Simulation:
          self.solver_tolerance, self.store_coupling_matrix, self.coupling_matrix_lookup_resolution,
          self.coupling_matrix_interpolator_kind, self.post_processing, self.length_unit, self.save_after_run,
          coord.default_k_parallel, coord.default_polar_angles, coord.default_azimuthal_angles) = state
+        self.krylov_recycler = None
+        self.preconditioner = None
+        self.fmm_tolerance = None
+        self.pfft_grid_spacing = None
+        self.lattice = None
+        self.out_of_core_directory = None
+        self.number_of_threads = None
         
     def print_simulation_header(self):
         version = pkg_resources.get_distribution("smuthi").version
@@ -111,7 +150,14 @@ class Simulation:
                                                solver_tolerance=self.solver_tolerance,
                                                store_coupling_matrix=self.store_coupling_matrix,
                                                coupling_matrix_lookup_resolution=self.coupling_matrix_lookup_resolution,
-                                               interpolator_kind=self.coupling_matrix_interpolator_kind)
+                                               interpolator_kind=self.coupling_matrix_interpolator_kind,
+                                               krylov_recycler=self.krylov_recycler,
+                                               preconditioner=self.preconditioner,
+                                               fmm_tolerance=self.fmm_tolerance,
+                                               pfft_grid_spacing=self.pfft_grid_spacing,
+                                               lattice=self.lattice,
+                                               out_of_core_directory=self.out_of_core_directory,
+                                               number_of_threads=self.number_of_threads)
     
     def run(self):
         """Start the simulation."""
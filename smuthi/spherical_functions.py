@@ -148,7 +148,7 @@ def dx_xh(n, x):
     return res
 
 
-@memo.Memoize
+@memo.memoize(max_bytes=2**22, max_entries=None)
 def factorial(n):
     """Return factorial.
 
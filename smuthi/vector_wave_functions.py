@@ -347,7 +347,7 @@ def translation_coefficients_svwf_out_to_out(tau1, l1, m1, tau2, l2, m2, k, d, s
     return A
 
 
-@memo.Memoize
+@memo.memoize(max_bytes=2**26, max_entries=None)
 # @jit(complex128[:](int32, int32, int32, int32, int32),
 #      nopython=True, cache=True)
 def ab5_coefficients(l1, m1, l2, m2, p):
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Test the batched interpolation of coupling lookup tables in particle_coupling.py"""
+
+import numpy as np
+import smuthi.particle_coupling as coup
+
+
+resolution = 0.5
+rho_grid = np.arange(-3 * resolution, 20 + 3 * resolution, resolution)
+z_grid = np.arange(-5 - 3 * resolution, 5 + 3 * resolution, resolution)
+coefficients = np.random.rand(2, 2) + 1j * np.random.rand(2, 2)
+
+
+def table_function(rho, z):
+    return (coefficients[None, :, :] * (1 + 0.3 * rho + 0.02 * rho**2)[:, None, None]
+            * (2 - 0.1 * z + 0.05 * z**2)[:, None, None])
+
+
+def test_stencil_weights():
+    x = np.random.rand(50) * 20
+    for kind in ['linear', 'cubic']:
+        indices, weights = coup.lookup_interpolation_stencil(x, rho_grid, kind)
+        np.testing.assert_allclose(weights.sum(axis=-1), 1)
+        np.testing.assert_allclose((weights * rho_grid[indices]).sum(axis=-1), x)
+
+
+def test_volume_interpolation():
+    rho = np.random.rand(30) * 20
+    z = (np.random.rand(30) - 0.5) * 10
+    table = table_function(np.repeat(rho_grid, len(z_grid)), np.tile(z_grid, len(rho_grid)))
+    table = table.reshape(len(rho_grid), len(z_grid), 2, 2)
+
+    # cubic interpolation reproduces quadratic polynomials
+    stencils = [coup.lookup_interpolation_stencil(rho, rho_grid, 'cubic'),
+                coup.lookup_interpolation_stencil(z, z_grid, 'cubic')]
+    np.testing.assert_allclose(coup.interpolate_lookup(table, stencils), table_function(rho, z), rtol=1e-10)
+
+    stencils = [coup.lookup_interpolation_stencil(rho, rho_grid, 'linear'),
+                coup.lookup_interpolation_stencil(z, z_grid, 'linear')]
+    np.testing.assert_allclose(coup.interpolate_lookup(table, stencils), table_function(rho, z), rtol=1e-2)
+
+
+def test_radial_interpolation():
+    rho = np.random.rand(30) * 20
+    table = table_function(rho_grid, np.zeros(len(rho_grid)))
+    stencils = [coup.lookup_interpolation_stencil(rho, rho_grid, 'cubic')]
+    np.testing.assert_allclose(coup.interpolate_lookup(table, stencils), table_function(rho, np.zeros(30)),
+                               rtol=1e-10)
+
+
+if __name__ == '__main__':
+    test_stencil_weights()
+    test_volume_interpolation()
+    test_radial_interpolation()
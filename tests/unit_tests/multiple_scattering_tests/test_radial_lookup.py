@@ -133,7 +133,22 @@ def test_result():
     relerr = np.linalg.norm(coefficients_lookup_cubic_gpu - coefficients_direct) / np.linalg.norm(coefficients_direct)
     print('relative error coefficient solution cubic interpolation GPU: ', relerr)
     assert relerr < 5e-4    
+
+
+def test_cpu_kernels():
+    for kind in ['linear', 'cubic']:
+        coup_mat_precomputed = linsys.CouplingMatrixRadialLookupCPU(vacuum_wavelength, particle_list, lay_sys,
+                                                                    resolution=lookup_resol, interpolator_kind=kind)
+        coup_mat_on_the_fly = linsys.CouplingMatrixRadialLookupCPU(vacuum_wavelength, particle_list, lay_sys,
+                                                                   resolution=lookup_resol, interpolator_kind=kind,
+                                                                   memory_budget=0)
+        M_precomputed_test_vec = coup_mat_precomputed.linear_operator(test_vec)
+        M_on_the_fly_test_vec = coup_mat_on_the_fly.linear_operator(test_vec)
+        relerr = np.linalg.norm(M_precomputed_test_vec - M_on_the_fly_test_vec) / np.linalg.norm(M_on_the_fly_test_vec)
+        assert relerr < 1e-6
+
     
 if __name__ == '__main__':
     test_linear_operator()
     test_result()
+    test_cpu_kernels()
@@ -8,6 +8,7 @@ import smuthi.simulation as simul
 import smuthi.particle_coupling as coup
 import smuthi.field_expansion as fldex
 import smuthi.cuda_sources as cu
+import smuthi.linear_system as linsys
 
 # Parameter input ----------------------------
 vacuum_wavelength = 550
@@ -90,6 +91,14 @@ simulation_lookup_cubic_cpu = simul.Simulation(layer_system=lay_sys, particle_li
 simulation_lookup_cubic_cpu.run()
 coefficients_lookup_cubic_cpu = particle_list[0].scattered_field.coefficients
 
+simulation_lookup_cubic_lu = simul.Simulation(layer_system=lay_sys, particle_list=particle_list, 
+                                              initial_field=init_fld, solver_type='LU', store_coupling_matrix=True,
+                                              coupling_matrix_lookup_resolution=lookup_resol, 
+                                              coupling_matrix_interpolator_kind='cubic',
+                                              log_to_terminal=False)
+simulation_lookup_cubic_lu.run()
+coefficients_lookup_cubic_lu = particle_list[0].scattered_field.coefficients
+
 test_vec = np.arange(simulation_lookup_linear_cpu.linear_system.master_matrix.shape[0])
 M_direct_test_vec = simulation_direct.linear_system.coupling_matrix.linear_operator(test_vec)
 M_linear_cpu_test_vec = simulation_lookup_linear_cpu.linear_system.coupling_matrix.linear_operator(test_vec)
@@ -131,7 +140,32 @@ def test_result():
     relerr = np.linalg.norm(coefficients_lookup_cubic_gpu - coefficients_direct) / np.linalg.norm(coefficients_direct)
     print('relative error coefficient solution cubic interpolation GPU: ', relerr)
     assert relerr < 5e-4
+
+
+def test_memory_budget_fallback():
+    coup_mat_precomputed = linsys.CouplingMatrixVolumeLookupCPU(vacuum_wavelength, particle_list, lay_sys,
+                                                                resolution=lookup_resol, interpolator_kind='cubic')
+    coup_mat_on_the_fly = linsys.CouplingMatrixVolumeLookupCPU(vacuum_wavelength, particle_list, lay_sys,
+                                                               resolution=lookup_resol, interpolator_kind='cubic',
+                                                               memory_budget=0)
+    assert hasattr(coup_mat_precomputed, 'precomputed_matrix')
+    assert not hasattr(coup_mat_on_the_fly, 'precomputed_matrix')
+    M_precomputed_test_vec = coup_mat_precomputed.linear_operator(test_vec)
+    M_on_the_fly_test_vec = coup_mat_on_the_fly.linear_operator(test_vec)
+    relerr = np.linalg.norm(M_precomputed_test_vec - M_on_the_fly_test_vec) / np.linalg.norm(M_on_the_fly_test_vec)
+    assert relerr < 1e-6
+
+
+def test_explicit_lookup_matrix():
+    coupling_matrix = simulation_lookup_cubic_lu.linear_system.coupling_matrix
+    assert isinstance(coupling_matrix, linsys.CouplingMatrixVolumeLookupCPU)
+    assert coupling_matrix.linear_operator.A.dtype == complex
+    relerr = np.linalg.norm(coefficients_lookup_cubic_lu - coefficients_direct) / np.linalg.norm(coefficients_direct)
+    assert relerr < 5e-4
+
     
 if __name__ == '__main__':
     test_linear_operator()
     test_result()
+    test_memory_budget_fallback()
+    test_explicit_lookup_matrix()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""Test the block GMRES solver in krylov.py"""
+import numpy as np
+import scipy.sparse.linalg
+import smuthi.krylov as krylov
+
+
+def test_block_gmres():
+    np.random.seed(0)
+    n, p = 200, 5
+    a = np.eye(n) + 0.3 * (np.random.randn(n, n) + 1j * np.random.randn(n, n)) / np.sqrt(n)
+    rhs = np.random.randn(n, p) + 1j * np.random.randn(n, p)
+    rhs[:, 3] = rhs[:, 0] + rhs[:, 1]  # linearly dependent right hand sides
+    matmat_calls = []
+
+    def matmat(x):
+        matmat_calls.append(x.shape)
+        return a.dot(x)
+
+    linear_operator = scipy.sparse.linalg.LinearOperator(shape=(n, n), matvec=matmat, matmat=matmat, dtype=complex)
+    x, info = krylov.block_gmres(linear_operator, rhs, tol=1e-8, restart=10)
+    assert info == 0
+    relerr = np.linalg.norm(a.dot(x) - rhs, axis=0) / np.linalg.norm(rhs, axis=0)
+    assert np.all(relerr < 1e-8)
+    assert all(shape == (n, p) for shape in matmat_calls)
+
+
+if __name__ == '__main__':
+    test_block_gmres()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Test the disk cache defined in disk_cache.py"""
+
+import shutil
+import tempfile
+import numpy as np
+import smuthi.disk_cache as dc
+import smuthi.layers as lay
+
+
+def test_store_and_load_entry():
+    directory = tempfile.mkdtemp()
+    try:
+        dc.set_cache_directory(directory)
+        key = dc.entry_key('test', a=np.arange(5), b=[1, 2.5])
+        assert key == dc.entry_key('test', b=[1, 2.5], a=np.arange(5))
+        assert key != dc.entry_key('test', a=np.arange(5), b=[1, 2.6])
+        assert dc.load(key) is None
+        entry = dc.store(key, x=np.arange(10) * 1j)
+        entry2 = dc.store(key, x=np.arange(10) * 1j)   # entry exists already, e.g. written by another process
+        assert isinstance(entry['x'], np.memmap)
+        np.testing.assert_array_equal(entry2['x'], np.arange(10) * 1j)
+        np.testing.assert_array_equal(dc.load(key)['x'], np.arange(10) * 1j)
+    finally:
+        dc.set_cache_directory(None)
+        shutil.rmtree(directory)
+
+
+def test_layer_response_from_disk():
+    directory = tempfile.mkdtemp()
+    kpar = np.linspace(0, 0.03, 200) + 0.001j
+    try:
+        l0 = lay.layersystem_response_matrix(1, [0, 250, 0], [1, 2 + 0.1j, 1.5], kpar, 0.011, 1, 2)
+        dc.set_cache_directory(directory)
+        l1 = lay.layersystem_response_matrix(1, [0, 250, 0], [1, 2 + 0.1j, 1.5], kpar, 0.011, 1, 2)
+        lay.layersystem_response_matrix.cache.clear()
+        l2 = lay.layersystem_response_matrix(1, [0, 250, 0], [1, 2 + 0.1j, 1.5], kpar, 0.011, 1, 2)
+        assert isinstance(l2, np.memmap)
+        np.testing.assert_array_equal(l1, l0)
+        np.testing.assert_array_equal(l2, l0)
+    finally:
+        dc.set_cache_directory(None)
+        lay.layersystem_response_matrix.cache.clear()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    test_store_and_load_entry()
+    test_layer_response_from_disk()
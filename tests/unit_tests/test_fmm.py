@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Test the fast multipole method for the direct particle coupling"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.particle_coupling as coup
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.fmm as fmm
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 1000
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+# explicit contour, such that the result does not depend on the default set by other test modules
+k_parallel = coord.complex_contour(vacuum_wavelength, neff_waypoints, neff_discr)
+np.random.seed(1)
+lay_sys = lay.LayerSystem([0, 0], [1, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+grid = 50 + np.arange(4) * 110
+positions = np.array([[x, y, z] for x in grid for y in grid for z in grid]) + (np.random.rand(64, 3) - 0.5) * 40
+particle_list = [part.Sphere(position=list(position), refractive_index=2, radius=30, l_max=1, m_max=1)
+                 for position in positions]
+
+
+def test_octree():
+    octree = fmm.Octree(positions, max_leaf_size=1, separation=2)
+    assert octree.depth == 2
+    receiving, emitting = octree.near_field_pairs()
+    interactions = octree.interaction_list(2)
+    number_far_pairs = sum(np.bincount(octree.particle_box)[targets].dot(np.bincount(octree.particle_box)[sources])
+                           for _, targets, sources in interactions)
+    assert len(receiving) + number_far_pairs == len(particle_list) * (len(particle_list) - 1)
+
+
+def test_fmm_matvec():
+    w = coup.direct_coupling_matrix(vacuum_wavelength, particle_list, lay_sys)
+    direct_fmm = fmm.DirectCouplingFMM(vacuum_wavelength, particle_list, lay_sys, tolerance=1e-2, max_leaf_size=1)
+    assert direct_fmm.near_field_matrix.nnz < w.size
+    x = np.random.rand(w.shape[0], 2) + 1j * np.random.rand(w.shape[0], 2)
+    wx = w.dot(x)
+    assert np.linalg.norm(direct_fmm.linear_operator.matmat(x) - wx) / np.linalg.norm(wx) < 1e-2
+
+
+def test_fmm_linear_system():
+    coefficients = []
+    for solver_type, fmm_tolerance in [('LU', None), ('gmres', 1e-2)]:
+        linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave,
+                                            layer_system=lay_sys, k_parallel=k_parallel, solver_type=solver_type,
+                                            solver_tolerance=1e-6, fmm_tolerance=fmm_tolerance)
+        linear_system.prepare()
+        linear_system.solve()
+        coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particle_list]))
+    assert np.linalg.norm(coefficients[1] - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-2
+
+
+def test_fmm_layered_medium():
+    # layer mediated coupling by 3D lookup (particles in the same layer) or explicitly (particles in different layers)
+    layered_system = lay.LayerSystem([0, 0], [1.5, 1])
+    two_layer_particle_list = [part.Sphere(position=list(position - [0, 0, 110]), refractive_index=2, radius=30,
+                                           l_max=1, m_max=1) for position in positions]
+    for particles, lookup_resolution in [(particle_list, 5), (two_layer_particle_list, None)]:
+        coefficients = []
+        for solver_type, fmm_tolerance in [('LU', None), ('gmres', 1e-2)]:
+            linear_system = linsys.LinearSystem(particle_list=particles, initial_field=plane_wave,
+                                                layer_system=layered_system, k_parallel=k_parallel,
+                                                solver_type=solver_type, solver_tolerance=1e-6,
+                                                fmm_tolerance=fmm_tolerance,
+                                                coupling_matrix_lookup_resolution=lookup_resolution,
+                                                interpolator_kind='cubic')
+            linear_system.prepare()
+            linear_system.solve()
+            coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particles]))
+        assert np.linalg.norm(coefficients[1] - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-2
+
+
+if __name__ == '__main__':
+    test_octree()
+    test_fmm_matvec()
+    test_fmm_linear_system()
+    test_fmm_layered_medium()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Test the hierarchical matrix compression and factorization of the linear system"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.hmatrix as hmat
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+np.random.seed(3)
+lay_sys = lay.LayerSystem([0, 400, 0], [1.5, 1.8, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+positions = np.random.rand(24, 3) * [2000, 2000, 200] + [0, 0, 100]
+particle_list = [part.Sphere(position=list(position), refractive_index=2.4, radius=50, l_max=2, m_max=2)
+                 for position in positions]
+
+
+def test_cluster_tree():
+    root, order = hmat.cluster_tree(positions, leaf_size=4)
+    assert np.array_equal(np.sort(order), np.arange(len(positions)))
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        if node.children:
+            assert node.children[0].particle_start == node.particle_start
+            assert node.children[0].particle_end == node.children[1].particle_start
+            assert node.children[1].particle_end == node.particle_end
+            nodes.extend(node.children)
+        else:
+            assert node.particle_end - node.particle_start <= 4
+
+
+def test_adaptive_cross_approximation():
+    x = np.linspace(0, 1, 30)
+    matrix = 1 / (2 + x[:, None] + x[None, :]) + 0j
+    offsets = np.arange(0, 31, 3)
+    u, vt = hmat.adaptive_cross_approximation(lambda i: matrix[offsets[i]:offsets[i + 1]],
+                                              lambda j: matrix[:, offsets[j]:offsets[j + 1]],
+                                              offsets, offsets, tolerance=1e-8)
+    assert u.shape[1] < 15
+    assert np.linalg.norm(u.dot(vt) - matrix) / np.linalg.norm(matrix) < 1e-7
+
+
+def test_hmatrix_coupling_matrix():
+    coup_mat = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys)
+    coup_mat_h = linsys.CouplingMatrixHierarchical(vacuum_wavelength, particle_list, lay_sys, tolerance=1e-6,
+                                                   leaf_size=4)
+    assert coup_mat_h.hmatrix.relative_error_estimate() < 1e-5
+    x = np.random.rand(coup_mat.shape[0], 2) + 1j * np.random.rand(coup_mat.shape[0], 2)
+    wx = coup_mat.linear_operator.matmat(x)
+    assert np.linalg.norm(coup_mat_h.linear_operator.matmat(x) - wx) / np.linalg.norm(wx) < 1e-5
+
+
+def test_hmatrix_linear_system():
+    coefficients = []
+    for solver_type, preconditioner in [('LU', None), ('hmatrix', None), ('gmres', 'hmatrix')]:
+        linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave,
+                                            layer_system=lay_sys, solver_type=solver_type, solver_tolerance=1e-7,
+                                            preconditioner=preconditioner)
+        linear_system.prepare()
+        linear_system.solve()
+        coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particle_list]))
+    for b in coefficients[1:]:
+        assert np.linalg.norm(b - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-5
+
+
+if __name__ == '__main__':
+    test_cluster_tree()
+    test_adaptive_cross_approximation()
+    test_hmatrix_coupling_matrix()
+    test_hmatrix_linear_system()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Test the GCRO-DR solver and the Krylov subspace recycling in krylov.py"""
+import numpy as np
+import scipy.sparse.linalg
+import smuthi.krylov as krylov
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.simulation as simul
+
+
+def test_gcro_dr_sequence():
+    np.random.seed(1)
+    n = 300
+    q = np.linalg.qr(np.random.randn(n, n) + 1j * np.random.randn(n, n))[0]
+    eigenvalues = np.concatenate([np.linspace(0.01, 0.05, 8), 1 + 0.5 * (np.random.rand(n - 8) - 0.5)])
+    a0 = q.dot(np.diag(eigenvalues)).dot(q.conj().T)
+    rhs = np.random.randn(n) + 1j * np.random.randn(n)
+    recycler = krylov.KrylovRecycler(recycle_dimension=8, restart=15)
+    for step in range(4):
+        a = a0 + 0.002 * step * np.random.randn(n, n) / np.sqrt(n)
+        x, info = recycler.solve(scipy.sparse.linalg.aslinearoperator(a), rhs, tol=1e-8, parameter=float(step))
+        assert info == 0
+        assert np.linalg.norm(a.dot(x) - rhs) / np.linalg.norm(rhs) < 1e-8
+    iterations = [stats['iterations'] for stats in recycler.step_statistics]
+    assert max(iterations[1:]) < iterations[0]
+
+
+def test_wavelength_sweep():
+    sphere1 = part.Sphere(position=[100, 100, 150], refractive_index=2.4 + 0.0j, radius=110, l_max=3, m_max=3)
+    sphere2 = part.Sphere(position=[-100, -100, 250], refractive_index=1.9 + 0.0j, radius=120, l_max=3, m_max=3)
+    particle_list = [sphere1, sphere2]
+    lay_sys = lay.LayerSystem([0, 400, 0], [2, 1.4, 2])
+    recycler = krylov.KrylovRecycler(recycle_dimension=5, restart=20)
+    for vacuum_wavelength in [550, 555, 560]:
+        init_fld = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8,
+                                  azimuthal_angle=np.pi * 1/3, polarization=0)
+        simulation_lu = simul.Simulation(layer_system=lay_sys, particle_list=particle_list, initial_field=init_fld,
+                                         solver_type='LU', log_to_terminal=False)
+        simulation_lu.run()
+        coefficients_lu = sphere1.scattered_field.coefficients
+        simulation_recycling = simul.Simulation(layer_system=lay_sys, particle_list=particle_list,
+                                                initial_field=init_fld, solver_type='gmres', solver_tolerance=1e-8,
+                                                krylov_recycler=recycler, log_to_terminal=False)
+        simulation_recycling.run()
+        relerr = (np.linalg.norm(sphere1.scattered_field.coefficients - coefficients_lu)
+                  / np.linalg.norm(coefficients_lu))
+        assert relerr < 1e-6
+    assert len(recycler.step_statistics) == 3
+
+
+if __name__ == '__main__':
+    test_gcro_dr_sequence()
+    test_wavelength_sweep()
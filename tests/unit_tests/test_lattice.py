@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Test the block-Toeplitz coupling matrix for particles on regular lattices"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.lattice as latt
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+lay_sys = lay.LayerSystem([0, 0], [1.5, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+
+# hexagonal patch with one vacant site
+hexagonal_lattice = latt.Lattice(origin=[-100, 50], lattice_vectors=[[300, 0], [150, 150 * np.sqrt(3)]])
+sites = hexagonal_lattice.site_positions([(i, j) for i in range(4) for j in range(3) if not (i, j) == (1, 1)])
+particle_list = [part.Sphere(position=[x, y, 150], refractive_index=2.4, radius=100, l_max=2, m_max=2)
+                 for x, y in sites]
+
+
+def test_detect_lattice():
+    lattice = latt.detect_lattice(particle_list)
+    assert lattice is not None
+    indices = lattice.indices(particle_list)
+    np.testing.assert_allclose(lattice.site_positions(indices), sites, atol=1e-8)
+    shifted_particle = part.Sphere(position=[10, 20, 150], refractive_index=2.4, radius=100, l_max=2, m_max=2)
+    assert latt.detect_lattice(particle_list + [shifted_particle]) is None
+
+
+def test_lattice_coupling_matrix():
+    coup_mat = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys)
+    coup_mat_fft = linsys.CouplingMatrixLattice(vacuum_wavelength, particle_list, lay_sys, hexagonal_lattice)
+    coup_mat_explicit = linsys.CouplingMatrixLattice(vacuum_wavelength, particle_list, lay_sys, explicit=True)
+    w = coup_mat.linear_operator.A
+    np.testing.assert_allclose(coup_mat_explicit.linear_operator.A, w, rtol=1e-8, atol=1e-8 * abs(w).max())
+    x = np.random.rand(w.shape[0], 2) + 1j * np.random.rand(w.shape[0], 2)
+    wx = w.dot(x)
+    assert np.linalg.norm(coup_mat_fft.linear_operator.matmat(x) - wx) / np.linalg.norm(wx) < 1e-10
+    np.testing.assert_allclose(coup_mat_fft.submatrix([0, 2, 5]), coup_mat.submatrix([0, 2, 5]), rtol=1e-8,
+                               atol=1e-8 * abs(w).max())
+
+
+def test_lattice_linear_system():
+    coefficients = []
+    for solver_type, lattice in [('LU', None), ('LU', 'detect'), ('gmres', hexagonal_lattice)]:
+        linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave,
+                                            layer_system=lay_sys, solver_type=solver_type, solver_tolerance=1e-8,
+                                            store_coupling_matrix=solver_type == 'LU', lattice=lattice)
+        linear_system.prepare()
+        linear_system.solve()
+        coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particle_list]))
+    for b in coefficients[1:]:
+        assert np.linalg.norm(b - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-6
+
+
+if __name__ == '__main__':
+    test_detect_lattice()
+    test_lattice_coupling_matrix()
+    test_lattice_linear_system()
@@ -66,6 +66,28 @@ def test_layerresponse_for_kpar_arrays():
     np.testing.assert_almost_equal(lmat0, lmat_vec[:, :, 0])
 
 
+def test_vectorized_layerresponse_equals_pointwise():
+    """Does the evaluation for a whole array of kpar agree with the evaluation for each kpar separately?"""
+    kpar_array = np.linspace(0, 3 * omega, 30) + 1j * np.linspace(0, 0.05 * omega, 30) ** 2
+    for pol in [0, 1]:
+        smat_vec = lay.layersystem_scattering_matrix(pol, layer_d, layer_n, kpar_array, omega)
+        tmat_vec = lay.layersystem_transfer_matrix(pol, layer_d, layer_n, kpar_array, omega)
+        for i, kp in enumerate(kpar_array):
+            np.testing.assert_allclose(smat_vec[:, :, i], lay.layersystem_scattering_matrix(pol, layer_d, layer_n, kp,
+                                                                                            omega))
+            np.testing.assert_allclose(tmat_vec[:, :, i], lay.layersystem_transfer_matrix(pol, layer_d, layer_n, kp,
+                                                                                          omega))
+        for fromlayer in range(len(layer_d)):
+            for tolayer in range(len(layer_d)):
+                lmat_vec = lay.layersystem_response_matrix(pol, layer_d, layer_n, kpar_array, omega, fromlayer,
+                                                           tolayer)
+                lmat = np.zeros((2, 2, len(kpar_array)), dtype=complex)
+                for i, kp in enumerate(kpar_array):
+                    lmat[:, :, i] = lay.layersystem_response_matrix(pol, layer_d, layer_n, kp, omega, fromlayer,
+                                                                    tolayer)
+                np.testing.assert_allclose(lmat_vec, lmat, rtol=0, atol=1e-8 * abs(lmat).max())
+
+
 def test_layerresponse_method():
     fromlayer=2
     tolayer=1
@@ -94,4 +116,5 @@ if __name__ == '__main__':
     test_scattering_matrix_equals_transfer_matrix()
     test_layerresponse_against_prototype()
     test_layerresponse_for_kpar_arrays()
+    test_vectorized_layerresponse_equals_pointwise()
     test_layerresponse_method()
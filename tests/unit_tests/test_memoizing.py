@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Test the caching functionality defined in memoizing.py"""
+
+import numpy as np
+import smuthi.memoizing as memo
+import smuthi.layers as lay
+
+
+def test_array_fingerprint():
+    a = np.linspace(0, 1, 1000) + 0.1j
+    assert memo.fingerprint(a) == memo.fingerprint(a.copy())
+    assert memo.fingerprint(a) != memo.fingerprint(a.astype(np.complex64))
+    assert memo.fingerprint(a) != memo.fingerprint(a.reshape(10, 100))
+    b = a.copy()
+    b[500] += 1e-12
+    assert memo.fingerprint(a) != memo.fingerprint(b)
+    assert memo.fingerprint([1, 2.0]) != memo.fingerprint([1.0, 2])
+
+
+def test_lru_cache_is_bounded_by_bytes():
+    calls = []
+
+    @memo.memoize(max_bytes=3 * 8000 + 500, max_entries=None)
+    def block(n):
+        calls.append(n)
+        return np.ones(1000) * n
+
+    for n in range(5):
+        block(n)
+    stats = block.cache.statistics()
+    assert stats['misses'] == 5
+    assert stats['evictions'] == 2
+    assert stats['entries'] == 3
+    assert stats['bytes'] <= stats['max_bytes']
+
+    block(4)    # most recently used -> hit
+    block(0)    # evicted -> miss
+    assert calls == [0, 1, 2, 3, 4, 0]
+    stats = memo.cache_statistics()[block.cache.name]
+    assert stats['hits'] == 1
+    assert stats['misses'] == 6
+
+
+def test_memoized_layer_response():
+    cache = lay.layersystem_response_matrix.cache
+    cache.clear()
+    cache.reset_statistics()
+    kpar = np.linspace(0, 0.02, 300)
+    l1 = lay.layersystem_response_matrix(0, [0, 100, 0], [1, 2, 1.5], kpar, 0.01, 1, 1)
+    l2 = lay.layersystem_response_matrix(0, [0, 100, 0], [1, 2, 1.5], kpar.copy(), 0.01, 1, 1)
+    assert l1 is l2
+    assert cache.statistics()['hits'] == 1
+
+
+if __name__ == '__main__':
+    test_array_fingerprint()
+    test_lru_cache_is_bounded_by_bytes()
+    test_memoized_layer_response()
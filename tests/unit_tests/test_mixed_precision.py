@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Test the single precision LU factorization with iterative refinement"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+lay_sys = lay.LayerSystem([0, 400, 0], [1.5, 1.7, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+part1 = part.Sphere(position=[100, 100, 150], refractive_index=2.4 + 0.0j, radius=110, l_max=3, m_max=3)
+part2 = part.Sphere(position=[-100, -100, 250], refractive_index=1.9 + 0.1j, radius=80, l_max=3, m_max=3)
+part3 = part.Sphere(position=[-200, 100, 300], refractive_index=2.5 + 0.0j, radius=90, l_max=3, m_max=3)
+particle_list = [part1, part2, part3]
+
+
+def solution(solver_type):
+    linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave, layer_system=lay_sys,
+                                        solver_type=solver_type)
+    linear_system.prepare()
+    linear_system.solve()
+    return linear_system, np.concatenate([particle.scattered_field.coefficients for particle in particle_list])
+
+
+def test_mixed_precision_lu():
+    _, b_lu = solution('LU')
+    linear_system, b_mixed = solution('LU_mixed')
+    assert linear_system.master_matrix.LU_piv_single[0].dtype == np.complex64
+    assert linear_system.refinement_residuals[-1] < linear_system.refinement_residuals[0]
+    assert linear_system.refinement_residuals[-1] < 1e-12
+    assert np.linalg.norm(b_mixed - b_lu) / np.linalg.norm(b_lu) < 1e-10
+
+
+def test_mixed_precision_multiple_rhs():
+    linear_system_lu, _ = solution('LU')
+    linear_system, _ = solution('LU_mixed')
+    initial_fields = [init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=beta, azimuthal_angle=0.3,
+                                     polarization=pol) for beta in [np.pi * 7/8, np.pi * 5/8] for pol in range(2)]
+    fields_lu = linear_system_lu.solve_multiple(initial_fields)
+    fields_mixed = linear_system.solve_multiple(initial_fields)
+    assert linear_system.refinement_residuals[-1] < 1e-12
+    for swe_list_lu, swe_list_mixed in zip(fields_lu, fields_mixed):
+        b_lu = np.concatenate([swe.coefficients for swe in swe_list_lu])
+        b_mixed = np.concatenate([swe.coefficients for swe in swe_list_mixed])
+        assert np.linalg.norm(b_mixed - b_lu) / np.linalg.norm(b_lu) < 1e-10
+
+
+def test_zero_rhs():
+    linear_system, _ = solution('LU_mixed')
+    n = linear_system.master_matrix.shape[0]
+    assert not np.any(linear_system.mixed_precision_lu_solve(np.zeros(n, dtype=complex)))
+    rhs = np.zeros((n, 2), dtype=complex)
+    rhs[:, 1] = 1
+    b = linear_system.mixed_precision_lu_solve(rhs)
+    assert not np.any(b[:, 0])
+    m = linear_system.master_matrix.explicit_matrix()
+    assert np.linalg.norm(m.dot(b[:, 1]) - rhs[:, 1]) / np.linalg.norm(rhs[:, 1]) < 1e-12
+
+
+def test_explicit_matrix():
+    linear_system, _ = solution('LU')
+    m = linear_system.master_matrix.linear_operator.A
+    np.testing.assert_allclose(linear_system.master_matrix.explicit_matrix(), m, atol=1e-14 * abs(m).max())
+
+
+if __name__ == '__main__':
+    test_mixed_precision_lu()
+    test_mixed_precision_multiple_rhs()
+    test_zero_rhs()
+    test_explicit_matrix()
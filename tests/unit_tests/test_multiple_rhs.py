@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Test the solution of the linear system for multiple initial fields"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.simulation as simul
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+polar_angles = [np.pi * 7/8, np.pi * 6/8, np.pi * 5/8]
+azimuthal_angle = np.pi * 1/3
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+
+sphere1 = part.Sphere(position=[100, 100, 150], refractive_index=2.4 + 0.0j, radius=110, l_max=3, m_max=3)
+sphere2 = part.Sphere(position=[-100, -100, 250], refractive_index=1.9 + 0.0j, radius=120, l_max=3, m_max=2)
+particle_list = [sphere1, sphere2]
+
+lay_sys = lay.LayerSystem([0, 400, 0], [2, 1.4, 2])
+
+initial_field_list = [init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=beta,
+                                     azimuthal_angle=azimuthal_angle, polarization=pol)
+                      for beta in polar_angles for pol in range(2)]
+
+# one simulation per initial field
+coefficients_single = []
+for initial_field in initial_field_list:
+    simulation = simul.Simulation(layer_system=lay_sys, particle_list=particle_list, initial_field=initial_field,
+                                  solver_type='LU', log_to_terminal=False)
+    simulation.run()
+    coefficients_single.append([particle.scattered_field.coefficients for particle in particle_list])
+
+# one simulation for the first initial field, then solve for all
+simulation = simul.Simulation(layer_system=lay_sys, particle_list=particle_list, initial_field=initial_field_list[0],
+                              solver_type='LU', log_to_terminal=False)
+simulation.run()
+scattered_fields_multiple = simulation.linear_system.solve_multiple(initial_field_list)
+
+# block GMRES with lookup
+simulation_lookup = simul.Simulation(layer_system=lay_sys, particle_list=particle_list,
+                                     initial_field=initial_field_list[0], solver_type='gmres', solver_tolerance=1e-6,
+                                     store_coupling_matrix=False, coupling_matrix_lookup_resolution=5,
+                                     coupling_matrix_interpolator_kind='cubic', log_to_terminal=False)
+simulation_lookup.run()
+scattered_fields_lookup = simulation_lookup.linear_system.solve_multiple(initial_field_list)
+
+
+def test_multiple_rhs():
+    assert len(scattered_fields_multiple) == len(initial_field_list)
+    for j in range(len(initial_field_list)):
+        for i in range(len(particle_list)):
+            np.testing.assert_allclose(scattered_fields_multiple[j][i].coefficients, coefficients_single[j][i],
+                                       rtol=1e-10, atol=1e-10 * np.abs(coefficients_single[j][i]).max())
+
+
+def test_multiple_rhs_block_gmres():
+    for j in range(len(initial_field_list)):
+        for i in range(len(particle_list)):
+            relerr = (np.linalg.norm(scattered_fields_lookup[j][i].coefficients - coefficients_single[j][i])
+                      / np.linalg.norm(coefficients_single[j][i]))
+            assert relerr < 1e-3
+
+
+if __name__ == '__main__':
+    test_multiple_rhs()
+    test_multiple_rhs_block_gmres()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Test the out-of-core storage of the coupling matrix and the tiled LU factorization"""
+import numpy as np
+import tempfile
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.out_of_core as ooc
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+lay_sys = lay.LayerSystem([0, 400, 0], [1.5, 1.7, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+part1 = part.Sphere(position=[100, 100, 150], refractive_index=2.4 + 0.0j, radius=110, l_max=3, m_max=3)
+part2 = part.Sphere(position=[-100, -100, 250], refractive_index=1.9 + 0.1j, radius=80, l_max=2, m_max=2)
+part3 = part.Sphere(position=[-200, 100, 300], refractive_index=2.5 + 0.0j, radius=90, l_max=3, m_max=2)
+particle_list = [part1, part2, part3]
+directory = tempfile.mkdtemp()
+
+
+def test_tiled_lu():
+    np.random.seed(0)
+    a = np.random.rand(50, 50) + 1j * np.random.rand(50, 50)
+    b = np.random.rand(50, 3) + 1j * np.random.rand(50, 3)
+    lu = ooc.matrix_file(a.shape, directory=directory)
+    lu[:] = a
+    piv = ooc.tiled_lu_factor(lu, panel_width=7)
+    x = ooc.tiled_lu_solve(lu, piv, b, panel_width=7)
+    np.testing.assert_allclose(a.dot(x), b, atol=1e-10)
+    np.testing.assert_allclose(ooc.tiled_matmat(np.asfortranarray(a), b, 7), a.dot(b), atol=1e-12)
+
+
+def test_out_of_core_coupling_matrix():
+    coup_mat = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys)
+    coup_mat_ooc = linsys.CouplingMatrixOutOfCore(vacuum_wavelength, particle_list, lay_sys, directory=directory,
+                                                  tile_memory=16 * 60 * coup_mat.shape[0])
+    assert len(coup_mat_ooc.particle_panels) > 1
+    w = coup_mat.linear_operator.A
+    np.testing.assert_allclose(coup_mat_ooc.matrix, w, atol=1e-14 * abs(w).max())
+    np.testing.assert_allclose(coup_mat_ooc.submatrix([0, 2]), coup_mat.submatrix([0, 2]), atol=1e-14 * abs(w).max())
+
+
+def test_out_of_core_linear_system():
+    coefficients = []
+    for out_of_core_directory in [None, directory]:
+        linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave,
+                                            layer_system=lay_sys, solver_type='LU',
+                                            out_of_core_directory=out_of_core_directory)
+        linear_system.prepare()
+        linear_system.solve()
+        coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particle_list]))
+    assert np.linalg.norm(coefficients[1] - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-10
+
+
+if __name__ == '__main__':
+    test_tiled_lu()
+    test_out_of_core_coupling_matrix()
+    test_out_of_core_linear_system()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Test the multithreaded assembly of the explicit coupling matrix"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+np.random.seed(4)
+lay_sys = lay.LayerSystem([0, 400, 0], [1.5, 1.7, 1])
+positions = np.random.rand(12, 3) * [1000, 1000, 300] + [0, 0, 50]
+particle_list = [part.Sphere(position=list(position), refractive_index=2.4, radius=40, l_max=2, m_max=2)
+                 for position in positions]
+
+
+def test_threads_deterministic():
+    w_serial = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys,
+                                             number_of_threads=1).linear_operator.A
+    w_parallel = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys,
+                                               number_of_threads=4).linear_operator.A
+    assert np.array_equal(w_serial, w_parallel)
+
+
+if __name__ == '__main__':
+    test_threads_deterministic()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Test the structure-of-arrays particle container"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+lay_sys = lay.LayerSystem([0, 400, 0], [1.5, 1.7, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+positions = [[100, 100, 150], [-100, -100, 250], [-200, 100, 300], [200, -150, 200], [0, 250, 500]]
+
+
+def sphere_list():
+    return [part.Sphere(position=list(position), refractive_index=2.4, radius=80 + 20 * (i % 2), l_max=3, m_max=3)
+            for i, position in enumerate(positions)]
+
+
+def solve(particle_list):
+    linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave, layer_system=lay_sys,
+                                        solver_type='LU')
+    linear_system.prepare()
+    linear_system.solve()
+    return np.concatenate([particle.scattered_field.coefficients for particle in particle_list])
+
+
+def test_particle_array_api():
+    particle_array = part.ParticleArray(sphere_list())
+    np.testing.assert_array_equal(particle_array.positions, positions)
+    particle_array[1].position[0] = 50
+    assert particle_array.positions[1, 0] == -100
+    particle_array.update()
+    assert particle_array.positions[1, 0] == 50
+    assert isinstance(particle_array[1].position, list)
+    particle_array.append(part.Sphere(position=[0, 0, 100], refractive_index=2.4, radius=80, l_max=2, m_max=2))
+    assert particle_array.positions.shape == (6, 3)
+    assert particle_array.blocksizes[-1] == 16
+    groups = particle_array.identical_particle_groups()
+    assert sorted(len(group) for group in groups) == [1, 2, 3]
+    assert isinstance(particle_array[1:3], list)
+
+
+def test_positions_refreshed_by_linear_system():
+    particle_array = part.ParticleArray(sphere_list())
+    particle_array[2].position[2] = 350
+    linsys.LinearSystem(particle_list=particle_array, initial_field=plane_wave, layer_system=lay_sys,
+                        solver_type='LU')
+    assert particle_array.positions[2, 2] == 350
+    np.testing.assert_array_equal(part.particle_positions(particle_array),
+                                  [particle.position for particle in particle_array])
+
+
+def test_particle_array_linear_system():
+    b_list = solve(sphere_list())
+    particle_array = part.ParticleArray(sphere_list())
+    b_array = solve(particle_array)
+    assert np.linalg.norm(b_array - b_list) / np.linalg.norm(b_list) < 1e-12
+    # particles 0 and 2 are identical and in the same layer, particle 4 is in another layer
+    assert particle_array[0].t_matrix is particle_array[2].t_matrix
+    assert particle_array[4].t_matrix is not particle_array[0].t_matrix
+    assert np.shares_memory(particle_array[3].scattered_field.coefficients, particle_array.scattered_field_coefficients)
+    assert np.shares_memory(particle_array[3].initial_field.coefficients, particle_array.initial_field_coefficients)
+
+
+if __name__ == '__main__':
+    test_particle_array_api()
+    test_positions_refreshed_by_linear_system()
+    test_particle_array_linear_system()
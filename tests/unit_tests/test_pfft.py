@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Test the precorrected FFT method for the coupling between particles at the same height"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.pfft as pfft
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+lookup_resol = 5
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+np.random.seed(2)
+lay_sys = lay.LayerSystem([0, 0], [1.5, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+grid = np.arange(6) * 300
+positions = np.array([[x, y] for x in grid for y in grid]) + (np.random.rand(36, 2) - 0.5) * 100
+particle_list = [part.Sphere(position=[x, y, 150], refractive_index=2.4, radius=100, l_max=2, m_max=2)
+                 for x, y in positions]
+
+
+def test_lagrange_stencil():
+    x = np.random.rand(10) * 10
+    indices, weights = pfft.lagrange_stencil(x, grid_origin=-1, grid_spacing=0.5, order=4)
+    nodes = -1 + 0.5 * indices
+    np.testing.assert_allclose((weights * nodes**3).sum(axis=-1), x**3)
+
+
+def test_pfft_matvec():
+    coup_mat = linsys.CouplingMatrixRadialLookupCPU(vacuum_wavelength, particle_list, lay_sys,
+                                                    resolution=lookup_resol, interpolator_kind='cubic', explicit=True)
+    coup_mat_fft = linsys.CouplingMatrixRadialLookupFFT(vacuum_wavelength, particle_list, lay_sys,
+                                                        resolution=lookup_resol, interpolator_kind='cubic',
+                                                        grid_spacing=25, interpolation_order=4)
+    assert coup_mat_fft.pfft.correction_matrix.nnz < coup_mat.shape[0]**2
+    x = np.random.rand(coup_mat.shape[0], 2) + 1j * np.random.rand(coup_mat.shape[0], 2)
+    wx = coup_mat.linear_operator.matmat(x)
+    relerr = np.linalg.norm(coup_mat_fft.linear_operator.matmat(x) - wx) / np.linalg.norm(wx)
+    print('relative error precorrected FFT matvec: ', relerr)
+    assert relerr < 1e-2
+
+
+def test_pfft_linear_system():
+    coefficients = []
+    for pfft_grid_spacing in [None, 25]:
+        linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave,
+                                            layer_system=lay_sys, solver_type='gmres', solver_tolerance=1e-6,
+                                            store_coupling_matrix=False, coupling_matrix_lookup_resolution=lookup_resol,
+                                            interpolator_kind='cubic', pfft_grid_spacing=pfft_grid_spacing)
+        linear_system.prepare()
+        linear_system.solve()
+        coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particle_list]))
+    assert np.linalg.norm(coefficients[1] - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-2
+
+
+if __name__ == '__main__':
+    test_lagrange_stencil()
+    test_pfft_matvec()
+    test_pfft_linear_system()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Test the preconditioners for the GMRES solution of the linear system"""
+import numpy as np
+import scipy.linalg
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.preconditioners as precond
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+# explicit contour, such that the result does not depend on the default set by other test modules
+k_parallel = coord.complex_contour(vacuum_wavelength, neff_waypoints, neff_discr)
+
+lay_sys = lay.LayerSystem([0, 800, 0], [1.5, 1, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+
+particle_list = []
+for i, x in enumerate(np.arange(4) * 220):
+    for j, y in enumerate(np.arange(3) * 220):
+        particle_list.append(part.Sphere(position=[x, y, 150 + 60 * ((i + j) % 2)], refractive_index=3.5,
+                                         radius=100, l_max=2, m_max=2))
+
+
+def solve(preconditioner=None, lookup_resolution=None, solver_type='gmres', tolerance=1e-8):
+    linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave, layer_system=lay_sys,
+                                        k_parallel=k_parallel, solver_type=solver_type, solver_tolerance=tolerance,
+                                        coupling_matrix_lookup_resolution=lookup_resolution,
+                                        store_coupling_matrix=lookup_resolution is None,
+                                        preconditioner=preconditioner)
+    linear_system.prepare()
+    linear_system.solve()
+    b = np.concatenate([particle.scattered_field.coefficients for particle in particle_list])
+    return b, linsys.iter_num
+
+
+b_lu, _ = solve(solver_type='LU')
+
+
+def test_spatial_clusters():
+    clusters = precond.spatial_clusters(particle_list, max_cluster_size=5)
+    assert max(len(cluster) for cluster in clusters) <= 5
+    np.testing.assert_array_equal(np.sort(np.concatenate(clusters)), np.arange(len(particle_list)))
+
+
+def test_preconditioned_gmres():
+    b, iterations = solve()
+    b_jacobi, iterations_jacobi = solve('block_jacobi')
+    b_cluster, iterations_cluster = solve(precond.ClusterPreconditioner(max_cluster_size=4))
+    for b_test in [b, b_jacobi, b_cluster]:
+        assert np.linalg.norm(b_test - b_lu) / np.linalg.norm(b_lu) < 1e-6
+    assert iterations_cluster < iterations
+
+
+def test_exact_user_preconditioner():
+    def inverse_master_matrix(linear_system):
+        return scipy.linalg.inv(linear_system.master_matrix.linear_operator.A)
+    b, iterations = solve(inverse_master_matrix)
+    assert np.linalg.norm(b - b_lu) / np.linalg.norm(b_lu) < 1e-6
+    assert iterations <= 2
+
+
+def test_cluster_preconditioner_with_lookup():
+    # the precomputed lookup coupling matrix is single precision
+    b, iterations = solve(lookup_resolution=5, tolerance=1e-5)
+    b_cluster, iterations_cluster = solve('cluster', lookup_resolution=5, tolerance=1e-5)
+    assert np.linalg.norm(b_cluster - b) / np.linalg.norm(b) < 1e-4
+    assert iterations_cluster < iterations
+
+    # the diagonal blocks of the lookup are close to those of the explicit coupling matrix
+    linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave, layer_system=lay_sys,
+                                        k_parallel=k_parallel, solver_type='gmres',
+                                        coupling_matrix_lookup_resolution=5, store_coupling_matrix=False)
+    linear_system.prepare()
+    cluster = np.array([0, 2, 5, 7])
+    w_lookup = linear_system.coupling_matrix.submatrix(cluster)
+    w_explicit = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys, k_parallel).submatrix(cluster)
+    assert np.linalg.norm(w_lookup - w_explicit) / np.linalg.norm(w_explicit) < 1e-3
+
+
+if __name__ == '__main__':
+    test_spatial_clusters()
+    test_preconditioned_gmres()
+    test_exact_user_preconditioner()
+    test_cluster_preconditioner_with_lookup()
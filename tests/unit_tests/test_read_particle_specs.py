@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Test the bulk reader and the binary format of particle specification files"""
+import os
+import tempfile
+import numpy as np
+import pkg_resources
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.initial_field as init
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+import smuthi.read_input as rin
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+lay_sys = lay.LayerSystem([0, 0], [1.5, 1])
+plane_wave = init.PlaneWave(vacuum_wavelength=vacuum_wavelength, polar_angle=np.pi * 7/8, azimuthal_angle=0.3,
+                            polarization=0)
+spec_file = pkg_resources.resource_filename('smuthi', 'data/example_particle_specs.dat')
+
+
+def test_read_text_specs():
+    particle_list = rin.read_particle_specs(spec_file)
+    assert type(particle_list) is list
+    assert [type(particle).__name__ for particle in particle_list] == ['Sphere', 'FiniteCylinder', 'Spheroid']
+    assert all(type(particle.position) is list for particle in particle_list)
+    np.testing.assert_allclose(part.particle_positions(particle_list),
+                               [[0, 100, 150], [250, -100, 250], [-250, 0, 350]])
+    assert particle_list[0].radius == 100 and particle_list[0].refractive_index == 2.4 + 0.05j
+    assert particle_list[1].cylinder_radius == 120 and particle_list[1].cylinder_height == 150
+    assert particle_list[1].euler_angles[:2] == [30, 60]
+    assert particle_list[2].semi_axis_c == 80 and particle_list[2].semi_axis_a == 140
+    assert [particle.l_max for particle in particle_list] == [3, 4, 3]
+
+
+def test_sections_without_header():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'specs.dat')
+        with open(filename, 'w') as specs:
+            specs.write('0 0 100 50 1.5 0 2 2\n1 0 100 50 1.5 0 2 1  # comment\n\n# spheres\n2 0 100 60 2 0.1 3 3\n')
+        particle_list = rin.read_particle_specs(filename)
+    assert len(particle_list) == 3
+    assert [particle.m_max for particle in particle_list] == [2, 1, 3]
+
+
+def test_binary_specs():
+    particle_list = rin.read_particle_specs(spec_file)
+    extensions = ['.npz'] + (['.h5'] if rin.h5py_available else [])
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in extensions:
+            filename = os.path.join(directory, 'specs' + extension)
+            rin.write_particle_specs(filename, particle_list)
+            binary_list = rin.read_particle_specs(filename)
+            # binary files group the particles by type
+            assert [type(particle).__name__ for particle in binary_list] == ['Sphere', 'Spheroid', 'FiniteCylinder']
+            np.testing.assert_allclose(part.particle_positions(binary_list),
+                                       part.particle_positions(particle_list)[[0, 2, 1]])
+            assert binary_list[2].euler_angles[:2] == particle_list[1].euler_angles[:2]
+            assert binary_list[1].refractive_index == particle_list[2].refractive_index
+
+
+def test_solve_from_specs():
+    coefficients = []
+    for particle_list in [rin.read_particle_specs(spec_file), part.ParticleArray(rin.read_particle_specs(spec_file))]:
+        linear_system = linsys.LinearSystem(particle_list=particle_list, initial_field=plane_wave,
+                                            layer_system=lay_sys, solver_type='LU')
+        linear_system.prepare()
+        linear_system.solve()
+        coefficients.append(np.concatenate([particle.scattered_field.coefficients for particle in particle_list]))
+    assert np.all(np.isfinite(coefficients[0])) and np.linalg.norm(coefficients[0]) > 0
+    assert np.linalg.norm(coefficients[1] - coefficients[0]) / np.linalg.norm(coefficients[0]) < 1e-12
+
+
+if __name__ == '__main__':
+    test_read_text_specs()
+    test_sections_without_header()
+    test_binary_specs()
+    test_solve_from_specs()
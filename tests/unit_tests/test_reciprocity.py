@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Test the assembly of the coupling matrix and of the lookup tables with the reciprocity relation"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.coordinates as coord
+import smuthi.particle_coupling as coup
+import smuthi.linear_system as linsys
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+lookup_resol = 10
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+np.random.seed(5)
+lay_sys = lay.LayerSystem([0, 400, 0], [1.5, 1.7 + 0.01j, 1])
+positions = np.random.rand(6, 3) * [800, 800, 200] + [0, 0, 100]
+particle_list = [part.Sphere(position=list(position), refractive_index=2.4, radius=50, l_max=3, m_max=3)
+                 for position in positions]
+particle_list[1].l_max, particle_list[1].m_max = 2, 1
+particle_list.append(part.Sphere(position=[200, 100, 500], refractive_index=2.4, radius=50, l_max=2, m_max=2))
+planar_particle_list = [part.Sphere(position=list(position[:2]) + [150], refractive_index=2.4, radius=50, l_max=2,
+                                    m_max=2) for position in positions]
+
+
+def test_reciprocity_relation():
+    assert coup.reciprocity_deviation(vacuum_wavelength, particle_list, lay_sys, number_of_pairs=15) < 1e-10
+
+
+def test_explicit_coupling_matrix():
+    default_use_reciprocity = coup.use_reciprocity
+    try:
+        coup.use_reciprocity = False
+        w = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys).linear_operator.A
+        coup.use_reciprocity = 'validate'
+        w_reciprocal = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys).linear_operator.A
+    finally:
+        coup.use_reciprocity = default_use_reciprocity
+    np.testing.assert_allclose(w_reciprocal, w, rtol=0, atol=1e-10 * abs(w).max())
+
+
+def test_radial_lookup():
+    default_use_reciprocity = coup.use_reciprocity
+    try:
+        coup.use_reciprocity = False
+        w, _ = coup.radial_coupling_lookup_table(vacuum_wavelength, planar_particle_list, lay_sys,
+                                                 resolution=lookup_resol)
+        coup.use_reciprocity = True
+        w_reciprocal, _ = coup.radial_coupling_lookup_table(vacuum_wavelength, planar_particle_list, lay_sys,
+                                                            resolution=lookup_resol)
+    finally:
+        coup.use_reciprocity = default_use_reciprocity
+    np.testing.assert_allclose(w_reciprocal, w, rtol=0, atol=1e-5 * abs(w).max())
+
+
+def test_volume_lookup():
+    default_use_reciprocity = coup.use_reciprocity
+    try:
+        coup.use_reciprocity = False
+        w_pl, w_mn, _, _, _ = coup.volumetric_coupling_lookup_table(vacuum_wavelength, particle_list[:4], lay_sys,
+                                                                    resolution=2 * lookup_resol)
+        coup.use_reciprocity = True
+        w_pl_reciprocal, w_mn_reciprocal, _, _, _ = coup.volumetric_coupling_lookup_table(
+            vacuum_wavelength, particle_list[:4], lay_sys, resolution=2 * lookup_resol)
+    finally:
+        coup.use_reciprocity = default_use_reciprocity
+    np.testing.assert_allclose(w_pl_reciprocal, w_pl, rtol=0, atol=1e-5 * abs(w_pl).max())
+    np.testing.assert_array_equal(w_mn_reciprocal, w_mn)
+
+
+if __name__ == '__main__':
+    test_reciprocity_relation()
+    test_explicit_coupling_matrix()
+    test_radial_lookup()
+    test_volume_lookup()
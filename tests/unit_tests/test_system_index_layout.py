@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Test the precomputed index layout of the system vector"""
+import numpy as np
+import smuthi.particles as part
+import smuthi.field_expansion as fldex
+import smuthi.particle_coupling as coup
+import smuthi.linear_system as linsys
+
+
+l_max = [3, 2, 3, 4, 2]
+m_max = [3, 2, 1, 4, 2]
+particle_list = [part.Sphere(position=[100 * i, 0, 0], refractive_index=2.4, radius=50, l_max=l, m_max=m)
+                 for i, (l, m) in enumerate(zip(l_max, m_max))]
+layout = linsys.SystemIndexLayout(particle_list)
+
+
+def test_layout_indices():
+    blocksizes = [fldex.blocksize(l, m) for l, m in zip(l_max, m_max)]
+    assert layout.size == sum(blocksizes)
+    for i, particle in enumerate(particle_list):
+        assert layout.block(i) == range(sum(blocksizes[:i]), sum(blocksizes[:i + 1]))
+        for tau in range(2):
+            for m in range(-particle.m_max, particle.m_max + 1):
+                for l in range(max(1, abs(m)), particle.l_max + 1):
+                    n = sum(blocksizes[:i]) + fldex.multi_to_single_index(tau, l, m, particle.l_max, particle.m_max)
+                    assert layout.index(i, tau, l, m) == n
+                    assert (layout.tau_array[n], layout.l_array[n], layout.m_array[n]) == (tau, l, m)
+                    assert layout.particle_numbers[n] == i
+    reference = np.concatenate([np.arange(sum(blocksizes[:i]), sum(blocksizes[:i + 1])) for i in [3, 0, 2]])
+    np.testing.assert_array_equal(layout.index_array([3, 0, 2]), reference)
+
+
+def test_lookup_index_array():
+    lookup_l_max, lookup_m_max = max(l_max), max(m_max)
+    lookup_indices = layout.lookup_index_array(lookup_l_max, lookup_m_max)
+    lookup_blocksize = fldex.blocksize(lookup_l_max, lookup_m_max)
+    for n in range(layout.size):
+        tau, l, m = layout.tau_array[n], layout.l_array[n], layout.m_array[n]
+        assert lookup_indices[n] == (layout.particle_numbers[n] * lookup_blocksize
+                                     + fldex.multi_to_single_index(tau, l, m, lookup_l_max, lookup_m_max))
+
+
+def test_block_multi_indices():
+    for l, m in zip(l_max, m_max):
+        tau_block, l_block, m_block = coup.block_multi_indices(l, m)
+        np.testing.assert_array_equal(coup.block_m_array(l, m), m_block)
+        reversal_index = coup.multipole_reversal_index(l, m)
+        for n in range(fldex.blocksize(l, m)):
+            assert fldex.multi_to_single_index(tau_block[n], l_block[n], m_block[n], l, m) == n
+            assert reversal_index[n] == fldex.multi_to_single_index(tau_block[n], l_block[n], -m_block[n], l, m)
+
+
+def test_split():
+    vector = np.arange(layout.size)
+    for i, block in enumerate(layout.split(vector)):
+        np.testing.assert_array_equal(block, vector[layout.block(i)])
+
+
+if __name__ == '__main__':
+    test_layout_indices()
+    test_lookup_index_array()
+    test_block_multi_indices()
+    test_split()
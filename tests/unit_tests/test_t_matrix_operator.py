@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Test the grouped application of diagonal and shared particle T-matrices"""
+import numpy as np
+import scipy.linalg
+import smuthi.particles as part
+import smuthi.layers as lay
+import smuthi.coordinates as coord
+import smuthi.linear_system as linsys
+
+
+# Parameter input ----------------------------
+vacuum_wavelength = 550
+neff_waypoints = [0, 0.5, 0.8-0.01j, 2-0.01j, 2.5, 5]
+neff_discr = 1e-2
+# --------------------------------------------
+
+coord.set_default_k_parallel(vacuum_wavelength, neff_waypoints, neff_discr)
+lay_sys = lay.LayerSystem([0, 0], [1.5, 1])
+positions = [[0, 0, 150], [300, 0, 150], [0, 300, 150], [300, 300, 150], [-300, 0, 150], [0, -300, 150]]
+l_max = [2, 2, 3, 2, 3, 2]
+particle_list = [part.Sphere(position=pos, refractive_index=2.4, radius=100, l_max=l, m_max=l)
+                 for pos, l in zip(positions, l_max)]
+
+np.random.seed(0)
+shared_t = np.random.rand(16, 16) + 1j * np.random.rand(16, 16)
+for i, particle in enumerate(particle_list):
+    n = 2 * l_max[i] * (l_max[i] + 2)
+    if i in [1, 3]:
+        particle.t_matrix = shared_t
+    elif i == 5:
+        particle.t_matrix = np.random.rand(n, n) + 1j * np.random.rand(n, n)
+    else:
+        particle.t_matrix = np.diag(np.random.rand(n) + 1j * np.random.rand(n))
+t_reference = scipy.linalg.block_diag(*[particle.t_matrix for particle in particle_list])
+
+
+def test_t_matrix_groups():
+    t_matrix = linsys.TMatrix(particle_list)
+    diagonal = [group[2] for group in t_matrix.particle_groups]
+    assert sorted(diagonal) == [False, False, True, True]
+    x = np.random.rand(t_matrix.shape[0], 3) + 1j * np.random.rand(t_matrix.shape[0], 3)
+    np.testing.assert_allclose(t_matrix.linear_operator.matmat(x), t_reference.dot(x), rtol=1e-12)
+    np.testing.assert_allclose(t_matrix.linear_operator.matvec(x[:, 0]), t_reference.dot(x[:, 0]), rtol=1e-12)
+    np.testing.assert_allclose(t_matrix.apply(x, chunk_memory=1), t_reference.dot(x), rtol=1e-12)
+
+
+def test_master_matrix():
+    t_matrix = linsys.TMatrix(particle_list)
+    coupling_matrix = linsys.CouplingMatrixExplicit(vacuum_wavelength, particle_list, lay_sys)
+    w = coupling_matrix.linear_operator.A
+    master_matrix = linsys.MasterMatrix(t_matrix, coupling_matrix)
+    m = np.eye(w.shape[0]) - t_reference.dot(w)
+    np.testing.assert_allclose(master_matrix.linear_operator.A, m, atol=1e-12 * abs(m).max())
+    m_single = master_matrix.explicit_matrix(dtype=np.complex64)
+    assert m_single.dtype == np.complex64
+    np.testing.assert_allclose(m_single, m, atol=1e-6 * abs(m).max())
+
+
+if __name__ == '__main__':
+    test_t_matrix_groups()
+    test_master_matrix()